@@ -20,9 +20,501 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from app import App
-from gui import IPSXFrame
+import os
+import sys
+import json
+import argparse
+
+
+# Imports are done inside the commands, so a CLI call only loads what it
+# uses; wx is imported for the GUI only.
+
+def _helper(args: argparse.Namespace, recover: bool=False) -> "ProxyHelper":
+    """
+    Sets up ProxyHelper. Commands that write the registry pass ``recover``,
+    so an interrupted change is finished before they start; read-only ones
+    skip the journal check.
+    """
+    from res import BACKUP_REG
+    from proxy import ProxyHelper
+    ProxyHelper.backup_file = args.backups or BACKUP_REG
+    if args.registry:
+        from backend import FileBackend
+        ProxyHelper.backend = FileBackend(args.registry)
+    if not recover:
+        return ProxyHelper
+    recovered = ProxyHelper.recover()
+    if args.registry and recovered.ok and recovered.value is not None:
+        # The journal is gone once recovered; persist what it wrote even
+        # if the command itself fails
+        ProxyHelper.backend.save()
+    if recovered.message:
+        from util import history_log
+        history_log(recovered.message)
+    return ProxyHelper
+
+
+def _finish(helper: "ProxyHelper", args: argparse.Namespace, result: dict) -> dict:
+    if args.registry and result.get("ok"):
+        helper.backend.save()
+    if result.get("ok") and result.get("status"):
+        from util import history_log, history
+        history_log(result["status"])
+        history().close()
+    return result
+
+
+def _all_users(helper: "ProxyHelper", args: argparse.Namespace, label: str, operation: str, *params) -> dict:
+    from hives import MultiUserApply
+    report = getattr(MultiUserApply(helper, args.workers), operation)(*params)
+    if args.registry and report.results and len(report.failed) < len(report.results):
+        helper.backend.save()
+    result = dict(report.to_dict(), ok=report.ok)
+    result["status"] = "{} for {} of {} user hives".format(
+        label, result["succeeded"], result["hives"]) if report.results else ""
+    if not report.results:
+        result["error"] = "No user hive is loaded"
+    return _finish(helper, args, result)
+
+
+def cmd_users(args: argparse.Namespace) -> dict:
+    from hives import list_hives
+    helper = _helper(args)
+    with helper.editor() as net:
+        return {"ok": True, "hives": list_hives(net.backend)}
+
+
+def cmd_install(args: argparse.Namespace) -> dict:
+    from res import INVALID_URL
+    from util import validate_pac_url
+    if len(args.url) > 1:
+        return _install_fastest(args)
+    url, = args.url
+    if not validate_pac_url(url):
+        return {"ok": False, "error": INVALID_URL}
+    fetcher = None
+    if args.check:
+        import dnscache
+        from urllib.parse import urlparse
+        from res import UNRESOLVED_HOST
+        from pacfetch import PacFetcher
+        if not validate_pac_url(url, dnscache.shared().get):
+            return {"ok": False, "error": UNRESOLVED_HOST.format(urlparse(url).hostname)}
+        fetcher = PacFetcher()
+    helper = _helper(args, recover=True)
+    if args.all_users:
+        if fetcher is not None:
+            from res import PAC_FETCH_ERR
+            ok, err = fetcher.check(url)
+            if not ok:
+                return {"ok": False, "error": PAC_FETCH_ERR.format(err)}
+        return _all_users(helper, args, "PAC file installed", "install_pac_file", url)
+    result = helper.backup_and_install(url, fetcher)
+    if not result:
+        return {"ok": False, "error": result.error}
+    return _finish(helper, args, {"ok": True, "status": result.status, "url": url})
+
+
+def _install_fastest(args: argparse.Namespace) -> dict:
+    from res import INVALID_URL
+    from mirrors import MirrorSet
+    mirrors = MirrorSet(args.url)
+    if mirrors.invalid:
+        return {"ok": False, "error": INVALID_URL, "invalid": mirrors.invalid}
+    helper = _helper(args, recover=True)
+    if args.all_users:
+        best = mirrors.fastest()
+        if best is None:
+            from res import PAC_FETCH_ERR
+            return {"ok": False, "error": PAC_FETCH_ERR.format("no mirror answered"),
+                    "probes": [p.to_dict() for p in mirrors.probe()]}
+        return dict(_all_users(helper, args, "PAC file installed", "install_pac_file", best.url), url=best.url)
+    result = helper.install_fastest(mirrors)
+    probes = [p.to_dict() for p in mirrors.probe()]
+    if not result:
+        return {"ok": False, "error": result.error, "probes": probes}
+    return _finish(helper, args, {"ok": True, "status": result.status, "url": result.value.url,
+                                  "probes": probes})
+
+
+def cmd_discover(args: argparse.Namespace) -> dict:
+    from res import WPAD_CACHE
+    from wpad import WpadDiscovery, WpadCache
+    helper = _helper(args, recover=args.install)
+    cache = WpadCache(os.path.join(helper.backup_file, WPAD_CACHE))
+    discovery = WpadDiscovery(args.domain, args.gateway, cache=cache, timeout=args.timeout)
+    result = {"network": discovery.network(), "candidates": discovery.candidates()}
+    if args.install:
+        outcome = helper.discover_and_install(discovery, args.fresh)
+        result.update(ok=outcome.ok, url=outcome.value, cached=discovery.cached, errors=discovery.errors)
+        if not outcome:
+            result["error"] = outcome.error
+            return result
+        result["status"] = outcome.status
+        return _finish(helper, args, result)
+    url = discovery.discover(args.fresh)
+    result.update(ok=url is not None, url=url, cached=discovery.cached, errors=discovery.errors)
+    if url is None:
+        from res import WPAD_ERR
+        result["error"] = WPAD_ERR
+    return result
+
+
+def cmd_probe(args: argparse.Namespace) -> dict:
+    from mirrors import MirrorSet
+    mirrors = MirrorSet(args.url)
+    probes = mirrors.probe(fresh=True)
+    ranked = mirrors.rank(probes)
+    return {
+        "ok": bool(ranked),
+        "fastest": ranked[0].url if ranked else None,
+        "probes": [p.to_dict() for p in probes],
+        "invalid": mirrors.invalid,
+    }
+
+
+def cmd_restore(args: argparse.Namespace) -> dict:
+    helper = _helper(args, recover=True)
+    if args.all_users:
+        return _all_users(helper, args, "Proxy configuration disabled", "restore_defaults")
+    if args.version is not None:
+        result = helper.restore_backup(args.version)
+    else:
+        result = helper.restore_defaults()
+    if not result:
+        return {"ok": False, "error": result.error}
+    return _finish(helper, args, {"ok": True, "status": result.status})
+
+
+def cmd_profile(args: argparse.Namespace) -> dict:
+    helper = _helper(args, recover=args.action == "switch")
+    if args.action == "list":
+        profiles = helper.profiles()
+        return {
+            "ok": True,
+            "active": helper.active_profile(),
+            "profiles": [dict(profiles.get(n).to_dict(), name=n) for n in profiles.names()],
+        }
+    if args.action == "add":
+        from res import INVALID_URL
+        from util import validate_pac_url
+        from profiles import Profile
+        if args.pac and not validate_pac_url(args.pac):
+            return {"ok": False, "error": INVALID_URL}
+        try:
+            profile = Profile(args.name, args.pac or "", args.proxy or "")
+        except ValueError as e:
+            return {"ok": False, "error": str(e)}
+        result = helper.save_profile(profile)
+    elif args.action == "remove":
+        result = helper.remove_profile(args.name)
+    else:
+        result = helper.switch_profile(args.name)
+    if not result:
+        return {"ok": False, "error": result.error}
+    return _finish(helper, args, {"ok": True, "status": result.status})
+
+
+def cmd_status(args: argparse.Namespace) -> dict:
+    from reg import IEWindowsRegEditor
+    from codec import ConnectionSettings
+    helper = _helper(args)
+    with helper.editor() as net:
+        settings = ConnectionSettings.decode(net.read_default_connection_settings())
+        url = helper.read_pac_link()
+    latest = helper.store().latest()
+    script = IEWindowsRegEditor.AUTO_CONFIG_SCRIPT
+    return {
+        "ok": True,
+        "pac_url": url,
+        "flags": settings.flags,
+        "auto_config_script": settings.flags & script == script,
+        "proxy_server": settings.proxy_server.decode(ConnectionSettings.ENCODING),
+        "manual_proxy": bool(settings.flags & ConnectionSettings.PROXY),
+        "bypass_entries": len(settings.bypass_entries()),
+        "counter": settings.counter,
+        "latest_backup": latest["version"] if latest else None,
+    }
+
+
+def _read_entries(args: argparse.Namespace) -> list:
+    entries = list(args.entries)
+    if args.file:
+        with open(args.file, "r") as f:
+            entries.extend(line.strip() for line in f)
+    return [e for e in entries if e]
+
+
+def cmd_proxy(args: argparse.Namespace) -> dict:
+    helper = _helper(args, recover=True)
+    bypass = _read_entries(args) if args.entries or args.file else None
+    result = helper.set_proxy_server("" if args.off else args.server, bypass)
+    if not result:
+        return {"ok": False, "error": result.error}
+    return _finish(helper, args, {"ok": True, "status": result.status})
+
+
+def cmd_bypass(args: argparse.Namespace) -> dict:
+    from codec import ConnectionSettings
+    helper = _helper(args, recover=args.action != "list")
+    if args.action == "list":
+        with helper.editor() as net:
+            settings = ConnectionSettings.decode(net.read_default_connection_settings())
+        return {"ok": True, "entries": settings.bypass_entries()}
+    entries = _read_entries(args)
+    if args.action == "add":
+        result = helper.edit_bypass(add=entries)
+    elif args.action == "remove":
+        result = helper.edit_bypass(remove=entries)
+    else:
+        result = helper.edit_bypass(replace=entries)
+    if not result:
+        return {"ok": False, "error": result.error}
+    return _finish(helper, args, {"ok": True, "status": result.status, "entries": result.value})
+
+
+def cmd_backup(args: argparse.Namespace) -> dict:
+    # A backup taken over an interrupted change would restore it half done
+    helper = _helper(args, recover=not args.list)
+    if args.list:
+        versions = [{"version": e["version"], "time": e["time"]} for e in helper.store().versions()]
+        return {"ok": True, "versions": versions}
+    result = helper.backup()
+    if not result:
+        return {"ok": False, "error": result.error}
+    return _finish(helper, args, {"ok": True, "status": result.status, "version": result.value})
+
+
+def cmd_history(args: argparse.Namespace) -> dict:
+    from util import history
+    records, _ = history().tail(args.count)
+    return {
+        "ok": True,
+        "records": [{"time": r.timestamp, "kind": r.kind, "message": r.message} for r in records],
+    }
+
+
+def cmd_watch(args: argparse.Namespace) -> dict:
+    from drift import DriftMonitor, RegistrySource
+    from util import history_log, history
+    helper = _helper(args, recover=bool(args.reapply))
+    reapply = helper.install_pac_file if args.reapply else None
+    monitor = DriftMonitor(RegistrySource(helper.backend), args.reapply, reapply, history_log,
+                           args.interval, args.max_interval)
+
+    def report(drifts: list) -> None:
+        for drift in drifts:
+            json.dump(drift.to_dict(), sys.stdout)
+            sys.stdout.write("\n")
+        sys.stdout.flush()
+        if args.registry and reapply:
+            helper.backend.save()
+
+    try:
+        monitor.run(report)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.source.close()
+        history().close()
+    return {"ok": True, "polls": monitor.polls, "decodes": monitor.decodes, "reapplies": monitor.reapplies}
+
+
+def cmd_inspect(args: argparse.Namespace) -> dict:
+    import corpus
+    report = corpus.inspect(args.path, args.workers)
+    return dict(report.to_dict(args.top), ok=True)
+
+
+def cmd_diff(args: argparse.Namespace) -> dict:
+    import corpus
+    from util import hex_dump
+    with open(args.a, "rb") as a, open(args.b, "rb") as b:
+        left, right = a.read(), b.read()
+    result = dict(corpus.diff(left, right), ok=True)
+    if args.dump:
+        result["dump"] = {"a": list(hex_dump(left)), "b": list(hex_dump(right))}
+    return result
+
+
+def cmd_metrics(args: argparse.Namespace) -> dict:
+    from res import METRICS_FILE
+    from metrics import Metrics
+    path = args.metrics or METRICS_FILE
+    if args.reset:
+        if os.path.exists(path):
+            os.remove(path)
+        return {"ok": True, "status": "Metrics cleared"}
+    try:
+        stored = Metrics.load(path)
+    except (OSError, ValueError):
+        stored = Metrics()
+    if args.prometheus:
+        stored.write_prometheus(args.prometheus)
+    snapshot = stored.snapshot()
+    return {"ok": True, "operations": snapshot["operations"], "counters": snapshot["counters"]}
+
+
+def _save_metrics(args: argparse.Namespace) -> None:
+    from metrics import METRICS
+    if args.metrics and (METRICS.recorded() or METRICS.counters):
+        try:
+            METRICS.save(args.metrics)
+        except OSError:
+            pass
+
+
+def cmd_gui(args: argparse.Namespace) -> None:
+    from app import App
+    from gui import IPSXFrame
+    # init() first: the frame starts background jobs that use the backup path
+    App.init().register(IPSXFrame).run()
+
+
+def parser() -> argparse.ArgumentParser:
+    from res import HIVE_WORKERS
+    cli = argparse.ArgumentParser(prog="ipsx", description="IP.SX proxy auto config helper")
+    cli.add_argument("--registry", help="JSON registry file to use instead of the Windows registry")
+    cli.add_argument("--backups", help="Backup store directory")
+    cli.add_argument("--metrics", help="File that accumulates timing metrics; none are kept without it")
+    cli.add_argument("--profile", choices=("sample", "ops", "all"),
+                     help="Profile the run: sample all threads, trace each operation, or both")
+    cli.add_argument("--profile-dir", help="Where to write the profiles (default: profile)")
+    commands = cli.add_subparsers(dest="command")
+
+    install = commands.add_parser("install", help="Install a PAC file URL, or the fastest of several mirrors")
+    install.add_argument("url", nargs="+")
+    install.add_argument("--check", action="store_true", help="Resolve the host and download the PAC file first")
+    install.add_argument("--all-users", action="store_true", help="Apply to every loaded user hive")
+    install.add_argument("--workers", type=int, default=HIVE_WORKERS, help="Hives handled at once")
+    install.set_defaults(func=cmd_install)
+
+    discover = commands.add_parser("discover", help="Find the network's PAC file by WPAD")
+    discover.add_argument("--install", action="store_true", help="Install the URL found")
+    discover.add_argument("--fresh", action="store_true", help="Probe even if this network is known")
+    discover.add_argument("--domain", action="append", help="Search suffix to use (default: the system's)")
+    discover.add_argument("--gateway", help="Default gateway identifying the network (default: the system's)")
+    discover.add_argument("--timeout", type=float, default=3.0, help="Seconds per probe")
+    discover.set_defaults(func=cmd_discover)
+
+    probe = commands.add_parser("probe", help="Check PAC file mirrors and rank them by latency")
+    probe.add_argument("url", nargs="+")
+    probe.set_defaults(func=cmd_probe)
+
+    restore = commands.add_parser("restore", help="Disable the PAC file or restore a backup")
+    which = restore.add_mutually_exclusive_group()
+    which.add_argument("--version", type=int, help="Backup version to restore")
+    which.add_argument("--all-users", action="store_true", help="Disable the PAC file in every loaded user hive")
+    restore.add_argument("--workers", type=int, default=HIVE_WORKERS, help="Hives handled at once")
+    restore.set_defaults(func=cmd_restore)
+
+    profile = commands.add_parser("profile", help="Manage and switch named profiles")
+    actions = profile.add_subparsers(dest="action")
+    actions.required = True
+    actions.add_parser("list", help="List the profiles and the active one")
+    add = actions.add_parser("add", help="Create or replace a profile (direct when neither option is given)")
+    add.add_argument("name")
+    kind = add.add_mutually_exclusive_group()
+    kind.add_argument("--pac", metavar="URL", help="PAC file URL")
+    kind.add_argument("--proxy", metavar="HOST:PORT", help="Manual proxy server")
+    remove = actions.add_parser("remove", help="Delete a profile")
+    remove.add_argument("name")
+    use = actions.add_parser("use", help="Switch to a profile")
+    use.add_argument("name")
+    profile.set_defaults(func=cmd_profile)
+
+    proxy = commands.add_parser("proxy", help="Set the manual proxy server, alongside any PAC file")
+    server = proxy.add_mutually_exclusive_group(required=True)
+    server.add_argument("server", nargs="?", metavar="HOST:PORT")
+    server.add_argument("--off", action="store_true", help="Disable the manual proxy")
+    proxy.add_argument("--bypass", dest="entries", nargs="*", default=[], metavar="HOST",
+                       help="Replace the bypass list with these entries")
+    proxy.add_argument("--bypass-file", dest="file", help="Replace the bypass list with entries read, one per line")
+    proxy.set_defaults(func=cmd_proxy)
+
+    bypass = commands.add_parser("bypass", help="Edit the proxy bypass list")
+    bypass.add_argument("action", choices=("list", "add", "remove", "set"))
+    bypass.add_argument("entries", nargs="*", metavar="HOST")
+    bypass.add_argument("--file", help="Also read entries from this file, one per line")
+    bypass.set_defaults(func=cmd_bypass)
+
+    users = commands.add_parser("users", help="List the user hives loaded under HKEY_USERS")
+    users.set_defaults(func=cmd_users)
+
+    status = commands.add_parser("status", help="Show the current configuration")
+    status.set_defaults(func=cmd_status)
+
+    backup = commands.add_parser("backup", help="Back up the current configuration")
+    backup.add_argument("--list", action="store_true", help="List the stored versions")
+    backup.set_defaults(func=cmd_backup)
+
+    history = commands.add_parser("history", help="Show the latest history entries")
+    history.add_argument("--count", type=int, default=20)
+    history.set_defaults(func=cmd_history)
+
+    watch = commands.add_parser("watch", help="Report settings rewritten by other software")
+    watch.add_argument("--reapply", metavar="URL", help="Re-install this PAC URL when it drifts away")
+    watch.add_argument("--interval", type=float, default=2.0, help="Shortest polling interval in seconds")
+    watch.add_argument("--max-interval", type=float, default=60.0, help="Longest polling interval in seconds")
+    watch.set_defaults(func=cmd_watch)
+
+    inspect = commands.add_parser("inspect", help="Summarize a directory or archive of captured settings blobs")
+    inspect.add_argument("path")
+    inspect.add_argument("--workers", type=int, help="Worker processes (default: one per CPU)")
+    inspect.add_argument("--top", type=int, default=5, help="Most common values shown per field")
+    inspect.set_defaults(func=cmd_inspect)
+
+    diff = commands.add_parser("diff", help="Compare two captured settings blobs field by field")
+    diff.add_argument("a")
+    diff.add_argument("b")
+    diff.add_argument("--dump", action="store_true", help="Include hex dumps of both blobs")
+    diff.set_defaults(func=cmd_diff)
+
+    metrics = commands.add_parser("metrics", help="Show p50/p99 per operation over the recorded runs")
+    metrics.add_argument("--prometheus", metavar="FILE", help="Also write them in Prometheus text format")
+    metrics.add_argument("--reset", action="store_true", help="Forget the recorded numbers")
+    metrics.set_defaults(func=cmd_metrics)
+
+    gui = commands.add_parser("gui", help="Start the graphical interface (default)")
+    gui.set_defaults(func=cmd_gui)
+    return cli
+
+
+def _profiler(args: argparse.Namespace) -> "Profiler":
+    from res import PROFILE_ENV
+    # profiling is not even imported unless asked for
+    if not args.profile and not os.environ.get(PROFILE_ENV):
+        return None
+    from profiling import Profiler
+    profiler = Profiler.from_env(args.profile, args.profile_dir)
+    return profiler.start() if profiler is not None else None
+
+
+def main(argv: list=None) -> int:
+    args = parser().parse_args(argv)
+    profiler = _profiler(args)
+    try:
+        return run(args)
+    finally:
+        if profiler is not None:
+            paths = profiler.stop()
+            sys.stderr.write("Profile written to {}\n".format(os.path.dirname(paths[-1])))
+
+
+def run(args: argparse.Namespace) -> int:
+    if args.command in (None, "gui"):
+        cmd_gui(args)
+        return 0
+    try:
+        result = args.func(args)
+    except Exception as e:
+        result = {"ok": False, "error": str(e)}
+    if args.command != "metrics":
+        _save_metrics(args)
+    json.dump(result, sys.stdout)
+    sys.stdout.write("\n")
+    return 0 if result.get("ok") else 1
 
 
 if __name__ == "__main__":
-    App.register(IPSXFrame).init().run()
+    sys.exit(main())
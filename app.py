@@ -27,16 +27,25 @@ from proxy import ProxyHelper
 
 class App(object):
 
-    __INSTANCE = wx.App(True, "debug")
+    __INSTANCE = None
+
+    @classmethod
+    def instance(cls) -> wx.App:
+        # Created on first use: importing this module must not connect to
+        # the display
+        if cls.__INSTANCE is None:
+            cls.__INSTANCE = wx.App(True, "debug")
+        return cls.__INSTANCE
 
     @classmethod
     def register(cls, panel: wx.Panel) -> "App":
+        cls.instance()
         panel()
         return cls
 
     @classmethod
     def run(cls):
-        cls.__INSTANCE.MainLoop()
+        cls.instance().MainLoop()
 
     @classmethod
     def init(cls) -> "App":
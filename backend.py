@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import abc
+import json
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+from metrics import METRICS
+
+
+# Values match the ones exported by the winreg module, so both backends
+# (and the constants stored in IEWindowsRegEditor) are interchangeable.
+HKEY_CURRENT_USER = 0x80000001
+HKEY_LOCAL_MACHINE = 0x80000002
+HKEY_USERS = 0x80000003
+KEY_ALL_ACCESS = 0xf003f
+KEY_READ = 0x20019
+REG_SZ = 1
+REG_BINARY = 3
+
+
+class RegistryBackend(abc.ABC):
+    """
+    Minimal registry interface used by IEWindowsRegEditor.
+
+    Handles returned by open_key are opaque; they must be released with
+    close_key. Missing keys or values raise FileNotFoundError, like winreg.
+    Every method is abstract, so an incomplete backend fails when it is
+    instantiated rather than on its first call.
+    """
+
+    @abc.abstractmethod
+    def open_key(self, root: int, path: str, access: int=KEY_ALL_ACCESS) -> Any:
+        pass
+
+    @abc.abstractmethod
+    def close_key(self, handle: Any) -> None:
+        pass
+
+    @abc.abstractmethod
+    def query_value(self, handle: Any, name: str) -> Tuple[Any, int]:
+        pass
+
+    @abc.abstractmethod
+    def set_value(self, handle: Any, name: str, kind: int, value: Any) -> None:
+        pass
+
+    @abc.abstractmethod
+    def delete_value(self, handle: Any, name: str) -> None:
+        pass
+
+    @abc.abstractmethod
+    def enum_keys(self, root: int, path: str) -> List[str]:
+        pass
+
+
+class WinRegBackend(RegistryBackend):
+    """
+    Backend for the live Windows registry.
+    """
+
+    def __init__(self):
+        import winreg
+        self.winreg = winreg
+
+    def open_key(self, root: int, path: str, access: int=KEY_ALL_ACCESS) -> Any:
+        return self.winreg.OpenKey(root, path, 0, access)
+
+    def close_key(self, handle: Any) -> None:
+        self.winreg.CloseKey(handle)
+
+    def query_value(self, handle: Any, name: str) -> Tuple[Any, int]:
+        return self.winreg.QueryValueEx(handle, name)
+
+    def set_value(self, handle: Any, name: str, kind: int, value: Any) -> None:
+        self.winreg.SetValueEx(handle, name, 0, kind, value)
+
+    def delete_value(self, handle: Any, name: str) -> None:
+        self.winreg.DeleteValue(handle, name)
+
+    def enum_keys(self, root: int, path: str) -> List[str]:
+        names = []
+        with self.winreg.OpenKey(root, path, 0, KEY_READ) as handle:
+            while True:
+                try:
+                    names.append(self.winreg.EnumKey(handle, len(names)))
+                except OSError:
+                    return names
+
+
+class MemoryKey(object):
+
+    __slots__ = ("path", "closed")
+
+    def __init__(self, path: Tuple[int, str]):
+        self.path = path
+        self.closed = False
+
+
+class MemoryBackend(RegistryBackend):
+    """
+    In-memory stand-in for the registry, usable on any platform.
+
+    Keys are matched case-insensitively, like on Windows. ``opened`` counts
+    the key opens, ``live`` the handles not closed yet and ``writes`` the
+    values set.
+    """
+
+    def __init__(self, keys: Dict[Tuple[int, str], Dict[str, Tuple[Any, int]]]=None):
+        self.keys = {}
+        self.opened = 0
+        self.live = 0
+        self.writes = 0
+        for (root, path), values in (keys or {}).items():
+            self.create_key(root, path).update(values)
+
+    @staticmethod
+    def normalize(root: int, path: str) -> Tuple[int, str]:
+        return root, path.strip("\\").lower()
+
+    def create_key(self, root: int, path: str) -> Dict[str, Tuple[Any, int]]:
+        return self.keys.setdefault(self.normalize(root, path), {})
+
+    def open_key(self, root: int, path: str, access: int=KEY_ALL_ACCESS) -> MemoryKey:
+        key = self.normalize(root, path)
+        if key not in self.keys:
+            raise FileNotFoundError(path)
+        self.opened += 1
+        self.live += 1
+        return MemoryKey(key)
+
+    def close_key(self, handle: MemoryKey) -> None:
+        if not handle.closed:
+            handle.closed = True
+            self.live -= 1
+
+    def _values(self, handle: MemoryKey) -> Dict[str, Tuple[Any, int]]:
+        if handle.closed:
+            raise OSError("Handle is closed")
+        return self.keys[handle.path]
+
+    def query_value(self, handle: MemoryKey, name: str) -> Tuple[Any, int]:
+        values = self._values(handle)
+        if name not in values:
+            raise FileNotFoundError(name)
+        return values[name]
+
+    def set_value(self, handle: MemoryKey, name: str, kind: int, value: Any) -> None:
+        self._values(handle)[name] = (value, kind)
+        self.writes += 1
+
+    def delete_value(self, handle: MemoryKey, name: str) -> None:
+        values = self._values(handle)
+        if name not in values:
+            raise FileNotFoundError(name)
+        del values[name]
+        self.writes += 1
+
+    def enum_keys(self, root: int, path: str) -> List[str]:
+        _, prefix = self.normalize(root, path)
+        prefix = prefix + "\\" if prefix else ""
+        names = []
+        for key_root, key_path in self.keys:
+            if key_root == root and key_path.startswith(prefix):
+                name = key_path[len(prefix):].split("\\", 1)[0]
+                if name and name not in names:
+                    names.append(name)
+        return names
+
+
+class LockedBackend(MemoryBackend):
+    """
+    MemoryBackend whose calls run one at a time under a lock, so threads can
+    share it like they share winreg (e.g. the workers of MultiUserApply),
+    and the counters stay exact.
+    """
+
+    def __init__(self, keys: Dict[Tuple[int, str], Dict[str, Tuple[Any, int]]]=None):
+        MemoryBackend.__init__(self, keys)
+        self.lock = threading.Lock()
+
+    def _call(self, method, *args):
+        with self.lock:
+            return method(self, *args)
+
+    def open_key(self, root: int, path: str, access: int=KEY_ALL_ACCESS) -> MemoryKey:
+        return self._call(MemoryBackend.open_key, root, path, access)
+
+    def close_key(self, handle: MemoryKey) -> None:
+        self._call(MemoryBackend.close_key, handle)
+
+    def query_value(self, handle: MemoryKey, name: str) -> Tuple[Any, int]:
+        return self._call(MemoryBackend.query_value, handle, name)
+
+    def set_value(self, handle: MemoryKey, name: str, kind: int, value: Any) -> None:
+        self._call(MemoryBackend.set_value, handle, name, kind, value)
+
+    def delete_value(self, handle: MemoryKey, name: str) -> None:
+        self._call(MemoryBackend.delete_value, handle, name)
+
+    def enum_keys(self, root: int, path: str) -> List[str]:
+        return self._call(MemoryBackend.enum_keys, root, path)
+
+
+class HivesBackend(LockedBackend):
+    """
+    LockedBackend with user hives loaded under HKEY_USERS, to run multi-user
+    operations on any platform. Every call first sleeps ``latency`` seconds,
+    like a round trip to the registry.
+    """
+
+    def __init__(self, latency: float=0.0):
+        LockedBackend.__init__(self)
+        self.latency = latency
+
+    def add_hive(self, sid: str, keys: Dict[str, Dict[str, Tuple[Any, int]]]) -> None:
+        """
+        Loads a hive: ``keys`` maps paths relative to the hive root to their
+        values, and is copied.
+        """
+        for path, values in keys.items():
+            self.create_key(HKEY_USERS, sid + "\\" + path).update(values)
+
+    def _call(self, method, *args):
+        if self.latency:
+            time.sleep(self.latency)
+        return LockedBackend._call(self, method, *args)
+
+
+class FileBackend(LockedBackend):
+    """
+    LockedBackend persisted as JSON; binary values are stored hex encoded.
+    Changes are written back by save().
+    """
+
+    def __init__(self, filepath: str):
+        LockedBackend.__init__(self)
+        self.filepath = filepath
+        try:
+            with open(filepath, "r") as file_:
+                data = json.load(file_)
+        except FileNotFoundError:
+            data = []
+        for root, path, values in data:
+            key = self.create_key(root, path)
+            for name, (value, kind) in values.items():
+                key[name] = (bytes.fromhex(value) if kind == REG_BINARY else value, kind)
+
+    def save(self) -> None:
+        data = []
+        with self.lock:
+            for (root, path), values in self.keys.items():
+                data.append([root, path, {
+                    name: (value.hex() if kind == REG_BINARY else value, kind)
+                    for name, (value, kind) in values.items()
+                }])
+        with open(self.filepath, "w") as file_:
+            json.dump(data, file_)
+
+
+class KeyCache(object):
+    """
+    Cache of open key handles for one backend.
+
+    Handles are reused for at most ``ttl`` seconds and at most ``size`` of
+    them are kept open; evicted and expired handles are closed right away.
+    close() (or leaving the ``with`` block) closes every cached handle.
+    """
+
+    def __init__(self, backend: RegistryBackend, ttl: float=5.0, size: int=8):
+        self.backend = backend
+        self.ttl = ttl
+        self.size = size
+        self.handles = OrderedDict()
+
+    def get(self, root: int, path: str, access: int=KEY_ALL_ACCESS) -> Any:
+        key = (root, path, access)
+        now = time.monotonic()
+        entry = self.handles.pop(key, None)
+        if entry is not None:
+            handle, opened_at = entry
+            if now - opened_at < self.ttl:
+                self.handles[key] = entry
+                return handle
+            self.backend.close_key(handle)
+        with METRICS.span("registry.open_key"):
+            handle = self.backend.open_key(root, path, access)
+        METRICS.count("registry.key_opens")
+        self.handles[key] = (handle, now)
+        while len(self.handles) > self.size:
+            _, (stale, _) = self.handles.popitem(last=False)
+            self.backend.close_key(stale)
+        return handle
+
+    def close(self) -> None:
+        while self.handles:
+            _, (handle, _) = self.handles.popitem()
+            self.backend.close_key(handle)
+
+    def __enter__(self) -> "KeyCache":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import json
+import zlib
+import hashlib
+import datetime
+
+from typing import Any, Dict, List, Tuple, Union
+from codec import ConnectionSettings
+
+
+def read_legacy(path: str) -> Tuple[bytes, bytes]:
+    """
+    Reads a backup file written before the store existed: the
+    DefaultConnectionSettings blob followed by the SavedLegacySettings one,
+    or a single blob when both were equal.
+
+    Returns:
+        tuple - (DefaultConnectionSettings, SavedLegacySettings).
+
+    Raises:
+        ValueError - If the file does not hold a settings blob.
+    """
+    with open(path, "rb") as file_:
+        data = file_.read()
+    half = len(data) // 2
+    if data[:half] == data[half:]:
+        return data[:half], data[half:]
+    # The second blob starts after the first one's URL segment, with the
+    # same header; the first trailer is whatever lies in between
+    start = len(data) - len(ConnectionSettings.fields(data)[-1])
+    pos = data.find(data[:4], start)
+    while pos != -1:
+        try:
+            ConnectionSettings.fields(data[pos:])
+        except ValueError:
+            pos = data.find(data[:4], pos + 1)
+            continue
+        return data[:pos], data[pos:]
+    return data, data
+
+
+class BackupStore(object):
+    """
+    Versioned, content-addressed store for registry snapshots.
+
+    Every value is kept once as a zlib-compressed object named after the
+    SHA-256 of its bytes (``objects/ab/abcd...``); a snapshot is a manifest
+    entry mapping value names to (digest, kind). Identical values share an
+    object and a snapshot equal to the latest one is not recorded again.
+    Only the ``max_versions`` latest snapshots are kept; objects no longer
+    referenced are removed.
+    """
+
+    MANIFEST = "manifest.json"
+    BINARY, STRING = "binary", "string"
+
+    def __init__(self, directory: str, max_versions: int=50):
+        self.directory = directory
+        self.max_versions = max_versions
+        self.objects = os.path.join(directory, "objects")
+        self.manifest = self._read_manifest()
+
+    def _read_manifest(self) -> List[Dict[str, Any]]:
+        try:
+            with open(os.path.join(self.directory, self.MANIFEST), "r") as file_:
+                return json.load(file_)
+        except (OSError, ValueError):
+            return []
+
+    def _write_manifest(self) -> None:
+        path = os.path.join(self.directory, self.MANIFEST)
+        with open(path + ".tmp", "w") as file_:
+            json.dump(self.manifest, file_, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def put_object(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as file_:
+                file_.write(zlib.compress(data, 9))
+            os.replace(path + ".tmp", path)
+        return digest
+
+    def get_object(self, digest: str) -> bytes:
+        """
+        Raises:
+            ValueError - If the object is corrupted.
+        """
+        with open(self.object_path(digest), "rb") as file_:
+            data = zlib.decompress(file_.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError("Corrupted backup object {}".format(digest))
+        return data
+
+    def snapshot(self, values: Dict[str, Union[bytes, str]]) -> int:
+        """
+        Records a snapshot.
+
+        Returns:
+            int - Its version number (the latest one if nothing changed).
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        entries = {}
+        for name, value in values.items():
+            if isinstance(value, str):
+                entries[name] = [self.put_object(value.encode("utf-8")), self.STRING]
+            else:
+                entries[name] = [self.put_object(bytes(value)), self.BINARY]
+        latest = self.latest()
+        if latest is not None and latest["values"] == entries:
+            return latest["version"]
+        version = latest["version"] + 1 if latest is not None else 1
+        self.manifest.append({
+            "version": version,
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "values": entries,
+        })
+        self.prune()
+        self._write_manifest()
+        return version
+
+    def versions(self) -> List[Dict[str, Any]]:
+        return list(self.manifest)
+
+    def latest(self) -> Dict[str, Any]:
+        return self.manifest[-1] if self.manifest else None
+
+    def entry(self, version: int=None) -> Dict[str, Any]:
+        """
+        Raises:
+            KeyError - If the version is unknown.
+        """
+        if not self.manifest:
+            raise KeyError("No backup available")
+        if version is None:
+            return self.manifest[-1]
+        # Versions are consecutive, so the entry is found by position
+        index = version - self.manifest[0]["version"]
+        if 0 <= index < len(self.manifest) and self.manifest[index]["version"] == version:
+            return self.manifest[index]
+        raise KeyError("Unknown backup version {}".format(version))
+
+    def load(self, version: int=None) -> Dict[str, Union[bytes, str]]:
+        """
+        Returns:
+            dict - The values of a snapshot (the latest by default).
+        """
+        values = {}
+        for name, (digest, kind) in self.entry(version)["values"].items():
+            data = self.get_object(digest)
+            values[name] = data.decode("utf-8") if kind == self.STRING else data
+        return values
+
+    def prune(self) -> None:
+        if len(self.manifest) <= self.max_versions:
+            return
+        dropped = self.manifest[:-self.max_versions]
+        self.manifest = self.manifest[-self.max_versions:]
+        live = {d for e in self.manifest for d, _ in e["values"].values()}
+        for entry in dropped:
+            for digest, _ in entry["values"].values():
+                if digest not in live:
+                    try:
+                        os.remove(self.object_path(digest))
+                    except OSError:
+                        pass
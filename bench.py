@@ -0,0 +1,772 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Micro-benchmarks for the hot paths, run on any platform against a fake
+registry.
+
+    python bench.py                         run everything
+    python bench.py core                    only the registry/backup/history paths
+    python bench.py alter_bin_reg history   selected benchmarks
+    python bench.py core --save base.json   store a baseline
+    python bench.py core --compare base.json --threshold 10
+                                            fail when a result regressed by
+                                            more than 10% against the baseline
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import platform
+import asyncio
+import subprocess
+import threading
+import struct
+import timeit
+import tempfile
+
+from collections import OrderedDict
+from codec import ConnectionSettings
+from backend import MemoryBackend, FileBackend, HivesBackend, HKEY_CURRENT_USER, REG_SZ, REG_BINARY
+from reg import IEWindowsRegEditor
+from proxy import ProxyHelper
+from hives import MultiUserApply
+from pac import PacEngine, PacHelpers, PacScript, DecisionCache
+from dnscache import DnsCache, StubResolver
+from pacindex import PacIndex, IndexedPacEngine
+from pacserver import PacServer
+from fwdproxy import ForwardingProxy
+from history import HistoryLog
+from metrics import METRICS, Histogram, timed
+from util import FileWriter, validate_pac_url
+import util
+
+
+AUTO_DETECT_SETTINGS = 0x09
+AUTO_CONFIG_SCRIPT = 0x05
+
+
+def legacy_alter_bin_reg(enable: bool, bytes_in: bytes, data: str="") -> bytes:
+    """
+    The list-based implementation IEWindowsRegEditor.alter_bin_reg used
+    before the codec, kept verbatim as the benchmark baseline.
+    """
+    byte_list = list(bytes_in)
+    cfg = AUTO_DETECT_SETTINGS
+    data_length = len(data.strip())
+    if enable:
+        cfg |= AUTO_CONFIG_SCRIPT
+    byte_list[8:12] = [cfg, 0x0, 0x0, 0x0]
+    x_size = byte_list[16:20]
+    x_len = struct.unpack("@i", bytes(x_size))[0]
+    data_len_start = 20 + x_len
+    data_len_end = data_len_start + 4
+    b_size = byte_list[data_len_start:data_len_end]
+    data_len = struct.unpack("@i", bytes(b_size))[0]
+    byte_list[data_len_start:data_len_end] = list(struct.pack("@i", data_length))
+    del byte_list[data_len_end:data_len_end + data_len]
+    chars = [ord(c) for c in data]
+    enc = "@" + ("B" * data_length)
+    byte_list[data_len_end:data_len_end] = struct.pack(enc, *chars)
+    return bytes(byte_list)
+
+
+def sample_blob(bypass_len: int=64, url_len: int=48, trailer_len: int=32) -> bytes:
+    """
+    Builds a synthetic DefaultConnectionSettings blob.
+    """
+    url = ("http://pac.example/" + "a" * url_len)[:url_len]
+    return ConnectionSettings(
+        counter=7,
+        bypass_list=b"<local>" * (bypass_len // 7),
+        auto_config_url=url.encode(),
+        trailer=b"\x00" * trailer_len,
+    ).encode()
+
+
+def per_op(fn, number: int, rounds: int=5) -> float:
+    """
+    Microseconds per call of ``fn``: the best of ``rounds`` timings of
+    ``number // rounds`` calls, which filters out scheduler noise.
+    """
+    count = max(1, number // rounds)
+    return min(timeit.repeat(fn, number=count, repeat=rounds)) / count * 1e6
+
+
+def bench_alter_bin_reg(number: int=20000) -> dict:
+    """
+    alter_bin_reg for URL lengths x blob sizes (the bypass list makes up
+    most of a large blob); the legacy per-byte version only runs on the
+    smaller blobs.
+    """
+    results = {}
+    for url_len in (16, 128, 1024):
+        url = "http://pac.example/" + "p" * url_len + ".pac"
+        for blob_len in (64, 1024, 16384):
+            blob = sample_blob(bypass_len=blob_len, url_len=url_len)
+            assert legacy_alter_bin_reg(True, blob, url) == IEWindowsRegEditor.alter_bin_reg(True, blob, url)
+            variants = [("codec", IEWindowsRegEditor.alter_bin_reg, number)]
+            if blob_len <= 1024:
+                variants.append(("legacy", legacy_alter_bin_reg, number // 10))
+            for name, fn, count in variants:
+                key = "alter_bin_reg/{}/url{}/blob{}".format(name, url_len, blob_len)
+                results[key] = per_op(lambda: fn(True, blob, url), count)
+    return results
+
+
+def bench_validate_pac_url(number: int=100000) -> dict:
+    rnd = random.Random(17)
+    shapes = (
+        "http://pac{}.example/proxy.pac",
+        "https://mirror{}.example:8443/a/b/wpad.pac",
+        "ftp://pac{}.example/proxy.pac",
+        "http://pac{}.example/proxy.js",
+        "   ",
+        "http:///{}.pac",
+        "not a url {}",
+    )
+    urls = [rnd.choice(shapes).format(i) for i in range(number)]
+    assert 0 < sum(1 for url in urls if validate_pac_url(url)) < number
+    elapsed = min(timeit.repeat(lambda: [validate_pac_url(url) for url in urls], number=1, repeat=5))
+    return {"validate_pac_url": elapsed / number * 1e6}
+
+
+def bench_backup(number: int=500) -> dict:
+    """
+    FileWriter.binary_dump of a settings blob, and ProxyHelper.backup into
+    the versioned store, with unchanged and with changed settings.
+    """
+    directory = tempfile.mkdtemp()
+    blob = sample_blob(bypass_len=1024)
+    results = {}
+    saved = ProxyHelper.backend, ProxyHelper.backup_file, ProxyHelper.backup_store
+    try:
+        writer = FileWriter(os.path.join(directory, "dump.bin"))
+        results["backup/binary_dump"] = per_op(lambda: writer.flush().add(blob).binary_dump(), number)
+
+        ProxyHelper.backend = backend = fake_registry(blob)
+        ProxyHelper.backup_file = os.path.join(directory, "store")
+        ProxyHelper.backup_store = None
+        assert ProxyHelper.backup()
+        results["backup/store/unchanged"] = per_op(ProxyHelper.backup, number)
+
+        settings = ConnectionSettings.decode(blob)
+        with IEWindowsRegEditor(backend) as net:
+            def changed():
+                settings.counter += 1
+                net.write_default_connection_settings(settings.encode())
+                ProxyHelper.backup()
+            results["backup/store/changed"] = per_op(changed, number)
+    finally:
+        # Later benchmarks must not inherit the deleted temporary store
+        ProxyHelper.backend, ProxyHelper.backup_file, ProxyHelper.backup_store = saved
+        shutil.rmtree(directory)
+    return results
+
+
+def bench_history(records: int=200000, number: int=2000) -> dict:
+    """
+    history_log appends and history_init (the GUI's startup read) on a log
+    that already holds ``records`` entries.
+    """
+    directory = tempfile.mkdtemp()
+    log = HistoryLog(os.path.join(directory, "history"), max_bytes=1 << 30)
+    previous, util._HISTORY = util._HISTORY, log
+    results = {}
+    try:
+        start = timeit.default_timer()
+        for i in range(records):
+            log.append("Proxy configuration enabled on your system! #{}".format(i))
+        log.flush()
+        results["history/fill_per_record"] = (timeit.default_timer() - start) / records * 1e6
+        results["history/history_log"] = per_op(lambda: util.history_log("Proxy configuration disabled!"), number)
+        results["history/history_init"] = per_op(util.history_init, number // 10)
+        _, cursor = log.tail(100)
+        results["history/older_page"] = per_op(lambda: log.older(cursor, 100), number // 10)
+    finally:
+        log.close()
+        util._HISTORY = previous
+        shutil.rmtree(directory)
+    return results
+
+
+def fake_registry(blob: bytes=None, url: str="") -> MemoryBackend:
+    """
+    Builds an in-memory registry holding the Internet Settings keys.
+    """
+    blob = blob if blob is not None else sample_blob()
+    path = "\\".join(IEWindowsRegEditor.COMPLETE_REG_PATH)
+    return MemoryBackend({
+        (HKEY_CURRENT_USER, path.rsplit("\\", 1)[0]): {
+            IEWindowsRegEditor.AUTO_CONFIG_REGVAL: (url, REG_SZ),
+        },
+        (HKEY_CURRENT_USER, path): {
+            IEWindowsRegEditor.CONNECTION_SETTINGS: (blob, REG_BINARY),
+            IEWindowsRegEditor.LEGACY_SETTINGS: (blob, REG_BINARY),
+        },
+    })
+
+
+def bench_install_cycle(number: int=5000) -> dict:
+    ProxyHelper.backend = backend = fake_registry()
+    url = "http://pac.example/proxy.pac"
+
+    def cycle():
+        ProxyHelper.install_pac_file(url)
+        ProxyHelper.restore_defaults()
+
+    ProxyHelper.journal_file = os.path.join(tempfile.mkdtemp(), "apply.journal")
+    assert ProxyHelper.install_pac_file(url) and ProxyHelper.restore_defaults()
+    t = timeit.timeit(cycle, number=number)
+    assert backend.live == 0
+    opened = backend.opened
+
+    # Re-applying what is already installed only reads
+    ProxyHelper.install_pac_file(url)
+    writes = backend.writes
+    reapply = timeit.timeit(lambda: ProxyHelper.install_pac_file(url), number=number)
+    assert backend.writes == writes
+    return {
+        "install_cycle": t / number * 1e6,
+        "install_cycle/key_opens": opened / number,
+        "install_cycle/reapply": reapply / number * 1e6,
+    }
+
+
+SAMPLE_PAC = """
+function FindProxyForURL(url, host) {
+    if (isPlainHostName(host) || dnsDomainIs(host, ".corp.example"))
+        return "DIRECT";
+    if (shExpMatch(host, "*.cdn.example") || isInNet(host, "10.0.0.0", "255.0.0.0"))
+        return "PROXY cdn-proxy.example:8080";
+    return "PROXY proxy.example:8080; DIRECT";
+}
+"""
+
+
+def bench_pac_decisions(number: int=200000, hosts: int=1000) -> dict:
+    helpers = PacHelpers(resolver=lambda host: None)
+    urls = ["http://h{}.cdn.example/path".format(i % hosts) for i in range(number)]
+    results = {}
+    for name, cache in (("cached", DecisionCache()), ("uncached", None)):
+        engine = PacEngine.from_source(SAMPLE_PAC, helpers, cache=cache)
+        count = number if cache is not None else number // 10
+        start = timeit.default_timer()
+        for _ in engine.evaluate_many(urls[:count]):
+            pass
+        elapsed = timeit.default_timer() - start
+        results["pac_decision/{}".format(name)] = elapsed / count * 1e6
+        results["pac_decision/{}/decisions_per_sec".format(name)] = count / elapsed
+    return results
+
+
+DNS_PAC = """
+function FindProxyForURL(url, host) {
+    if (isInNet(host, "10.0.0.0", "255.0.0.0"))
+        return "DIRECT";
+    return "PROXY proxy.example:8080";
+}
+"""
+
+
+def bench_dns(number: int=50000, hosts: int=2000, delay: float=0.001) -> dict:
+    """
+    DnsCache.get over a skewed workload (a few hot names, a long tail, a
+    tenth of them unresolvable) against a stub resolver taking ``delay``
+    seconds: hit rate (%) and per-lookup p50/p99, compared to resolving every
+    time. Then PAC decisions of a script calling isInNet, without the
+    decision cache, with and without the DNS cache.
+    """
+    rnd = random.Random(22)
+    names = ["h{}.corp.example".format(i) for i in range(hosts)]
+    records = {name: "10.0.{}.{}".format(i // 256 % 256, i % 256) for i, name in enumerate(names) if i % 10}
+    workload = [names[min(int(rnd.paretovariate(1.2)) - 1, hosts - 1)] for _ in range(number)]
+    stub = StubResolver(records, delay)
+    cache = DnsCache(stub)
+    histogram = Histogram()
+    try:
+        for name in workload:
+            start = time.perf_counter_ns()
+            cache.get(name)
+            histogram.record((time.perf_counter_ns() - start) // 1000)
+        stats = cache.stats()
+        results = {
+            "dns/hit_rate": stats["hit_rate"] * 100,
+            "dns/queries": stub.queries,
+            "dns/get/p50_us": histogram.percentile(50),
+            "dns/get/p99_us": histogram.percentile(99),
+            "dns/get/mean_us": histogram.total / histogram.count,
+        }
+
+        def blocking(host):
+            time.sleep(delay)
+            return records.get(host)
+
+        results["dns/uncached/mean_us"] = per_op(lambda: blocking(workload[0]), 200)
+        urls = ["http://{}/".format(name) for name in workload[:2000]]
+        for label, resolver in (("dns_cache", cache.get), ("no_dns_cache", blocking)):
+            engine = PacEngine.from_source(DNS_PAC, PacHelpers(resolver=resolver), cache=None)
+            count = len(urls) if resolver is cache.get else len(urls) // 10
+            start = timeit.default_timer()
+            for _ in engine.evaluate_many(urls[:count]):
+                pass
+            results["pac_decision/isInNet/{}".format(label)] = (timeit.default_timer() - start) / count * 1e6
+    finally:
+        cache.close()
+    return results
+
+
+def large_pac(rules: int=10000) -> str:
+    """
+    Builds a PAC file with ``rules`` host rules of the common shapes.
+    """
+    lines = ["function FindProxyForURL(url, host) {", "    host = host.toLowerCase();"]
+    for i in range(rules):
+        kind = i % 4
+        if kind == 0:
+            cond = 'dnsDomainIs(host, ".site{}.example")'.format(i)
+        elif kind == 1:
+            cond = 'shExpMatch(host, "*.cdn{}.example")'.format(i)
+        elif kind == 2:
+            cond = 'shExpMatch(host, "host{}.example") || dnsDomainIs(host, "alt{}.example")'.format(i, i)
+        else:
+            cond = 'isInNet(host, "10.{}.{}.0", "255.255.255.0")'.format(i // 256 % 256, i % 256)
+        lines.append('    if ({}) return "PROXY p{}.example:8080";'.format(cond, i % 16))
+    lines.append('    return "DIRECT";')
+    lines.append("}")
+    return "\n".join(lines)
+
+
+def bench_pac_index(rules: int=10000, number: int=200) -> dict:
+    source = large_pac(rules)
+    script = PacScript(source, PacHelpers(resolver=lambda host: None))
+    hosts = ["www.site{}.example".format(i) for i in range(0, rules, 4 * (rules // number or 1))]
+    hosts = (hosts * (number // len(hosts) + 1))[:number]
+    urls = ["http://{}/".format(h) for h in hosts]
+    results = {}
+    start = timeit.default_timer()
+    index = PacIndex.compile(script)
+    results["pac_index/compile_ms"] = (timeit.default_timer() - start) * 1e3
+    index.save("bench_pac_index.json")
+    start = timeit.default_timer()
+    index = PacIndex.load("bench_pac_index.json", script)
+    results["pac_index/load_ms"] = (timeit.default_timer() - start) * 1e3
+    os.remove("bench_pac_index.json")
+    for name, engine in (("naive", PacEngine(script, cache=None)),
+                         ("indexed", IndexedPacEngine(script, index, cache=None))):
+        answers = [engine.evaluate(u) for u in urls[:10]]
+        assert answers == [script.find_proxy(u, h) for u, h in zip(urls[:10], hosts[:10])]
+        start = timeit.default_timer()
+        for url in urls:
+            engine.evaluate(url)
+        results["pac_index/{}/{}".format(name, rules)] = (timeit.default_timer() - start) / number * 1e6
+    return results
+
+
+async def _pac_client(port: int, requests: int, headers: bytes) -> int:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    request = b"GET /proxy.pac HTTP/1.1\r\nHost: localhost\r\n" + headers + b"\r\n"
+    done = 0
+    for _ in range(requests):
+        writer.write(request)
+        head = await reader.readuntil(b"\r\n\r\n")
+        length = int(head.split(b"Content-Length: ", 1)[1].split(b"\r\n", 1)[0])
+        await reader.readexactly(length)
+        done += 1
+    writer.close()
+    return done
+
+
+def bench_pac_server(clients: int=200, requests: int=50) -> dict:
+    """
+    Load test for PacServer: ``clients`` concurrent keep-alive connections
+    each issuing ``requests`` GETs, for each response variant.
+    """
+    results = {}
+    server = PacServer(SAMPLE_PAC.encode()).start_in_thread()
+    variants = (
+        ("plain", b""),
+        ("gzip", b"Accept-Encoding: gzip\r\n"),
+        ("not_modified", "If-None-Match: {}\r\n".format(server.responses.etag).encode()),
+    )
+
+    async def run(headers):
+        counts = await asyncio.gather(*(_pac_client(server.port, requests, headers)
+                                        for _ in range(clients)))
+        return sum(counts)
+
+    try:
+        for name, headers in variants:
+            start = timeit.default_timer()
+            total = asyncio.run(run(headers))
+            elapsed = timeit.default_timer() - start
+            results["pac_server/{}/requests_per_sec".format(name)] = total / elapsed
+    finally:
+        server.stop_thread()
+    return results
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class StandinUpstream(object):
+    """
+    Local origin answering every request with a fixed body, plus an echo
+    service for CONNECT tunnels, on a loop of their own.
+    """
+
+    def __init__(self, body: bytes=b"x" * 1024):
+        self.response = b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body) + body
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        async def start():
+            self.http = await asyncio.start_server(self.serve_http, "127.0.0.1", 0)
+            self.echo = await asyncio.start_server(self.serve_echo, "127.0.0.1", 0)
+
+        def run():
+            self.loop.run_until_complete(start())
+            ready.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        ready.wait()
+        self.http_port = self.http.sockets[0].getsockname()[1]
+        self.echo_port = self.echo.sockets[0].getsockname()[1]
+
+    async def serve_http(self, reader, writer):
+        try:
+            while True:
+                await reader.readuntil(b"\r\n\r\n")
+                writer.write(self.response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+    async def serve_echo(self, reader, writer):
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+async def _proxy_client(port: int, url: bytes, requests: int, latencies: list) -> None:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    request = b"GET " + url + b" HTTP/1.1\r\nHost: origin\r\n\r\n"
+    for _ in range(requests):
+        start = timeit.default_timer()
+        writer.write(request)
+        head = await reader.readuntil(b"\r\n\r\n")
+        length = int(head.lower().split(b"content-length: ", 1)[1].split(b"\r\n", 1)[0])
+        await reader.readexactly(length)
+        latencies.append(timeit.default_timer() - start)
+    writer.close()
+
+
+async def _tunnel_client(port: int, target: int, size: int) -> int:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"CONNECT 127.0.0.1:%d HTTP/1.1\r\n\r\n" % target)
+    await reader.readuntil(b"\r\n\r\n")
+    chunk = b"x" * 65536
+
+    async def send():
+        for _ in range(size // len(chunk)):
+            writer.write(chunk)
+            await writer.drain()
+        writer.write_eof()
+
+    sender = asyncio.ensure_future(send())
+    received = 0
+    while True:
+        data = await reader.read(1 << 20)
+        if not data:
+            break
+        received += len(data)
+    await sender
+    writer.close()
+    return received
+
+
+def bench_forward_proxy(clients: int=50, requests: int=100, tunnel_mb: int=64) -> dict:
+    upstream = StandinUpstream()
+    engine = PacEngine.from_source('function FindProxyForURL(url, host) { return "DIRECT"; }',
+                                   PacHelpers(resolver=lambda host: None))
+    proxy = ForwardingProxy(engine).start_in_thread()
+    url = b"http://127.0.0.1:%d/object" % upstream.http_port
+    latencies = []
+
+    async def run():
+        await asyncio.gather(*(_proxy_client(proxy.port, url, requests, latencies)
+                               for _ in range(clients)))
+
+    results = {}
+    try:
+        start = timeit.default_timer()
+        asyncio.run(run())
+        elapsed = timeit.default_timer() - start
+        results["forward_proxy/http/requests_per_sec"] = len(latencies) / elapsed
+        results["forward_proxy/http/p50"] = percentile(latencies, 50) * 1e6
+        results["forward_proxy/http/p99"] = percentile(latencies, 99) * 1e6
+        start = timeit.default_timer()
+        received = asyncio.run(_tunnel_client(proxy.port, upstream.echo_port, tunnel_mb << 20))
+        elapsed = timeit.default_timer() - start
+        results["forward_proxy/tunnel/mb_per_sec"] = received / elapsed / (1 << 20)
+    finally:
+        proxy.stop_thread()
+        upstream.stop()
+    return results
+
+
+def bench_cli_cold_start(number: int=10) -> dict:
+    """
+    Cold start of the headless CLI, against a JSON registry file.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    registry = os.path.abspath("bench_registry.json")
+    stored = FileBackend(registry)
+    stored.keys = fake_registry().keys
+    stored.save()
+    cmd = [sys.executable, here, "--registry", registry, "status"]
+    try:
+        out = subprocess.run([sys.executable, "-X", "importtime"] + cmd[1:],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        assert b" wx" not in out.stderr, "the CLI must not import wx"
+        start = timeit.default_timer()
+        for _ in range(number):
+            subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+        elapsed = timeit.default_timer() - start
+    finally:
+        os.remove(registry)
+    return {"cli/status/cold_start_ms": elapsed / number * 1e3}
+
+
+def bench_metrics(number: int=200000) -> dict:
+    """
+    Cost of the always-on instrumentation: a timed() call and a span on
+    top of a no-op, and a histogram record alone.
+    """
+    def noop():
+        pass
+
+    instrumented = timed("bench.noop")(noop)
+
+    def span():
+        with METRICS.span("bench.span"):
+            pass
+
+    histogram = Histogram()
+    results = {
+        "metrics/timed_overhead": per_op(instrumented, number) - per_op(noop, number),
+        "metrics/span": per_op(span, number),
+        "metrics/record": per_op(lambda: histogram.record(1234), number),
+    }
+    return results
+
+
+def bench_bypass(number: int=20) -> dict:
+    """
+    Bulk bypass list edits with alter_settings: replacing the list, and
+    merging into an existing one, for 1k to 50k entries.
+    """
+    results = {}
+    for count in (1000, 10000, 50000):
+        entries = ["host{}.corp.example".format(i) for i in range(count)]
+        blob = sample_blob()
+        merged = IEWindowsRegEditor.alter_settings(blob, bypass=entries[::2])
+        assert len(ConnectionSettings.decode(
+            IEWindowsRegEditor.alter_settings(merged, add_bypass=entries)).bypass_entries()) == count
+        results["bypass/set/{}".format(count)] = per_op(
+            lambda: IEWindowsRegEditor.alter_settings(blob, bypass=entries), number)
+        results["bypass/add/{}".format(count)] = per_op(
+            lambda: IEWindowsRegEditor.alter_settings(merged, add_bypass=entries), number)
+    return results
+
+
+def bench_hives(hives: int=200, latency: float=0.0005) -> dict:
+    """
+    install_pac_file on every hive of a HivesBackend whose calls take
+    ``latency`` seconds, with 1 and 16 workers. Milliseconds per run.
+    """
+    template = fake_registry().keys
+    results = {}
+    saved = ProxyHelper.backend, ProxyHelper.backup_file, ProxyHelper.backup_store
+    for workers in (1, 16):
+        backend = HivesBackend(latency)
+        for i in range(hives):
+            backend.add_hive("S-1-5-21-1-2-3-{}".format(1000 + i),
+                             {path: dict(values) for (_, path), values in template.items()})
+        ProxyHelper.backend = backend
+        ProxyHelper.backup_file = directory = tempfile.mkdtemp()
+        ProxyHelper.backup_store = None
+        try:
+            report = MultiUserApply(workers=workers).install_pac_file("http://pac.example/proxy.pac")
+            assert report.ok and len(report.results) == hives
+            results["hives/install/{}/workers{}_ms".format(hives, workers)] = report.elapsed * 1e3
+        finally:
+            ProxyHelper.backend, ProxyHelper.backup_file, ProxyHelper.backup_store = saved
+            shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+BENCHMARKS = OrderedDict([
+    ("alter_bin_reg", bench_alter_bin_reg),
+    ("validate_pac_url", bench_validate_pac_url),
+    ("backup", bench_backup),
+    ("history", bench_history),
+    ("install_cycle", bench_install_cycle),
+    ("metrics", bench_metrics),
+    ("bypass", bench_bypass),
+    ("hives", bench_hives),
+    ("dns", bench_dns),
+    ("pac_decisions", bench_pac_decisions),
+    ("pac_index", bench_pac_index),
+    ("pac_server", bench_pac_server),
+    ("forward_proxy", bench_forward_proxy),
+    ("cli_cold_start", bench_cli_cold_start),
+])
+
+GROUPS = {
+    "core": ("alter_bin_reg", "validate_pac_url", "backup", "history", "install_cycle", "metrics", "bypass"),
+}
+
+# Results whose name ends like this are rates: higher is better
+HIGHER_IS_BETTER = ("_per_sec", "_rate")
+
+
+def higher_is_better(name: str) -> bool:
+    return name.endswith(HIGHER_IS_BETTER)
+
+
+def run(names: list, repeat: int=1) -> dict:
+    """
+    Runs the named benchmarks ``repeat`` times, keeping the best value of
+    each result.
+    """
+    results = {}
+    for name in names:
+        for _ in range(repeat):
+            for key, value in BENCHMARKS[name]().items():
+                if key not in results:
+                    results[key] = value
+                elif higher_is_better(key):
+                    results[key] = max(results[key], value)
+                else:
+                    results[key] = min(results[key], value)
+    return results
+
+
+def save_baseline(path: str, results: dict) -> None:
+    data = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.platform(),
+        "results": results,
+    }
+    with open(path, "w") as file_:
+        json.dump(data, file_, indent=2, sort_keys=True)
+
+
+def load_baseline(path: str) -> dict:
+    with open(path, "r") as file_:
+        return json.load(file_)["results"]
+
+
+def compare(baseline: dict, results: dict, threshold: float) -> list:
+    """
+    Returns:
+        list - (name, baseline, current, change %, regressed) for every
+            result present in both; change is positive when worse.
+    """
+    rows = []
+    for name in sorted(results):
+        if name not in baseline or not baseline[name]:
+            continue
+        old, new = baseline[name], results[name]
+        change = (new - old) / old * 100
+        if higher_is_better(name):
+            change = -change
+        rows.append((name, old, new, change, change > threshold))
+    return rows
+
+
+def report(results: dict) -> None:
+    """
+    Prints results; timings are in microseconds per operation, counters
+    (names ending in a unit such as ``/key_opens``) are per operation too.
+    """
+    for name, value in sorted(results.items()):
+        print("{:<40} {:>12.2f}".format(name, value))
+
+
+def report_comparison(rows: list, threshold: float) -> None:
+    for name, old, new, change, regressed in rows:
+        print("{:<40} {:>12.2f} {:>12.2f} {:>+8.1f}%{}".format(
+            name, old, new, change, "  REGRESSION" if regressed else ""))
+    regressions = sum(1 for row in rows if row[4])
+    print("{} of {} results regressed by more than {}%".format(regressions, len(rows), threshold))
+
+
+def main(argv: list=None) -> int:
+    cli = argparse.ArgumentParser(description="Micro-benchmarks")
+    cli.add_argument("names", nargs="*", help="Benchmarks or groups ({})".format(
+        ", ".join(list(BENCHMARKS) + list(GROUPS))))
+    cli.add_argument("--repeat", type=int, default=1, help="Keep the best of N runs")
+    cli.add_argument("--save", metavar="FILE", help="Write the results as a JSON baseline")
+    cli.add_argument("--compare", metavar="FILE", help="Compare with a JSON baseline")
+    cli.add_argument("--threshold", type=float, default=10.0,
+                     help="Regression tolerated by --compare, in percent")
+    args = cli.parse_args(argv)
+    names = []
+    for name in args.names or list(BENCHMARKS):
+        for item in GROUPS.get(name, (name,)):
+            if item not in BENCHMARKS:
+                cli.error("unknown benchmark {}".format(item))
+            if item not in names:
+                names.append(item)
+    results = run(names, args.repeat)
+    if args.save:
+        save_baseline(args.save, results)
+    if args.compare:
+        rows = compare(load_baseline(args.compare), results, args.threshold)
+        report_comparison(rows, args.threshold)
+        return 1 if any(row[4] for row in rows) else 0
+    report(results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import struct
+
+from typing import Iterable
+
+
+class ConnectionSettings(object):
+    """
+    Structured view of a DefaultConnectionSettings/SavedLegacySettings blob.
+
+    Layout (all integers are little-endian DWORDs):
+
+        0   header        - structure version (0x46 on recent Windows)
+        4   counter       - incremented by Windows on every change
+        8   flags         - AUTO_DETECT/AUTO_CONFIG_SCRIPT/MANUAL_PROXY bits
+        12  proxy length  - followed by the proxy server string
+        ..  bypass length - followed by the proxy bypass list
+        ..  url length    - followed by the auto config URL
+        ..  trailer       - remaining bytes, kept verbatim
+
+    The blob is parsed once over a memoryview and rebuilt with a single
+    preallocated bytearray, so no per-byte Python objects are created.
+    """
+
+    __slots__ = (
+        "header",
+        "counter",
+        "flags",
+        "proxy_server",
+        "bypass_list",
+        "auto_config_url",
+        "trailer",
+    )
+
+    DWORD = struct.Struct("<I")
+    PREFIX = struct.Struct("<III")
+
+    HEADER_IDX = 0
+    COUNTER_IDX = 4
+    FLAGS_IDX = 8
+    PROXY_LEN_IDX = 12
+
+    # Flag bits; Windows always keeps DIRECT set
+    DIRECT = 0x01
+    PROXY = 0x02
+    AUTO_PROXY_URL = 0x04
+    AUTO_DETECT = 0x08
+
+    ENCODING = "latin-1"
+    BYPASS_SEP = ";"
+
+    def __init__(self, header: int=0x46, counter: int=0, flags: int=0x01,
+                 proxy_server: bytes=b"", bypass_list: bytes=b"",
+                 auto_config_url: bytes=b"", trailer: bytes=b""):
+        self.header = header
+        self.counter = counter
+        self.flags = flags
+        self.proxy_server = proxy_server
+        self.bypass_list = bypass_list
+        self.auto_config_url = auto_config_url
+        self.trailer = trailer
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, ConnectionSettings):
+            return NotImplemented
+        return all(getattr(self, s) == getattr(other, s) for s in self.__slots__)
+
+    def __repr__(self) -> str:
+        fields = ", ".join("{}={!r}".format(s, getattr(self, s)) for s in self.__slots__)
+        return "ConnectionSettings({})".format(fields)
+
+    def diff(self, other: "ConnectionSettings", ignore: tuple=()) -> list:
+        """
+        Field-level differences; string fields are decoded.
+
+        Args:
+            other (ConnectionSettings) - Record to compare with.
+            ignore (tuple) - Field names to leave out.
+
+        Returns:
+            list - (field, own value, other value) for each differing field.
+        """
+        changes = []
+        for field in self.__slots__:
+            a, b = getattr(self, field), getattr(other, field)
+            if a != b and field not in ignore:
+                if isinstance(a, bytes) and field != "trailer":
+                    a, b = a.decode(self.ENCODING), b.decode(self.ENCODING)
+                elif isinstance(a, bytes):
+                    a, b = a.hex(), b.hex()
+                changes.append((field, a, b))
+        return changes
+
+    @classmethod
+    def fields(cls, blob: bytes) -> tuple:
+        """
+        Parses a settings blob into a plain tuple, in __slots__ order, without
+        building a record; used for bulk scans.
+
+        Args:
+            blob (bytes) - Raw registry value, or a memoryview of it.
+
+        Returns:
+            tuple - (header, counter, flags, proxy_server, bypass_list,
+                auto_config_url, trailer).
+
+        Raises:
+            ValueError - If the blob is truncated or malformed.
+        """
+        view = memoryview(blob)
+        size = len(view)
+        if size < cls.PREFIX.size:
+            raise ValueError("Invalid format")
+        unpack = cls.DWORD.unpack_from
+        out = list(cls.PREFIX.unpack_from(view, cls.HEADER_IDX))
+        offset = cls.PROXY_LEN_IDX
+        for _ in range(3):
+            end = offset + cls.DWORD.size
+            if end > size:
+                raise ValueError("Invalid format")
+            length, = unpack(view, offset)
+            offset = end + length
+            if offset > size:
+                raise ValueError("Invalid format")
+            out.append(view[end:offset].tobytes())
+        out.append(view[offset:].tobytes())
+        return tuple(out)
+
+    @classmethod
+    def decode(cls, blob: bytes) -> "ConnectionSettings":
+        """
+        Parses a settings blob.
+
+        Args:
+            blob (bytes) - Raw registry value.
+
+        Returns:
+            ConnectionSettings - Decoded record.
+
+        Raises:
+            ValueError - If the blob is truncated or malformed.
+        """
+        return cls(*cls.fields(blob))
+
+    def size(self) -> int:
+        """
+        Returns:
+            int - Length in bytes of the encoded blob.
+        """
+        return (self.PREFIX.size + 3 * self.DWORD.size + len(self.proxy_server)
+                + len(self.bypass_list) + len(self.auto_config_url) + len(self.trailer))
+
+    def encode(self) -> bytes:
+        """
+        Serializes the record back into a registry blob.
+
+        Returns:
+            bytes - Raw registry value.
+        """
+        buf = bytearray(self.size())
+        self.PREFIX.pack_into(buf, self.HEADER_IDX, self.header, self.counter, self.flags)
+        offset = self.PROXY_LEN_IDX
+        for field in (self.proxy_server, self.bypass_list, self.auto_config_url):
+            self.DWORD.pack_into(buf, offset, len(field))
+            offset += self.DWORD.size
+            buf[offset:offset + len(field)] = field
+            offset += len(field)
+        buf[offset:] = self.trailer
+        return bytes(buf)
+
+    def set_auto_config_url(self, url: str) -> "ConnectionSettings":
+        """
+        Replaces the auto config URL segment.
+
+        Args:
+            url (str) - URL to store; surrounding whitespace is dropped.
+
+        Returns:
+            ConnectionSettings - Self, for chaining.
+        """
+        self.auto_config_url = url.strip().encode(self.ENCODING)
+        return self
+
+    def set_flag(self, bit: int, enable: bool=True) -> "ConnectionSettings":
+        """
+        Sets or clears one of the flag bits.
+
+        Args:
+            bit (int) - PROXY, AUTO_PROXY_URL or AUTO_DETECT.
+            enable (bool) - Whether the bit should be set.
+
+        Returns:
+            ConnectionSettings - Self, for chaining.
+        """
+        self.flags = (self.flags | bit) if enable else (self.flags & ~bit)
+        return self
+
+    def set_proxy_server(self, server: str, enable: bool=True) -> "ConnectionSettings":
+        """
+        Replaces the proxy server segment and sets the MANUAL_PROXY bit to
+        match; an empty server always clears it.
+
+        Args:
+            server (str) - "host:port", or per-protocol "http=host:port;https=...".
+            enable (bool) - Whether the proxy should be used.
+
+        Returns:
+            ConnectionSettings - Self, for chaining.
+        """
+        self.proxy_server = server.strip().encode(self.ENCODING)
+        return self.set_flag(self.PROXY, enable and bool(self.proxy_server))
+
+    def bypass_entries(self) -> list:
+        """
+        Returns:
+            list - Bypass list entries (str), in order, without empty ones.
+        """
+        text = self.bypass_list.decode(self.ENCODING)
+        return [e for e in (e.strip() for e in text.split(self.BYPASS_SEP)) if e]
+
+    def set_bypass_list(self, entries: Iterable[str]) -> "ConnectionSettings":
+        """
+        Replaces the bypass list. The entries are joined and encoded once, so
+        this stays linear in the total length for lists of any size.
+
+        Args:
+            entries (Iterable[str]) - Hosts, wildcards or "<local>".
+
+        Returns:
+            ConnectionSettings - Self, for chaining.
+        """
+        entries = (e.strip() for e in entries)
+        self.bypass_list = self.BYPASS_SEP.join(e for e in entries if e).encode(self.ENCODING)
+        return self
+
+    def add_bypass(self, entries: Iterable[str]) -> "ConnectionSettings":
+        """
+        Appends entries to the bypass list, skipping those already present.
+
+        Args:
+            entries (Iterable[str]) - Entries to add.
+
+        Returns:
+            ConnectionSettings - Self, for chaining.
+        """
+        merged = dict.fromkeys(self.bypass_entries())
+        merged.update(dict.fromkeys(e.strip() for e in entries))
+        return self.set_bypass_list(merged)
+
+    def remove_bypass(self, entries: Iterable[str]) -> "ConnectionSettings":
+        """
+        Drops entries from the bypass list; unknown ones are ignored.
+
+        Args:
+            entries (Iterable[str]) - Entries to remove.
+
+        Returns:
+            ConnectionSettings - Self, for chaining.
+        """
+        drop = set(e.strip() for e in entries)
+        return self.set_bypass_list(e for e in self.bypass_entries() if e not in drop)
@@ -0,0 +1,409 @@
+# #!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import mmap
+import zlib
+import struct
+import tarfile
+import zipfile
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from codec import ConnectionSettings
+
+
+def fingerprint(fields: tuple) -> tuple:
+    """
+    Structural fingerprint of a blob parsed by ConnectionSettings.fields:
+    header version, flags, which string fields are present and the trailer
+    length. Values that vary per machine (counter, server names, URLs) are
+    left out.
+    """
+    header, _, flags, proxy, bypass, url, trailer = fields
+    return header, flags, bool(proxy), bool(bypass), bool(url), len(trailer)
+
+
+class Group(object):
+    """
+    Blobs sharing one structural fingerprint, with per-field value counts.
+    Only the first MAX_VALUES distinct values of a field are counted; the
+    rest are tallied in ``overflow``.
+    """
+
+    MAX_VALUES = 32
+    FIELDS = ("counter", "proxy_server", "bypass_list", "auto_config_url", "trailer")
+    # Positions of FIELDS in a ConnectionSettings.fields tuple
+    POSITIONS = tuple(ConnectionSettings.__slots__.index(f) for f in FIELDS)
+
+    __slots__ = ("count", "example", "values", "overflow", "tables")
+
+    def __init__(self, example: str):
+        self.count = 0
+        self.example = example
+        self.values = {f: Counter() for f in self.FIELDS} # type: Dict[str, Counter]
+        self.overflow = Counter()
+        self.tables = tuple((f, p, self.values[f]) for f, p in zip(self.FIELDS, self.POSITIONS))
+
+    def add(self, fields: tuple) -> None:
+        self.count += 1
+        limit = self.MAX_VALUES
+        for field, position, values in self.tables:
+            value = fields[position]
+            if value in values:
+                values[value] += 1
+            elif len(values) < limit:
+                values[value] = 1
+            else:
+                self.overflow[field] += 1
+
+    def tally(self, field: str, value, count: int) -> None:
+        values = self.values[field]
+        if value in values or len(values) < self.MAX_VALUES:
+            values[value] += count
+        else:
+            self.overflow[field] += count
+
+    def merge(self, other: "Group") -> None:
+        self.count += other.count
+        for field, values in other.values.items():
+            for value, count in values.items():
+                self.tally(field, value, count)
+        self.overflow.update(other.overflow)
+
+    @staticmethod
+    def show(value) -> object:
+        if isinstance(value, bytes):
+            return value.decode(ConnectionSettings.ENCODING)
+        return value
+
+    def to_dict(self, top: int=5) -> dict:
+        fields = {}
+        for field, values in self.values.items():
+            distinct = len(values) + (1 if self.overflow[field] else 0)
+            if distinct > 1:
+                fields[field] = {
+                    "distinct": len(values),
+                    "untracked": self.overflow[field],
+                    "top": [[self.show(v), c] for v, c in values.most_common(top)],
+                }
+        constant = {f: self.show(next(iter(v))) for f, v in self.values.items()
+                    if len(v) == 1 and not self.overflow[f]}
+        return {"count": self.count, "example": self.example, "constant": constant, "varying": fields}
+
+
+class CorpusReport(object):
+    """
+    Mergeable summary of a set of blobs: groups by structural fingerprint,
+    plus the blobs that do not decode at all.
+    """
+
+    MAX_OUTLIERS = 20
+
+    def __init__(self):
+        self.total = 0
+        self.groups = {} # type: Dict[tuple, Group]
+        self.outliers = 0
+        self.outlier_samples = [] # type: List[Tuple[str, str, str]]
+
+    def add(self, name: str, blob: bytes) -> None:
+        self.total += 1
+        try:
+            fields = ConnectionSettings.fields(blob)
+        except ValueError as e:
+            self.outlier(name, str(e), blob)
+            return
+        key = fingerprint(fields)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = Group(name)
+        group.add(fields)
+
+    def outlier(self, name: str, error: str, blob: bytes=b"") -> None:
+        self.outliers += 1
+        if len(self.outlier_samples) < self.MAX_OUTLIERS:
+            self.outlier_samples.append((name, error, bytes(blob[:32]).hex()))
+
+    def merge(self, other: "CorpusReport") -> "CorpusReport":
+        self.total += other.total
+        for key, group in other.groups.items():
+            if key in self.groups:
+                self.groups[key].merge(group)
+            else:
+                self.groups[key] = group
+        self.outliers += other.outliers
+        room = self.MAX_OUTLIERS - len(self.outlier_samples)
+        self.outlier_samples.extend(other.outlier_samples[:max(room, 0)])
+        return self
+
+    def to_dict(self, top: int=5) -> dict:
+        groups = sorted(self.groups.items(), key=lambda item: -item[1].count)
+        return {
+            "total": self.total,
+            "groups": [dict(group.to_dict(top), fingerprint={
+                "header": key[0], "flags": key[1], "proxy_server": key[2],
+                "bypass_list": key[3], "auto_config_url": key[4], "trailer_length": key[5],
+            }) for key, group in groups],
+            "outliers": self.outliers,
+            "outlier_samples": [{"name": n, "error": e, "head": h} for n, e, h in self.outlier_samples],
+        }
+
+
+def iter_directory(directory: str) -> Iterator[str]:
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            yield os.path.join(root, name)
+
+
+class ZipReader(object):
+    """
+    Reads zip members straight from an mmap of the archive.
+
+    zipfile builds a ZipInfo object per member up front, which dominates the
+    run time on archives of small blobs. This walks the central directory
+    with struct over a memoryview instead, and lets a worker process start
+    at any directory entry, so shards of one archive are read in parallel.
+    Stored and deflated members (with zip64 sizes and offsets) are supported.
+    """
+
+    EOCD = struct.Struct("<4s4H2LH")
+    ZIP64_LOCATOR = struct.Struct("<4sLQL")
+    ZIP64_EOCD = struct.Struct("<4sQ2H2L4Q")
+    CENTRAL = struct.Struct("<4s6H3L5H2L")
+    LOCAL = struct.Struct("<4s5H3L2H")
+    SIZES = struct.Struct("<3H")
+    EXTRA = struct.Struct("<2H")
+    QWORD = struct.Struct("<Q")
+
+    EOCD_SIG = b"PK\x05\x06"
+    MASK32 = 0xffffffff
+
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        self.directory, self.count = self.locate()
+
+    def __enter__(self) -> "ZipReader":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.view.release()
+        self.map.close()
+        self.file.close()
+
+    def locate(self) -> Tuple[int, int]:
+        """
+        Returns:
+            tuple - Offset of the central directory and number of entries.
+        """
+        start = self.map.rfind(self.EOCD_SIG, max(0, len(self.map) - (1 << 16) - self.EOCD.size))
+        if start < 0:
+            raise ValueError("Not a zip archive")
+        _, _, _, _, count, _, offset, _ = self.EOCD.unpack_from(self.view, start)
+        if count == 0xffff or offset == self.MASK32:
+            locator = start - self.ZIP64_LOCATOR.size
+            _, _, eocd64, _ = self.ZIP64_LOCATOR.unpack_from(self.view, locator)
+            fields = self.ZIP64_EOCD.unpack_from(self.view, eocd64)
+            count, offset = fields[7], fields[9]
+        return offset, count
+
+    def zip64(self, extra: memoryview, sizes: list) -> list:
+        """
+        Replaces the 0xffffffff placeholders of (usize, csize, offset) with
+        the values of the zip64 extra field.
+        """
+        pos = 0
+        while pos + self.EXTRA.size <= len(extra):
+            kind, length = self.EXTRA.unpack_from(extra, pos)
+            pos += self.EXTRA.size
+            if kind == 1:
+                field = pos
+                for i, value in enumerate(sizes):
+                    if value == self.MASK32:
+                        sizes[i], = self.QWORD.unpack_from(extra, field)
+                        field += self.QWORD.size
+                return sizes
+            pos += length
+        return sizes
+
+    def shards(self, parts: int) -> List[Tuple[int, int]]:
+        """
+        Splits the central directory in ``parts`` runs of entries.
+
+        Returns:
+            list - (directory offset, entry count) per run.
+        """
+        size = max(1, -(-self.count // parts))
+        unpack, view = self.SIZES.unpack_from, self.view
+        runs, offset = [], self.directory
+        for index in range(self.count):
+            if index % size == 0:
+                runs.append([offset, 0])
+            runs[-1][1] += 1
+            name, extra, comment = unpack(view, offset + 28)
+            offset += self.CENTRAL.size + name + extra + comment
+        return [tuple(r) for r in runs]
+
+    def members(self, offset: int=None, count: int=None) -> Iterator[Tuple[str, object]]:
+        """
+        Yields (name, blob) for ``count`` entries starting at directory
+        offset ``offset``. Blobs that cannot be read (unsupported or
+        corrupt) are yielded as a ValueError instead.
+        """
+        offset = self.directory if offset is None else offset
+        count = self.count if count is None else count
+        view, central, local = self.view, self.CENTRAL, self.LOCAL
+        for _ in range(count):
+            entry = central.unpack_from(view, offset)
+            flags, method, csize, usize = entry[3], entry[4], entry[8], entry[9]
+            name_len, extra_len, comment_len, header = entry[10], entry[11], entry[12], entry[16]
+            name_end = offset + central.size + name_len
+            raw_name = view[offset + central.size:name_end].tobytes()
+            sizes = [usize, csize, header]
+            if self.MASK32 in sizes:
+                usize, csize, header = self.zip64(view[name_end:name_end + extra_len], sizes)
+            offset = name_end + extra_len + comment_len
+            name = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+            if name.endswith("/"):
+                continue
+            data = None
+            try:
+                _, _, _, _, _, _, _, _, _, local_name, local_extra = local.unpack_from(view, header)
+                start = header + local.size + local_name + local_extra
+                data = view[start:start + csize]
+                if method == zipfile.ZIP_STORED:
+                    blob = data.tobytes()
+                elif method == zipfile.ZIP_DEFLATED:
+                    blob = zlib.decompress(data, -15)
+                else:
+                    blob = ValueError("Unsupported compression {}".format(method))
+            except (zlib.error, struct.error) as e:
+                blob = ValueError("Corrupt member: {}".format(e))
+            finally:
+                # Released before yielding, so close() works even when the
+                # caller stops iterating half way
+                if data is not None:
+                    data.release()
+            yield name, blob
+
+
+def iter_archive(path: str) -> Iterator[Tuple[str, object]]:
+    """
+    Streams the members of a zip or tar archive as (name, blob). Like
+    ZipReader.members, zip members that cannot be read are yielded as a
+    ValueError instead.
+    """
+    if zipfile.is_zipfile(path):
+        with ZipReader(path) as archive:
+            yield from archive.members()
+        return
+    with tarfile.open(path, "r:*") as archive:
+        for member in archive:
+            if member.isfile():
+                yield member.name, archive.extractfile(member).read()
+
+
+def _inspect_files(paths: List[str]) -> CorpusReport:
+    report = CorpusReport()
+    for path in paths:
+        with open(path, "rb") as file_:
+            report.add(path, file_.read())
+    return report
+
+
+def _inspect_zip(path: str, offset: int=None, count: int=None) -> CorpusReport:
+    with ZipReader(path) as archive:
+        return _inspect_blobs(archive.members(offset, count))
+
+
+def _inspect_blobs(blobs: Iterable[Tuple[str, object]]) -> CorpusReport:
+    report = CorpusReport()
+    for name, blob in blobs:
+        if isinstance(blob, ValueError):
+            report.outlier(name, str(blob))
+        else:
+            report.add(name, blob)
+    return report
+
+
+def shards(items: list, count: int) -> List[list]:
+    size = max(1, -(-len(items) // count))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def inspect(path: str, workers: Optional[int]=None, chunk: int=4096) -> CorpusReport:
+    """
+    Summarizes every blob in a directory tree or a zip/tar archive.
+
+    Directory files and zip members are split in contiguous shards that
+    worker processes read themselves; tar archives can only be read in
+    order, so their blobs are read here and shipped in chunks of ``chunk``.
+    With ``workers`` 1 everything runs in this process.
+    """
+    workers = workers or os.cpu_count() or 1
+    is_zip = os.path.isfile(path) and zipfile.is_zipfile(path)
+    if workers == 1:
+        if os.path.isdir(path):
+            return _inspect_files(list(iter_directory(path)))
+        if is_zip:
+            return _inspect_zip(path)
+        return _inspect_blobs(iter_archive(path))
+    report = CorpusReport()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        if os.path.isdir(path):
+            futures = [pool.submit(_inspect_files, s) for s in shards(list(iter_directory(path)), workers * 4)]
+        elif is_zip:
+            with ZipReader(path) as archive:
+                runs = archive.shards(workers * 4)
+            futures = [pool.submit(_inspect_zip, path, offset, count) for offset, count in runs]
+        else:
+            futures, batch = [], []
+            for item in iter_archive(path):
+                batch.append(item)
+                if len(batch) == chunk:
+                    futures.append(pool.submit(_inspect_blobs, batch))
+                    batch = []
+            if batch:
+                futures.append(pool.submit(_inspect_blobs, batch))
+        for future in futures:
+            report.merge(future.result())
+    return report
+
+
+def diff(a: bytes, b: bytes) -> dict:
+    """
+    Field-level comparison of two blobs.
+    """
+    try:
+        left, right = ConnectionSettings.decode(a), ConnectionSettings.decode(b)
+        shape = fingerprint(ConnectionSettings.fields(a)) == fingerprint(ConnectionSettings.fields(b))
+    except ValueError as e:
+        return {"error": str(e)}
+    return {
+        "same_structure": shape,
+        "changes": [{"field": f, "a": x, "b": y} for f, x, y in left.diff(right)],
+    }
@@ -0,0 +1,259 @@
+# #!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import time
+import socket
+import asyncio
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+from metrics import METRICS
+
+
+async def system_resolve(host: str) -> Optional[str]:
+    """
+    IPv4 address of ``host`` from the system resolver, or None.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        infos = await loop.getaddrinfo(host, None, family=socket.AF_INET, type=socket.SOCK_STREAM)
+    except (OSError, UnicodeError):
+        return None
+    return infos[0][4][0] if infos else None
+
+
+class StubResolver(object):
+    """
+    In-process resolver answering from a dict after ``delay`` seconds, for
+    tests and benchmarks; ``queries`` counts the lookups it served.
+    """
+
+    def __init__(self, records: Dict[str, str]=None, delay: float=0.0):
+        self.records = dict(records or {})
+        self.delay = delay
+        self.queries = 0
+
+    async def __call__(self, host: str) -> Optional[str]:
+        self.queries += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return self.records.get(host)
+
+
+class DnsCache(object):
+    """
+    Caching resolver shared by the PAC helpers and the URL checks.
+
+    Answers are kept ``ttl`` seconds, failures ``negative_ttl`` seconds, in
+    an LRU of at most ``size`` names. Misses run ``resolve`` on a private
+    event loop thread, started on first use; concurrent lookups of the same
+    name share one query. A hit on a name past ``prefetch`` of its TTL
+    refreshes it in the background, so hot names never expire in front of
+    a caller.
+
+    get() is the synchronous entry point (a PacHelpers resolver); from a
+    coroutine, await resolve() instead.
+    """
+
+    def __init__(self, resolve: Callable[[str], Awaitable[Optional[str]]]=None, ttl: float=300.0,
+                 negative_ttl: float=30.0, size: int=4096, prefetch: float=0.8, timeout: float=2.0):
+        self.query = resolve or system_resolve
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.size = size
+        self.prefetch = prefetch
+        self.timeout = timeout
+        self.entries = OrderedDict() # type: OrderedDict[str, tuple]
+        self.pending = {} # type: Dict[str, Future]
+        self.lock = threading.Lock()
+        self.loop = None # type: asyncio.AbstractEventLoop
+        self.thread = None # type: threading.Thread
+        self.hits = self.misses = self.negative_hits = 0
+        self.coalesced = self.prefetches = self.evictions = 0
+
+    def _cached(self, host: str) -> tuple:
+        """
+        Returns:
+            tuple - (found, address); schedules a prefetch when due.
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry is None or entry[1] <= now:
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(host)
+            address, expires, refresh = entry
+            if address is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            due = refresh <= now and host not in self.pending
+            if due:
+                self.prefetches += 1
+        if due:
+            self._submit(host)
+        return True, address
+
+    def _store(self, host: str, address: Optional[str]) -> None:
+        ttl = self.ttl if address is not None else self.negative_ttl
+        now = time.monotonic()
+        with self.lock:
+            self.entries[host] = (address, now + ttl, now + ttl * self.prefetch)
+            self.entries.move_to_end(host)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    async def _query(self, host: str) -> Optional[str]:
+        try:
+            with METRICS.span("dns.query"):
+                address = await asyncio.wait_for(self.query(host), self.timeout)
+        except Exception:
+            address = None
+        self._store(host, address)
+        return address
+
+    def _start(self) -> asyncio.AbstractEventLoop:
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=loop.run_forever, name="ipsx-dns", daemon=True)
+                self.thread.start()
+                self.loop = loop
+            return self.loop
+
+    def _submit(self, host: str) -> Future:
+        """
+        The in-flight query for ``host``, started if there is none.
+        """
+        loop = self._start()
+        with self.lock:
+            future = self.pending.get(host)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            future = self.pending[host] = asyncio.run_coroutine_threadsafe(self._query(host), loop)
+        future.add_done_callback(lambda _: self._forget(host, future))
+        return future
+
+    def _forget(self, host: str, future: Future) -> None:
+        with self.lock:
+            if self.pending.get(host) is future:
+                del self.pending[host]
+
+    def get(self, host: str) -> Optional[str]:
+        """
+        IPv4 address of ``host``, or None if it does not resolve; blocks for
+        at most ``timeout`` seconds on a miss.
+        """
+        host = host.lower()
+        found, address = self._cached(host)
+        METRICS.count("dns.hits" if found else "dns.misses")
+        if found:
+            return address
+        try:
+            return self._submit(host).result(self.timeout + 1)
+        except Exception:
+            return None
+
+    async def resolve(self, host: str) -> Optional[str]:
+        """
+        Coroutine version of get(), usable from any event loop.
+        """
+        host = host.lower()
+        found, address = self._cached(host)
+        METRICS.count("dns.hits" if found else "dns.misses")
+        if found:
+            return address
+        try:
+            return await asyncio.wrap_future(self._submit(host))
+        except Exception:
+            return None
+
+    def warm(self, hosts: Iterable[str]) -> None:
+        """
+        Starts lookups of ``hosts`` that are not cached, without waiting.
+        """
+        for host in hosts:
+            host = host.lower()
+            with self.lock:
+                entry = self.entries.get(host)
+                fresh = entry is not None and entry[1] > time.monotonic()
+            if not fresh:
+                self._submit(host)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+            "coalesced": self.coalesced,
+            "prefetches": self.prefetches,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+        }
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    @staticmethod
+    async def _cancel_all() -> None:
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self) -> None:
+        """
+        Stops the resolver thread; cached answers stay usable. Lookups in
+        flight are cancelled, so their callers get None right away and a
+        later lookup of the same name starts afresh.
+        """
+        with self.lock:
+            loop, self.loop = self.loop, None
+            self.pending.clear()
+        if loop is not None:
+            try:
+                asyncio.run_coroutine_threadsafe(self._cancel_all(), loop).result(self.timeout + 1)
+            finally:
+                loop.call_soon_threadsafe(loop.stop)
+                self.thread.join()
+                loop.close()
+
+
+_SHARED = None # type: DnsCache
+
+
+def shared() -> DnsCache:
+    """
+    Process-wide DnsCache used by default by the PAC helpers.
+    """
+    global _SHARED
+    if _SHARED is None:
+        _SHARED = DnsCache()
+    return _SHARED
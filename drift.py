@@ -0,0 +1,212 @@
+# #!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import time
+import hashlib
+import threading
+
+from typing import Callable, Dict, List, Optional, Tuple
+from codec import ConnectionSettings
+from reg import IEWindowsRegEditor
+from backend import RegistryBackend
+
+
+class RegistrySource(object):
+    """
+    Reads the watched values as raw bytes. Any object with the same read()
+    and close() can be handed to DriftMonitor instead.
+    """
+
+    NAMES = (
+        IEWindowsRegEditor.AUTO_CONFIG_REGVAL,
+        IEWindowsRegEditor.CONNECTION_SETTINGS,
+        IEWindowsRegEditor.LEGACY_SETTINGS,
+    )
+
+    def __init__(self, backend: RegistryBackend=None):
+        self.editor = IEWindowsRegEditor(backend)
+        self.readers = (
+            lambda: self.editor.read_auto_config().encode("utf-8"),
+            self.editor.read_default_connection_settings,
+            self.editor.read_saved_legacy_settings,
+        )
+
+    def read(self) -> Dict[str, bytes]:
+        values = {}
+        for name, reader in zip(self.NAMES, self.readers):
+            try:
+                values[name] = bytes(reader())
+            except OSError:
+                values[name] = b""
+        return values
+
+    def close(self) -> None:
+        self.editor.close()
+
+
+class Drift(object):
+    """
+    One watched value that changed between two polls. ``changes`` lists
+    (field, old, new) for every decoded field that differs.
+    """
+
+    __slots__ = ("name", "changes", "time")
+
+    def __init__(self, name: str, changes: List[Tuple[str, object, object]]):
+        self.name = name
+        self.changes = changes
+        self.time = time.time()
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "changes": [{"field": f, "old": o, "new": n} for f, o, n in self.changes],
+        }
+
+    def __str__(self) -> str:
+        return "{} changed: {}".format(self.name, ", ".join(
+            "{} {!r} -> {!r}".format(f, o, n) for f, o, n in self.changes))
+
+
+class DriftMonitor(object):
+    """
+    Polls a source and reports settings that were rewritten behind our back.
+
+    Every poll reads the raw values and compares an 8-byte BLAKE2 digest of
+    each one to the previous poll; only values whose digest changed are
+    decoded and diffed. A change that only bumps the settings counter is
+    not drift. With ``desired`` set, a drift that leaves the system off that
+    PAC URL calls ``reapply(desired)``.
+
+    The polling interval halves after each drift, down to ``min_interval``,
+    and grows by ``backoff`` after each quiet poll, up to ``max_interval``.
+    """
+
+    IGNORED = ("counter",)
+
+    def __init__(self, source: RegistrySource=None, desired: str=None,
+                 reapply: Callable[[str], object]=None, log: Callable[[str, str], object]=None,
+                 min_interval: float=2.0, max_interval: float=60.0, backoff: float=1.5):
+        self.source = source if source is not None else RegistrySource()
+        self.desired = desired
+        self.reapply = reapply
+        self.log = log
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.values = {} # type: Dict[str, bytes]
+        self.fingerprints = {} # type: Dict[str, bytes]
+        self.polls = self.decodes = self.reapplies = 0
+        self.stopping = threading.Event()
+        self.thread = None # type: threading.Thread
+
+    @staticmethod
+    def fingerprint(value: bytes) -> bytes:
+        return hashlib.blake2b(value, digest_size=8).digest()
+
+    def baseline(self) -> None:
+        self.values = self.source.read()
+        self.fingerprints = {k: self.fingerprint(v) for k, v in self.values.items()}
+
+    @staticmethod
+    def settings(value: bytes) -> Optional[ConnectionSettings]:
+        try:
+            return ConnectionSettings.decode(value)
+        except ValueError:
+            return None
+
+    def diff(self, name: str, old: bytes, new: bytes) -> List[Tuple[str, object, object]]:
+        self.decodes += 1
+        if name == IEWindowsRegEditor.AUTO_CONFIG_REGVAL:
+            return [("value", old.decode("utf-8", "replace"), new.decode("utf-8", "replace"))]
+        before, after = self.settings(old), self.settings(new)
+        if before is None or after is None:
+            return [("raw", old.hex(), new.hex())]
+        return before.diff(after, self.IGNORED)
+
+    def check(self) -> List[Drift]:
+        """
+        One poll; returns the drifts found, an empty list when nothing
+        changed.
+        """
+        if not self.fingerprints:
+            self.baseline()
+        self.polls += 1
+        values = self.source.read()
+        drifts = []
+        for name, value in values.items():
+            digest = self.fingerprint(value)
+            if digest == self.fingerprints.get(name):
+                continue
+            changes = self.diff(name, self.values.get(name, b""), value)
+            self.fingerprints[name], self.values[name] = digest, value
+            if changes:
+                drifts.append(Drift(name, changes))
+        if drifts:
+            self.interval = max(self.min_interval, self.interval / 2)
+            for drift in drifts:
+                if self.log is not None:
+                    self.log(str(drift), "drift")
+            if self.needs_reapply():
+                self.reapplies += 1
+                result = self.reapply(self.desired)
+                if self.log is not None:
+                    self.log("Re-applied {}: {}".format(self.desired, getattr(result, "message", result)), "drift")
+                # Our own write is not drift
+                self.baseline()
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+        return drifts
+
+    def needs_reapply(self) -> bool:
+        if self.desired is None or self.reapply is None:
+            return False
+        url = self.values.get(IEWindowsRegEditor.AUTO_CONFIG_REGVAL, b"").decode("utf-8", "replace")
+        if url != self.desired:
+            return True
+        settings = self.settings(self.values.get(IEWindowsRegEditor.CONNECTION_SETTINGS, b""))
+        script = IEWindowsRegEditor.AUTO_CONFIG_SCRIPT
+        return settings is None or settings.flags & script != script or settings.auto_config_url != self.desired.encode(ConnectionSettings.ENCODING)
+
+    def run(self, on_drift: Callable[[List[Drift]], None]=None) -> None:
+        """
+        Polls until stop() is called.
+        """
+        self.baseline()
+        while not self.stopping.wait(self.interval):
+            drifts = self.check()
+            if drifts and on_drift is not None:
+                on_drift(drifts)
+
+    def start(self, on_drift: Callable[[List[Drift]], None]=None) -> threading.Thread:
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, args=(on_drift,), daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self) -> None:
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.source.close()
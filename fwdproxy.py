@@ -0,0 +1,520 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Local HTTP/CONNECT forwarding proxy routing each request by PAC decision.
+
+Sockets are driven directly through the event loop's sock_* coroutines:
+bytes are relayed from a preallocated buffer through memoryview slices
+(no per-chunk allocations), and a relay only reads again once the previous
+chunk was fully sent, which gives natural backpressure.
+"""
+
+import socket
+import asyncio
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from httphead import HttpError, connection_options, content_length, end_to_end, header, parse_head
+from pac import PacEngine
+
+
+Route = Optional[Tuple[str, int]]
+
+
+def parse_pac_answer(answer: str) -> List[Route]:
+    """
+    Turns "PROXY a:8080; DIRECT" into [("a", 8080), None]; None is DIRECT.
+    SOCKS entries are skipped since the proxy only speaks HTTP upstream.
+    """
+    routes = []
+    for entry in answer.split(";"):
+        parts = entry.split()
+        if not parts:
+            continue
+        kind = parts[0].upper()
+        if kind == "DIRECT":
+            routes.append(None)
+        elif kind in ("PROXY", "HTTP") and len(parts) > 1:
+            host, _, port = parts[1].rpartition(":")
+            if host and port.isdigit():
+                routes.append((host.strip("[]"), int(port)))
+            else:
+                routes.append((parts[1], 80))
+    return routes or [None]
+
+
+class ProxyError(HttpError):
+    """
+    Failure to serve a request; a malformed head raises the HttpError base.
+    """
+
+
+class BadRequest(ProxyError):
+    """
+    The client's request cannot be parsed; answered with 400, not 502.
+    """
+
+
+class BufferedSocket(object):
+    """
+    Non-blocking socket with a read-ahead buffer for parsing HTTP framing.
+    """
+
+    def __init__(self, sock: socket.socket, bufsize: int=65536):
+        self.sock = sock
+        self.loop = asyncio.get_running_loop()
+        self.pending = bytearray()
+        self.chunk = bytearray(bufsize)
+        self.view = memoryview(self.chunk)
+
+    async def fill(self) -> int:
+        n = await self.loop.sock_recv_into(self.sock, self.chunk)
+        self.pending += self.view[:n]
+        return n
+
+    async def read_until(self, marker: bytes, limit: int=65536) -> bytes:
+        start = 0
+        while True:
+            index = self.pending.find(marker, start)
+            if index >= 0:
+                end = index + len(marker)
+                data = bytes(self.pending[:end])
+                del self.pending[:end]
+                return data
+            if len(self.pending) > limit:
+                raise ProxyError("Header too large")
+            start = max(0, len(self.pending) - len(marker) + 1)
+            if not await self.fill():
+                raise EOFError()
+
+    async def send(self, data: bytes) -> None:
+        await self.loop.sock_sendall(self.sock, data)
+
+    async def copy(self, dst: "BufferedSocket", size: int) -> None:
+        """
+        Relays exactly ``size`` bytes to ``dst``.
+        """
+        if self.pending:
+            head = min(size, len(self.pending))
+            await dst.send(bytes(self.pending[:head]))
+            del self.pending[:head]
+            size -= head
+        while size > 0:
+            n = await self.loop.sock_recv_into(self.sock, self.view[:min(size, len(self.chunk))])
+            if not n:
+                raise EOFError()
+            await dst.send(self.view[:n])
+            size -= n
+
+    async def copy_chunked(self, dst: "BufferedSocket") -> None:
+        while True:
+            line = await self.read_until(b"\r\n")
+            await dst.send(line)
+            try:
+                size = int(line.split(b";", 1)[0].strip() or b"0", 16)
+            except ValueError:
+                raise ProxyError("Bad chunk size")
+            if size == 0:
+                break
+            await self.copy(dst, size + 2)
+        while True:
+            line = await self.read_until(b"\r\n")
+            await dst.send(line)
+            if line == b"\r\n":
+                return
+
+    async def pipe(self, dst: "BufferedSocket") -> None:
+        """
+        Relays until EOF, then half-closes ``dst``.
+        """
+        if self.pending:
+            await dst.send(bytes(self.pending))
+            self.pending.clear()
+        try:
+            while True:
+                n = await self.loop.sock_recv_into(self.sock, self.chunk)
+                if not n:
+                    break
+                await dst.send(self.view[:n])
+        except OSError:
+            pass
+        finally:
+            try:
+                dst.sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+def split_authority(authority: str, default_port: int) -> Tuple[str, int]:
+    """
+    Splits "host:port" (or "[v6]:port") into (host, port).
+
+    Raises:
+        BadRequest - If the host is missing or the port is not valid.
+    """
+    if authority.rfind(":") > authority.rfind("]"):
+        host, _, port = authority.rpartition(":")
+    else:
+        host, port = authority, ""
+    host = host.strip("[]")
+    if not host:
+        raise BadRequest("Missing host")
+    if not port:
+        return host, default_port
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        raise BadRequest("Bad port {!r}".format(port))
+    return host, int(port)
+
+
+class UpstreamPool(object):
+    """
+    Idle keep-alive upstream connections plus a concurrency limit, both
+    per upstream (host, port).
+    """
+
+    def __init__(self, limit: int=64, max_idle: int=64, connect_timeout: float=10.0):
+        self.limit = limit
+        self.max_idle = max_idle
+        self.connect_timeout = connect_timeout
+        self.idle = {}
+        self.semaphores = {}
+
+    def semaphore(self, key: Tuple[str, int]) -> asyncio.Semaphore:
+        sem = self.semaphores.get(key)
+        if sem is None:
+            sem = self.semaphores[key] = asyncio.Semaphore(self.limit)
+        return sem
+
+    async def connect(self, key: Tuple[str, int], bufsize: int,
+                      fresh: bool=False) -> Tuple[BufferedSocket, bool]:
+        """
+        Returns:
+            tuple - The connection and whether it was reused.
+        """
+        idle = None if fresh else self.idle.get(key)
+        while idle:
+            conn = idle.pop()
+            if conn.pending:
+                conn.close()
+                continue
+            return conn, True
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(key[0], key[1], type=socket.SOCK_STREAM)
+        error = None
+        for family, kind, proto, _, addr in infos:
+            sock = socket.socket(family, kind, proto)
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                await asyncio.wait_for(loop.sock_connect(sock, addr), self.connect_timeout)
+                return BufferedSocket(sock, bufsize), False
+            except (OSError, asyncio.TimeoutError) as e:
+                sock.close()
+                error = e
+        raise ProxyError("Cannot connect to {}:{}: {}".format(key[0], key[1], error))
+
+    def release(self, key: Tuple[str, int], conn: BufferedSocket) -> None:
+        idle = self.idle.setdefault(key, [])
+        if len(idle) < self.max_idle:
+            idle.append(conn)
+        else:
+            conn.close()
+
+    def close(self) -> None:
+        for conns in self.idle.values():
+            for conn in conns:
+                conn.close()
+        self.idle.clear()
+
+
+class ForwardingProxy(object):
+    """
+    HTTP/1.1 forward proxy; CONNECT requests become byte tunnels, other
+    requests are forwarded with keep-alive on both sides.
+    """
+
+    BAD_GATEWAY = b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+    BAD_REQUEST = b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+    ESTABLISHED = b"HTTP/1.1 200 Connection Established\r\n\r\n"
+
+    def __init__(self, engine: PacEngine, host: str="127.0.0.1", port: int=0,
+                 pool: UpstreamPool=None, bufsize: int=65536):
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self.pool = pool if pool is not None else UpstreamPool()
+        self.bufsize = bufsize
+        self.sock = None
+        self.loop = None
+        self.thread = None
+        self.accepting = None
+        self.tasks = set()
+        self.evaluator = None # type: ThreadPoolExecutor
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def address(self) -> str:
+        return "{}:{}".format(self.host, self.port)
+
+    async def routes(self, url: str) -> List[Route]:
+        """
+        Cached decisions are answered inline; the script itself runs off the
+        event loop, since a dnsResolve() miss blocks for the lookup and must
+        not stall the other connections. A single evaluator thread keeps
+        script runs serialised.
+        """
+        answer = self.engine.cached(url)
+        if answer is None:
+            loop = asyncio.get_running_loop()
+            answer = await loop.run_in_executor(self.evaluator, self.engine.compute, url)
+        return parse_pac_answer(answer)
+
+    async def open_upstream(self, routes: List[Route], target: Tuple[str, int],
+                            tunnel: bool) -> Tuple[BufferedSocket, Tuple[str, int], Route, bool]:
+        """
+        Connects to the first reachable route. The upstream's concurrency
+        slot is held on return and must be given back with release_slot().
+        """
+        error = None
+        for route in routes:
+            key = target if route is None else route
+            sem = self.pool.semaphore(key)
+            await sem.acquire()
+            try:
+                conn, reused = await self.pool.connect(key, self.bufsize, fresh=tunnel)
+                if tunnel and route is not None:
+                    await conn.send("CONNECT {0}:{1} HTTP/1.1\r\nHost: {0}:{1}\r\n\r\n".format(*target)
+                                    .encode("latin-1"))
+                    status, _ = parse_head(await conn.read_until(b"\r\n\r\n"))
+                    if status[1] != b"200":
+                        conn.close()
+                        raise ProxyError("Upstream refused CONNECT")
+                return conn, key, route, reused
+            except (HttpError, OSError, EOFError) as e:
+                sem.release()
+                error = e
+        raise ProxyError(str(error))
+
+    def release_slot(self, key: Tuple[str, int]) -> None:
+        self.pool.semaphore(key).release()
+
+    async def tunnel(self, client: BufferedSocket, target: bytes) -> None:
+        dest = split_authority(target.decode("latin-1"), 443)
+        routes = await self.routes("https://{}/".format(dest[0]))
+        upstream, key, _, _ = await self.open_upstream(routes, dest, True)
+        try:
+            await client.send(self.ESTABLISHED)
+            await asyncio.gather(client.pipe(upstream), upstream.pipe(client))
+        finally:
+            upstream.close()
+            self.release_slot(key)
+
+    async def relay_response(self, upstream: BufferedSocket, client: BufferedSocket,
+                             status_head: bytes, method: bytes,
+                             client_close: bool, interim: bool=True) -> Tuple[bool, bool]:
+        """
+        Relays a response whose head was read already. Interim 1xx responses
+        (e.g. 100 Continue) are passed on, to HTTP/1.1 clients only with
+        ``interim``, until the final response arrives.
+
+        Returns:
+            tuple - Whether the client and the upstream connections can be
+            reused.
+        """
+        status, headers = parse_head(status_head)
+        while status[1].startswith(b"1") and status[1] != b"101":
+            if interim:
+                await client.send(b"".join([b"HTTP/1.1 ", status[1], b" ", status[2], b"\r\n"]
+                                           + end_to_end(headers) + [b"\r\n"]))
+            status, headers = parse_head(await upstream.read_until(b"\r\n\r\n"))
+        upstream_close = b"close" in connection_options(headers)
+        length = content_length(headers)
+        chunked = b"chunked" in (header(headers, b"transfer-encoding") or b"").lower()
+        bodiless = method == b"HEAD" or status[1] in (b"204", b"304") or status[1].startswith(b"1")
+        delimited = bodiless or chunked or length is not None
+        keep = delimited and not client_close
+        out = [b"HTTP/1.1 ", status[1], b" ", status[2], b"\r\n"]
+        out.extend(end_to_end(headers))
+        out.append(b"Connection: keep-alive\r\n\r\n" if keep else b"Connection: close\r\n\r\n")
+        await client.send(b"".join(out))
+        if bodiless:
+            pass
+        elif chunked:
+            await upstream.copy_chunked(client)
+        elif length is not None:
+            await upstream.copy(client, length)
+        else:
+            await upstream.pipe(client)
+        return keep, delimited and not upstream_close
+
+    async def forward(self, client: BufferedSocket, first: List[bytes],
+                      headers: List[Tuple[bytes, bytes, bytes]]) -> bool:
+        """
+        Forwards one request and its response.
+
+        Returns:
+            bool - Whether the client connection can be reused.
+        """
+        method, target, version = first
+        url = target.decode("latin-1")
+        if not url.startswith("http://"):
+            raise BadRequest("Only absolute http:// URLs can be forwarded")
+        authority, _, path = url[7:].partition("/")
+        dest = split_authority(authority, 80)
+        routes = await self.routes(url)
+        client_close = b"close" in connection_options(headers) or version == b"HTTP/1.0"
+        kept = end_to_end(headers)
+        length = content_length(headers, BadRequest)
+        chunked = b"chunked" in (header(headers, b"transfer-encoding") or b"").lower()
+
+        for attempt in (0, 1):
+            upstream, key, route, reused = await self.open_upstream(routes, dest, False)
+            line = target if route is not None else b"/" + path.encode("latin-1")
+            head = b"".join([method, b" ", line, b" HTTP/1.1\r\n"]
+                            + kept
+                            + [b"Connection: keep-alive\r\n\r\n"])
+            try:
+                try:
+                    await upstream.send(head)
+                    if chunked:
+                        await client.copy_chunked(upstream)
+                    elif length is not None:
+                        await client.copy(upstream, length)
+                    status_head = await upstream.read_until(b"\r\n\r\n")
+                except (OSError, EOFError):
+                    upstream.close()
+                    # A pooled connection may have been closed by the peer;
+                    # retry bodiless requests once on a fresh one
+                    if reused and not attempt and length is None and not chunked:
+                        continue
+                    raise
+                try:
+                    keep, reusable = await self.relay_response(upstream, client, status_head, method,
+                                                               client_close, version != b"HTTP/1.0")
+                except BaseException:
+                    upstream.close()
+                    raise
+                if reusable:
+                    self.pool.release(key, upstream)
+                else:
+                    upstream.close()
+                return keep
+            finally:
+                self.release_slot(key)
+        return False
+
+    async def handle(self, sock: socket.socket) -> None:
+        client = BufferedSocket(sock, self.bufsize)
+        try:
+            while True:
+                try:
+                    head = await client.read_until(b"\r\n\r\n")
+                except EOFError:
+                    break
+                self.requests += 1
+                try:
+                    first, headers = parse_head(head)
+                except HttpError:
+                    await client.send(self.BAD_REQUEST)
+                    break
+                try:
+                    if first[0] == b"CONNECT":
+                        await self.tunnel(client, first[1])
+                        break
+                    if not await self.forward(client, first, headers):
+                        break
+                except BadRequest:
+                    self.errors += 1
+                    await client.send(self.BAD_REQUEST)
+                    break
+                except (HttpError, EOFError):
+                    self.errors += 1
+                    await client.send(self.BAD_GATEWAY)
+                    break
+        except OSError:
+            self.errors += 1
+        finally:
+            client.close()
+
+    async def serve(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            sock, _ = await loop.sock_accept(self.sock)
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            task = loop.create_task(self.handle(sock))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def start(self) -> "ForwardingProxy":
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(1024)
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+        self.evaluator = ThreadPoolExecutor(1, thread_name_prefix="ipsx-pac")
+        self.accepting = asyncio.get_running_loop().create_task(self.serve())
+        return self
+
+    async def stop(self) -> None:
+        if self.accepting is not None:
+            self.accepting.cancel()
+            for task in list(self.tasks):
+                task.cancel()
+            await asyncio.gather(self.accepting, *self.tasks, return_exceptions=True)
+            self.accepting = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.evaluator is not None:
+            self.evaluator.shutdown()
+            self.evaluator = None
+        self.pool.close()
+
+    def start_in_thread(self) -> "ForwardingProxy":
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            self.loop.run_until_complete(self.start())
+            ready.set()
+            self.loop.run_forever()
+            self.loop.run_until_complete(self.stop())
+            self.loop.close()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self
+
+    def stop_thread(self) -> None:
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop = self.thread = None
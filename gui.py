@@ -20,12 +20,21 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import os
 import wx
 
 from typing import Callable
-from res import APP_CONFIG, OK, BACKUP_REG, BACKUP_ERR, INVALID_URL
-from proxy import ProxyHelper
-from util import validate_pac_url, history_log, history_init
+from res import APP_CONFIG, INVALID_URL, WPAD_ERR, WPAD_CACHE
+from res import PAC_CACHE_DIR, MIRROR_CHECK_INTERVAL, METRICS_FILE
+from proxy import ProxyHelper, Result
+from profiles import Profile
+from pacfetch import PacFetcher, DiskCache
+from res import HISTORY_TAIL
+from util import validate_pac_url, history_log, history
+from worker import Worker
+from mirrors import MirrorSet, HealthMonitor
+from wpad import WpadDiscovery, WpadCache
+from metrics import METRICS
 
 
 class IPSXFrame(wx.Frame):
@@ -33,7 +42,7 @@ class IPSXFrame(wx.Frame):
     IP.SX Main Frame for GUI.
     """
 
-    LABEL = "IP.SX proxy auto config URI"
+    LABEL = "IP.SX proxy auto config URI (mirrors: space separated)"
 
     INPUT_STYLE = {
         "flag": wx.ALL | wx.ALIGN_CENTER_VERTICAL,
@@ -50,17 +59,52 @@ class IPSXFrame(wx.Frame):
         "size": (130, -1)
     }
 
+    DETECT_BTN_STYLE = {
+        "label": "Detect",
+        "size": (60, -1)
+    }
+
+    SWITCH_BTN_STYLE = {
+        "label": "Switch",
+        "size": (60, -1)
+    }
+
+    SAVE_PROFILE_BTN_STYLE = {
+        "label": "Save...",
+        "size": (60, -1)
+    }
+
+    OLDER_BTN_STYLE = {
+        "label": "Load older entries",
+        "size": (260, -1)
+    }
+
+    FRAME_STYLE = wx.DEFAULT_FRAME_STYLE ^ wx.RESIZE_BORDER
+
+    # Worker keys of the jobs that read or change the proxy settings; each
+    # operation has its own key, so only repeats of that job coalesce
+    SETTINGS_JOBS = ("pac_link", "install", "install_fastest", "restore", "switch")
+
     DIALOG_PROPS = (
         "Info", wx.OK
     )
 
     def __init__(self):
-        wx.Frame.__init__(self, None, **APP_CONFIG)
+        wx.Frame.__init__(self, None, style=self.FRAME_STYLE, **APP_CONFIG)
+        self.fetcher = PacFetcher(DiskCache(PAC_CACHE_DIR))
+        self.worker = Worker(self._dispatch)
+        self.closing = False
+        self.monitor = None
+        self.health_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self._health_timer_cb, self.health_timer)
+        self.worker.submit(None, ProxyHelper.recover, callback=self._recovered_cb)
         self.panel = wx.Panel(self)
         self.sizer = wx.GridBagSizer(vgap=0, hgap=5)
         self.setup()
         self.panel.SetSizerAndFit(self.sizer)
-        self.statusbar = self.CreateStatusBar()
+        self.statusbar = self.CreateStatusBar(2)
+        self.statusbar.SetStatusWidths([-3, -2])
+        self.Bind(wx.EVT_CLOSE, self._close_cb)
         self.Show(True)
 
     def setup(self):
@@ -68,38 +112,173 @@ class IPSXFrame(wx.Frame):
         self.create_enable_btn()
         self.create_disable_btn()
         self.create_pac_input()
+        self.create_profiles()
         self.create_history()
         sizer_input = wx.BoxSizer(wx.VERTICAL)
         sizer_btns = wx.BoxSizer(wx.HORIZONTAL)
+        sizer_profiles = wx.BoxSizer(wx.HORIZONTAL)
         sizer_input.Add(self.label)
-        sizer_input.Add(self.pac_link_input)
+        sizer_link = wx.BoxSizer(wx.HORIZONTAL)
+        sizer_link.Add(self.pac_link_input, 1)
+        sizer_link.Add(self.detect_btn)
+        sizer_input.Add(sizer_link, 0, wx.EXPAND)
         sizer_btns.Add(self.enable_btn)
         sizer_btns.Add(self.disable_btn)
+        sizer_profiles.Add(self.profile_choice, 1)
+        sizer_profiles.Add(self.switch_btn)
+        sizer_profiles.Add(self.save_profile_btn)
         self.sizer.Add(sizer_input, pos=(0, 0), border=5, flag=wx.ALL|wx.EXPAND)
         ln = wx.StaticLine(self.panel, -1, style=wx.LI_HORIZONTAL)
         self.sizer.Add(ln, pos=(1, 0), border=5, flag=wx.ALL|wx.EXPAND)
         self.sizer.Add(sizer_btns, pos=(2, 0), border=5, flag=wx.ALL|wx.EXPAND)
-        self.sizer.Add(self.history, pos=(3, 0), border=5, flag=wx.ALL|wx.EXPAND)
+        self.sizer.Add(sizer_profiles, pos=(3, 0), border=5, flag=wx.ALL|wx.EXPAND)
+        self.sizer.Add(self.history, pos=(4, 0), border=5, flag=wx.ALL|wx.EXPAND)
+        self.sizer.Add(self.older_btn, pos=(5, 0), border=5, flag=wx.LEFT|wx.RIGHT|wx.EXPAND)
 
     def create_header(self):
         pass
 
     def create_history(self):
-        self.history = wx.TextCtrl(self.panel, wx.ID_ANY, style=wx.TE_MULTILINE|wx.TE_READONLY, size=(260, 180))
-        ok, txt = history_init()
-        if not ok:
-            txt = "...\n"
-        self.history.SetValue(txt)
+        self.history = wx.TextCtrl(self.panel, wx.ID_ANY, style=wx.TE_MULTILINE|wx.TE_READONLY, size=(260, 150))
+        self.older_btn = wx.Button(self.panel, wx.ID_ANY, **self.OLDER_BTN_STYLE)
+        self.older_btn.Disable()
+        self.Bind(wx.EVT_BUTTON, self._older_history_cb, self.older_btn)
+        self.history.SetValue("...\n")
+        self.worker.submit("history", lambda: history().tail(HISTORY_TAIL), callback=self._history_loaded_cb)
+
+    def _history_loaded_cb(self, result: Result):
+        records, self.history_cursor = result.value if result else ([], None)
+        self.history.SetValue("".join("{}\n".format(r) for r in records) or "...\n")
+        self.older_btn.Enable(self.history_cursor is not None)
+
+    def _older_history_cb(self, event):
+        self.older_btn.Disable()
+        cursor = self.history_cursor
+        self.worker.submit("history", lambda: history().older(cursor, HISTORY_TAIL),
+                           callback=self._older_loaded_cb)
+
+    def _older_loaded_cb(self, result: Result):
+        records, self.history_cursor = result.value if result else ([], None)
+        self.older_btn.Enable(self.history_cursor is not None)
+        self.history.SetInsertionPoint(0)
+        self.history.WriteText("".join("{}\n".format(r) for r in records))
+        self.history.ShowPosition(0)
+
+    def _close_cb(self, event):
+        self.closing = True
+        self.health_timer.Stop()
+        # Pending history appends still run, so the session's last events
+        # reach the log
+        self.worker.shutdown(drain=True)
+        self.fetcher.close()
+        history().close()
+        try:
+            METRICS.save(METRICS_FILE)
+        except OSError:
+            pass
+        event.Skip()
+
+    def _dispatch(self, callback: Callable[[Result], None], result: Result):
+        # Called on the worker thread
+        wx.CallAfter(self._deliver, callback, result)
+
+    def _deliver(self, callback: Callable[[Result], None], result: Result):
+        if self and not self.closing:
+            callback(result)
+
+    def _recovered_cb(self, result: Result):
+        if result.message:
+            self.log_event(result.message)
 
     def create_pac_input(self):
         self.label = wx.StaticText(self.panel, wx.ID_ANY, self.LABEL)
-        self.pac_link_input = wx.TextCtrl(self.panel, wx.ID_ANY, size=(260, -1))
-        proxy = ProxyHelper.read_pac_link()
+        self.pac_link_input = wx.TextCtrl(self.panel, wx.ID_ANY, size=(200, -1))
+        self.detect_btn = wx.Button(self.panel, wx.ID_ANY, **self.DETECT_BTN_STYLE)
+        self.Bind(wx.EVT_BUTTON, self._detect_cb, self.detect_btn)
+        self.enable_btn.Disable()
+        self.disable_btn.Disable()
+        self.worker.submit("pac_link", ProxyHelper.read_pac_link, callback=self._pac_link_cb)
+
+    def _pac_link_cb(self, result: Result):
+        proxy = result.value or ProxyHelper.EMPTY_STRING
         if len(proxy) > 0:
-            self.enable_btn.Disable()
             self.pac_link_input.SetValue(proxy)
+        self._set_installed(len(proxy) > 0)
+
+    def _detect_cb(self, event):
+        cache = WpadCache(os.path.join(ProxyHelper.backup_file, WPAD_CACHE))
+        self.detect_btn.Disable()
+        self.statusbar.SetStatusText("Looking for a WPAD server...")
+        self.worker.submit("detect", lambda: WpadDiscovery(cache=cache).discover(),
+                           callback=self._detected_cb)
+
+    def _detected_cb(self, result: Result):
+        self.detect_btn.Enable()
+        if not result.value:
+            self.alert_dialog(result.error or WPAD_ERR)
+            return
+        # Filled in only; installing stays the user's call
+        self.pac_link_input.SetValue(result.value)
+        self.log_event("Discovered {}".format(result.value))
+
+    def create_profiles(self):
+        self.profile_choice = wx.Choice(self.panel, wx.ID_ANY, size=(130, -1))
+        self.switch_btn = wx.Button(self.panel, wx.ID_ANY, **self.SWITCH_BTN_STYLE)
+        self.save_profile_btn = wx.Button(self.panel, wx.ID_ANY, **self.SAVE_PROFILE_BTN_STYLE)
+        self.switch_btn.Disable()
+        self.Bind(wx.EVT_BUTTON, self._switch_profile_cb, self.switch_btn)
+        self.Bind(wx.EVT_BUTTON, self._save_profile_cb, self.save_profile_btn)
+        self._load_profiles()
+
+    def _load_profiles(self):
+        self.worker.submit("profiles", lambda: (ProxyHelper.profiles().names(), ProxyHelper.active_profile()),
+                           callback=self._profiles_loaded_cb)
+
+    def _profiles_loaded_cb(self, result: Result):
+        names, active = result.value if result else ([], "")
+        self.profile_choice.SetItems(names)
+        if active in names:
+            self.profile_choice.SetStringSelection(active)
+        elif names:
+            self.profile_choice.SetSelection(0)
+        busy = any(self.worker.busy(key) for key in self.SETTINGS_JOBS)
+        self.switch_btn.Enable(len(names) > 0 and not busy)
+
+    def _switch_profile_cb(self, event):
+        name = self.profile_choice.GetStringSelection()
+        if not name:
+            return
+        self._stop_health_checks()
+        self._set_busy("Switching to {}...".format(name))
+        self.worker.submit("switch", ProxyHelper.switch_profile, name, callback=self._profile_switched_cb)
+
+    def _profile_switched_cb(self, result: Result):
+        profile = ProxyHelper.profiles().get(result.value) if result else None
+        if profile is not None:
+            self.pac_link_input.SetValue(profile.pac_url)
+            self._set_installed(bool(profile.pac_url or profile.proxy_server))
         else:
-            self.disable_btn.Disable()
+            self._set_installed(len(self.pac_link_input.GetValue().strip()) > 0)
+        self._show_timing("proxy.switch_profile")
+        self.alert_dialog(result.message)
+
+    def _save_profile_cb(self, event):
+        link = self.pac_link_input.GetValue().strip()
+        if link and not validate_pac_url(link):
+            self.alert_dialog(INVALID_URL)
+            return
+        dialog = wx.TextEntryDialog(self, "Profile name for {}".format(link or "a direct connection"),
+                                    "Save profile")
+        name = dialog.GetValue().strip() if dialog.ShowModal() == wx.ID_OK else ""
+        dialog.Destroy()
+        if name:
+            # No key: a save must never be coalesced into a pending reload
+            self.worker.submit(None, ProxyHelper.save_profile, Profile(name, link),
+                               callback=self._profile_saved_cb)
+
+    def _profile_saved_cb(self, result: Result):
+        self.log_event(result.message)
+        self._load_profiles()
 
     def create_enable_btn(self):
         self.enable_btn = wx.Button(self.panel, wx.ID_ANY, **self.ENABLE_BTN_STYLE)
@@ -111,41 +290,86 @@ class IPSXFrame(wx.Frame):
         self.Bind(wx.EVT_BUTTON, self._disable_proxy_cb, self.disable_btn)
 
     def _enable_proxy_cb(self, event):
-        link = self.pac_link_input.GetValue()
-        if not validate_pac_url(link):
+        links = MirrorSet.split(self.pac_link_input.GetValue())
+        mirrors = MirrorSet(links)
+        if not mirrors.urls or mirrors.invalid:
             self.alert_dialog(INVALID_URL)
             return
-        ok, err = ProxyHelper.backup()
-        if not ok:
-            ProxyHelper.last_error = BACKUP_ERR.format(err)
-        else:
-            self._invoke_helper(ProxyHelper.install_pac_file, link)
-            self.enable_btn.Disable()
-            self.disable_btn.Enable()
-        self.alert_dialog()
+        if len(mirrors.urls) == 1:
+            self._set_busy("Installing PAC file...")
+            self.worker.submit("install", ProxyHelper.backup_and_install, mirrors.urls[0], self.fetcher,
+                               callback=self._applied_cb)
+            return
+        self._set_busy("Probing {} mirrors...".format(len(mirrors.urls)))
+        self.worker.submit("install_fastest", ProxyHelper.install_fastest, mirrors,
+                           callback=lambda result: self._mirror_applied_cb(mirrors, result))
 
     def _disable_proxy_cb(self, event):
-        self._invoke_helper(ProxyHelper.restore_defaults)
-        self.alert_dialog()
+        self._stop_health_checks()
+        self._set_busy("Restoring configuration...")
+        self.worker.submit("restore", ProxyHelper.restore_defaults, callback=self._restored_cb)
+
+    def _applied_cb(self, result: Result):
+        self._set_installed(result.ok)
+        self._show_timing("proxy.backup_and_install")
+        self.alert_dialog(result.message)
+
+    def _mirror_applied_cb(self, mirrors: MirrorSet, result: Result):
+        self._set_installed(result.ok)
+        self._show_timing("proxy.install_fastest")
+        self.alert_dialog(result.message)
+        if result:
+            self.monitor = HealthMonitor(mirrors, result.value.url, ProxyHelper.install_pac_file)
+            self.health_timer.Start(MIRROR_CHECK_INTERVAL * 1000)
+
+    def _stop_health_checks(self):
+        self.health_timer.Stop()
+        if self.monitor is not None:
+            self.monitor.stop()
+            self.monitor = None
+
+    def _health_timer_cb(self, event):
+        if self.monitor is not None:
+            monitor = self.monitor
+            self.worker.submit("health", monitor.check, callback=lambda result: self._health_cb(monitor, result))
+
+    def _health_cb(self, monitor: HealthMonitor, result: Result):
+        if monitor is not self.monitor or not result or result.value is None:
+            return
+        self.log_event("Switched PAC mirror to {}".format(result.value.url))
+
+    def _restored_cb(self, result: Result):
+        self._set_installed(not result.ok)
+        self._show_timing("proxy.restore_defaults")
+        self.alert_dialog(result.message)
+
+    def _show_timing(self, operation: str):
+        summary = METRICS.summary(operation)
+        self.statusbar.SetStatusText("p50 {:.1f} ms / p99 {:.1f} ms".format(
+            summary["p50_us"] / 1e3, summary["p99_us"] / 1e3), 1)
+
+    def _set_busy(self, message: str):
+        self.enable_btn.Disable()
         self.disable_btn.Disable()
-        self.enable_btn.Enable()
+        self.switch_btn.Disable()
+        self.save_profile_btn.Disable()
+        self.statusbar.SetStatusText(message)
 
-    def _invoke_helper(self, cb: Callable, *args: str) -> str:
-        if cb(*args).save() is not OK:
-            return ProxyHelper.get_last_error()
-        return ProxyHelper.get_last_status()
+    def _set_installed(self, installed: bool):
+        self.enable_btn.Enable(not installed)
+        self.disable_btn.Enable(installed)
+        self.switch_btn.Enable(self.profile_choice.GetCount() > 0)
+        self.save_profile_btn.Enable()
 
-    def alert_dialog(self, message: str=""):
-        if message == ProxyHelper.EMPTY_STRING:
-            message = ProxyHelper.get_last_status()
+    def alert_dialog(self, message: str):
         self.log_event(message)
         alert = wx.MessageDialog(self, message, *self.DIALOG_PROPS)
         alert.ShowModal()
         alert.Destroy()
 
-    def log_event(self, event):
+    def log_event(self, event: str):
         self.statusbar.SetStatusText(event)
         self.history.AppendText("{}\n".format(event))
-        ok, txt = history_log("{}\n".format(event))
-        if not ok:
-            pass # TODO: handle this
+        # Queued behind the operation that produced it, so the file keeps
+        # the on-screen order
+        self.worker.submit(None, history_log, event)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import mmap
+import time
+import struct
+import datetime
+import threading
+
+from typing import List, Tuple
+
+
+class HistoryRecord(object):
+    """
+    One history entry, stored as a ``timestamp<TAB>kind<TAB>message`` line.
+    Lines written by older versions (bare messages) parse as "event" records
+    without timestamp.
+    """
+
+    __slots__ = ("timestamp", "kind", "message")
+
+    ESCAPES = (("\\", "\\\\"), ("\n", "\\n"), ("\t", "\\t"))
+
+    def __init__(self, message: str, kind: str="event", timestamp: str=""):
+        self.timestamp = timestamp
+        self.kind = kind
+        self.message = message
+
+    def encode(self) -> bytes:
+        message = self.message
+        for raw, escaped in self.ESCAPES:
+            message = message.replace(raw, escaped)
+        return "{}\t{}\t{}\n".format(self.timestamp, self.kind, message).encode("utf-8")
+
+    @classmethod
+    def decode(cls, line: bytes) -> "HistoryRecord":
+        text = line.decode("utf-8", "replace").rstrip("\n")
+        parts = text.split("\t", 2)
+        if len(parts) != 3:
+            return cls(text)
+        message = parts[2]
+        if "\\" in message:
+            out, i = [], 0
+            while i < len(message):
+                c = message[i]
+                if c == "\\" and i + 1 < len(message):
+                    i += 1
+                    c = {"n": "\n", "t": "\t"}.get(message[i], message[i])
+                out.append(c)
+                i += 1
+            message = "".join(out)
+        return cls(message, parts[1], parts[0])
+
+    def __str__(self) -> str:
+        return self.message
+
+
+class HistoryLog(object):
+    """
+    Append-only history file with size based rotation.
+
+    The writer keeps its handle open and flushes every ``flush_every``
+    records or ``flush_interval`` seconds. Next to each segment, a small
+    index (``<file>.idx``) holds the byte offset of every ``page``-th
+    record as little-endian uint64s, so pages are found without scanning.
+    Readers memory-map the segment and only touch the bytes they return,
+    so opening the log costs the same whatever its size.
+
+    Rotated segments are named ``<file>.1`` (newest) to ``<file>.<backups>``.
+
+    Writes come from the GUI worker and the monitor threads; a lock keeps
+    each record, its index entry and rotation in one piece.
+    """
+
+    OFFSET = struct.Struct("<Q")
+
+    def __init__(self, filepath: str, max_bytes: int=1 << 20, backups: int=3,
+                 page: int=64, flush_every: int=8, flush_interval: float=1.0):
+        self.filepath = filepath
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.page = page
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.file = None
+        self.index = None
+        self.unflushed = 0
+        self.flushed_at = time.monotonic()
+        self.lock = threading.RLock()
+        self.size, self.count = self._scan(filepath)
+
+    @staticmethod
+    def index_path(segment: str) -> str:
+        return segment + ".idx"
+
+    def segment(self, number: int) -> str:
+        return self.filepath if number == 0 else "{}.{}".format(self.filepath, number)
+
+    def _offsets(self, segment: str) -> List[int]:
+        try:
+            with open(self.index_path(segment), "rb") as file_:
+                data = file_.read()
+        except OSError:
+            return None
+        usable = len(data) - len(data) % self.OFFSET.size
+        return [o for o, in self.OFFSET.iter_unpack(data[:usable])]
+
+    def _rebuild_index(self, segment: str) -> List[int]:
+        """
+        Indexes a segment written without one (e.g. by older versions).
+        """
+        offsets, offset, count = [], 0, 0
+        with open(segment, "rb") as file_:
+            for line in file_:
+                if count % self.page == 0:
+                    offsets.append(offset)
+                offset += len(line)
+                count += 1
+        with open(self.index_path(segment), "wb") as file_:
+            file_.write(b"".join(self.OFFSET.pack(o) for o in offsets))
+        return offsets
+
+    def _scan(self, segment: str) -> Tuple[int, int]:
+        """
+        Returns:
+            tuple - Size in bytes and record count of a segment; only the
+            records after the last indexed page are read.
+        """
+        try:
+            size = os.path.getsize(segment)
+        except OSError:
+            return 0, 0
+        offsets = self._offsets(segment)
+        if offsets is None or (offsets and offsets[-1] > size) or (size and not offsets):
+            offsets = self._rebuild_index(segment)
+        if not offsets:
+            return size, 0
+        with open(segment, "rb") as file_:
+            file_.seek(offsets[-1])
+            rest = sum(1 for _ in file_)
+        return size, (len(offsets) - 1) * self.page + rest
+
+    # ------------------------------------------------------------------
+    # Writer
+    # ------------------------------------------------------------------
+
+    def _open(self) -> None:
+        if self.file is None:
+            self.file = open(self.filepath, "ab")
+            self.index = open(self.index_path(self.filepath), "ab")
+
+    def append(self, message: str, kind: str="event") -> HistoryRecord:
+        """
+        Adds a record; it reaches the disk on the next batched flush.
+        """
+        record = HistoryRecord(message, kind, datetime.datetime.now().isoformat(timespec="seconds"))
+        data = record.encode()
+        with self.lock:
+            if self.size and self.size + len(data) > self.max_bytes:
+                self.rotate()
+            self._open()
+            if self.count % self.page == 0:
+                self.index.write(self.OFFSET.pack(self.size))
+            self.file.write(data)
+            self.size += len(data)
+            self.count += 1
+            self.unflushed += 1
+            now = time.monotonic()
+            if self.unflushed >= self.flush_every or now - self.flushed_at >= self.flush_interval:
+                self.flush()
+        return record
+
+    def flush(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+                self.index.flush()
+            self.unflushed = 0
+            self.flushed_at = time.monotonic()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.flush()
+                self.file.close()
+                self.index.close()
+                self.file = self.index = None
+
+    def rotate(self) -> None:
+        with self.lock:
+            self.close()
+            for number in range(self.backups, 0, -1):
+                src = self.segment(number - 1)
+                if not os.path.exists(src):
+                    continue
+                dst = self.segment(number)
+                os.replace(src, dst)
+                if os.path.exists(self.index_path(src)):
+                    os.replace(self.index_path(src), self.index_path(dst))
+            if self.backups == 0:
+                for path in (self.filepath, self.index_path(self.filepath)):
+                    if os.path.exists(path):
+                        os.remove(path)
+            self.size = self.count = 0
+
+    # ------------------------------------------------------------------
+    # Readers
+    # ------------------------------------------------------------------
+
+    def _read(self, segment: str, end: int, count: int) -> Tuple[List[HistoryRecord], int]:
+        """
+        Reads up to ``count`` records ending at byte ``end`` of a segment.
+
+        Returns:
+            tuple - The records (oldest first) and the offset of the first.
+        """
+        if end <= 0 or count <= 0:
+            return [], 0
+        with open(segment, "rb") as file_:
+            with mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                end = min(end, len(view))
+                start = end
+                for _ in range(count):
+                    if start <= 0:
+                        break
+                    start = view.rfind(b"\n", 0, start - 1) + 1
+                lines = view[start:end].splitlines(True)
+        return [HistoryRecord.decode(l) for l in lines], start
+
+    def tail(self, count: int) -> Tuple[List[HistoryRecord], Tuple[int, int]]:
+        """
+        Returns:
+            tuple - The last ``count`` records and a cursor for older().
+        """
+        with self.lock:
+            self.flush()
+            end = self.size if os.path.exists(self.filepath) else 0
+        return self.older((0, end), count)
+
+    def older(self, cursor: Tuple[int, int], count: int) -> Tuple[List[HistoryRecord], Tuple[int, int]]:
+        """
+        Loads up to ``count`` records preceding ``cursor``, continuing into
+        rotated segments.
+
+        Returns:
+            tuple - The records (oldest first) and the cursor before them;
+            None once the beginning of the history is reached.
+        """
+        if cursor is None:
+            return [], None
+        number, end = cursor
+        records = []
+        while len(records) < count and number <= self.backups:
+            segment = self.segment(number)
+            if not os.path.exists(segment):
+                break
+            if end is None:
+                end = os.path.getsize(segment)
+            chunk, start = self._read(segment, end, count - len(records))
+            records[:0] = chunk
+            if start > 0:
+                return records, (number, start)
+            number, end = number + 1, None
+        if number <= self.backups and os.path.exists(self.segment(number)):
+            return records, (number, end)
+        return records, None
+
+    def page_at(self, number: int) -> List[HistoryRecord]:
+        """
+        Returns the ``number``-th page (of ``page`` records) of the current
+        segment, located through the offset index.
+        """
+        with self.lock:
+            self.flush()
+            offsets = self._offsets(self.filepath) or []
+            size = self.size
+        if number >= len(offsets):
+            return []
+        end = offsets[number + 1] if number + 1 < len(offsets) else size
+        with open(self.filepath, "rb") as file_:
+            file_.seek(offsets[number])
+            data = file_.read(end - offsets[number])
+        return [HistoryRecord.decode(l) for l in data.splitlines(True)]
@@ -0,0 +1,149 @@
+# #!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+from res import BACKUP_ERR, HIVE_WORKERS
+from backend import RegistryBackend, HKEY_USERS
+from proxy import ProxyHelper, Result
+
+
+# Hives of real users: local and domain accounts, and Azure AD ones. The
+# service accounts (S-1-5-18/19/20), .DEFAULT and the *_Classes hives have
+# no Internet Settings of their own.
+USER_SID_PREFIXES = ("s-1-5-21-", "s-1-12-1-")
+CLASSES_SUFFIX = "_classes"
+
+
+def list_hives(backend: RegistryBackend) -> List[str]:
+    """
+    SIDs of the user hives loaded under HKEY_USERS, i.e. of the users that
+    are logged in or whose profile is otherwise loaded.
+    """
+    names = backend.enum_keys(HKEY_USERS, "")
+    return sorted(name for name in names
+                  if name.lower().startswith(USER_SID_PREFIXES) and not name.lower().endswith(CLASSES_SUFFIX))
+
+
+class HiveResult(object):
+    """
+    Outcome of an operation on one hive; ``backup`` is the version of the
+    backup taken just before it, if any.
+    """
+
+    __slots__ = ("sid", "result", "backup", "elapsed")
+
+    def __init__(self, sid: str, result: Result, backup: int=None, elapsed: float=0.0):
+        self.sid = sid
+        self.result = result
+        self.backup = backup
+        self.elapsed = elapsed
+
+    def to_dict(self) -> dict:
+        entry = {"sid": self.sid, "ok": self.result.ok, "backup": self.backup,
+                 "elapsed_ms": round(self.elapsed * 1000, 1)}
+        entry["status" if self.result.ok else "error"] = self.result.message
+        return entry
+
+
+class HiveReport(object):
+    """
+    Consolidated outcome of one operation over every hive.
+    """
+
+    def __init__(self, operation: str, results: List[HiveResult], elapsed: float):
+        self.operation = operation
+        self.results = results
+        self.elapsed = elapsed
+
+    @property
+    def failed(self) -> List[HiveResult]:
+        return [r for r in self.results if not r.result]
+
+    @property
+    def ok(self) -> bool:
+        return bool(self.results) and not self.failed
+
+    def to_dict(self) -> dict:
+        return {
+            "operation": self.operation,
+            "hives": len(self.results),
+            "succeeded": len(self.results) - len(self.failed),
+            "failed": len(self.failed),
+            "elapsed_ms": round(self.elapsed * 1000, 1),
+            "results": [r.to_dict() for r in self.results],
+        }
+
+
+class MultiUserApply(object):
+    """
+    Runs a ProxyHelper operation on every loaded user hive.
+
+    Each hive is handled by its own ProxyHelper.for_hive, so backups and
+    journals never collide: an interrupted change is recovered first, then
+    the settings are backed up, then the operation runs. Hives are processed
+    on a pool of at most ``workers`` threads, since the time goes to
+    registry round trips and backup writes rather than to Python code.
+    """
+
+    def __init__(self, helper: type=ProxyHelper, workers: int=HIVE_WORKERS, sids: List[str]=None):
+        self.helper = helper
+        self.workers = workers
+        self.sids = sids
+
+    def hives(self) -> List[str]:
+        if self.sids is not None:
+            return list(self.sids)
+        with self.helper.editor() as net:
+            return list_hives(net.backend)
+
+    def apply_one(self, sid: str, operation: Callable[[type], Result]) -> HiveResult:
+        helper = self.helper.for_hive(sid)
+        start = time.perf_counter()
+        backup = None
+        try:
+            recovered = helper.recover()
+            if not recovered:
+                result = recovered
+            else:
+                backup = helper.backup()
+                result = operation(helper) if backup else Result.failure(BACKUP_ERR.format(backup.error))
+        except Exception as e:
+            result = Result.failure(str(e))
+        version = backup.value if backup else None
+        return HiveResult(sid, result, version, time.perf_counter() - start)
+
+    def run(self, name: str, operation: Callable[[type], Result]) -> HiveReport:
+        start = time.perf_counter()
+        sids = self.hives()
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(sids) or 1)),
+                                thread_name_prefix="ipsx-hive") as pool:
+            results = list(pool.map(lambda sid: self.apply_one(sid, operation), sids))
+        return HiveReport(name, results, time.perf_counter() - start)
+
+    def install_pac_file(self, link: str) -> HiveReport:
+        return self.run("install", lambda helper: helper.install_pac_file(link))
+
+    def restore_defaults(self) -> HiveReport:
+        return self.run("restore", lambda helper: helper.restore_defaults())
@@ -0,0 +1,102 @@
+# #!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Parsing of HTTP/1.x message heads, shared by the forwarding proxy and the
+clients that speak raw HTTP (mirror checks, load generation).
+
+Headers are kept as (lower-case name, name, value) tuples, in their order.
+"""
+
+from typing import List, Optional, Set, Tuple
+
+
+HOP_BY_HOP = (b"connection", b"proxy-connection", b"keep-alive", b"proxy-authorization",
+              b"te", b"trailer", b"upgrade")
+
+
+class HttpError(Exception):
+    """
+    A message head that cannot be parsed.
+    """
+
+
+def parse_head(head: bytes) -> Tuple[List[bytes], List[Tuple[bytes, bytes, bytes]]]:
+    """
+    Splits a request/response head into its first line and a list of
+    (lower-case name, name, value) headers.
+    """
+    lines = head[:-4].split(b"\r\n")
+    first = lines[0].split(b" ", 2)
+    if len(first) != 3:
+        raise HttpError("Bad start line")
+    headers = []
+    for line in lines[1:]:
+        name, sep, value = line.partition(b":")
+        if not sep:
+            raise HttpError("Bad header")
+        name = name.strip()
+        headers.append((name.lower(), name, value.strip()))
+    return first, headers
+
+
+def header(headers: List[Tuple[bytes, bytes, bytes]], name: bytes) -> bytes:
+    for key, _, value in headers:
+        if key == name:
+            return value
+    return None
+
+
+def connection_options(headers: List[Tuple[bytes, bytes, bytes]]) -> Set[bytes]:
+    """
+    The lower-case tokens of the Connection and Proxy-Connection headers,
+    e.g. {b"close"} or {b"keep-alive", b"x-trace"}.
+    """
+    options = set()
+    for key, _, value in headers:
+        if key in (b"connection", b"proxy-connection"):
+            options.update(token.strip().lower() for token in value.split(b","))
+    return options
+
+
+def end_to_end(headers: List[Tuple[bytes, bytes, bytes]]) -> List[bytes]:
+    """
+    The header lines a proxy passes on: all but HOP_BY_HOP and the headers
+    the Connection header names.
+    """
+    hop = connection_options(headers).union(HOP_BY_HOP)
+    return [name + b": " + value + b"\r\n" for key, name, value in headers if key not in hop]
+
+
+def content_length(headers: List[Tuple[bytes, bytes, bytes]], error: type=HttpError) -> Optional[int]:
+    """
+    The Content-Length header as an int, None when absent.
+
+    Raises:
+        ``error`` - If the value is not a plain decimal number.
+    """
+    value = header(headers, b"content-length")
+    if value is None:
+        return None
+    if not value.isdigit():
+        raise error("Bad Content-Length")
+    return int(value)
@@ -0,0 +1,358 @@
+# #!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Load generator for the PAC delivery path.
+
+Replays a fleet of clients fetching the AutoConfigURL, e.g. a logon storm,
+against a PAC URL, optionally through a proxy. Arrivals are scheduled up
+front (open loop): a slow server does not slow the clients down, and
+latency is measured from each client's scheduled arrival, so queueing is
+not hidden (no coordinated omission). Service time, from the moment the
+request is actually sent, is reported separately.
+
+Run offline against the built-in stand-in origin:
+
+    python loadgen.py --origin --pattern storm --clients 5000 --duration 20
+"""
+
+import ssl
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+from metrics import FineHistogram
+from httphead import parse_head, header
+
+
+PERCENTILES = (50, 90, 99, 99.9, 99.99)
+
+
+def steady(rate: float, duration: float, rnd: random.Random) -> List[float]:
+    """
+    Poisson arrivals at ``rate`` per second.
+    """
+    arrivals, t = [], rnd.expovariate(rate)
+    while t < duration:
+        arrivals.append(t)
+        t += rnd.expovariate(rate)
+    return arrivals
+
+
+def ramp(rate: float, duration: float, rnd: random.Random) -> List[float]:
+    """
+    Poisson arrivals whose rate grows linearly from 0 to ``rate``.
+    """
+    # Thinning of a ``rate`` process: keep an arrival at t with p = t / duration
+    return [t for t in steady(rate, duration, rnd) if rnd.random() < t / duration]
+
+
+def storm(clients: int, duration: float, rnd: random.Random) -> List[float]:
+    """
+    ``clients`` logons within ``duration``: a sharp rise peaking at about a
+    fifth of the window, then a long tail (Beta(2, 5) distributed).
+    """
+    return sorted(duration * rnd.betavariate(2, 5) for _ in range(clients))
+
+
+PATTERNS = {"steady": steady, "ramp": ramp, "storm": storm}
+
+
+def schedule(pattern: str, duration: float, rate: float=100.0, clients: int=1000,
+             seed: int=1) -> List[float]:
+    """
+    Arrival offsets in seconds, in increasing order.
+    """
+    rnd = random.Random(seed)
+    if pattern == "storm":
+        return storm(clients, duration, rnd)
+    return PATTERNS[pattern](rate, duration, rnd)
+
+
+class LoadReport(object):
+    """
+    Outcome of a run: counts, an error breakdown, per-second timeline and
+    latency/service time histograms in microseconds.
+    """
+
+    def __init__(self, target: str, pattern: dict):
+        self.target = target
+        self.pattern = pattern
+        self.latency = FineHistogram()
+        self.service = FineHistogram()
+        self.statuses = Counter()
+        self.errors = Counter()
+        self.timeline = {} # type: Dict[int, Counter]
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    def record(self, second: int, latency: int, service: int, status: int, size: int) -> None:
+        self.latency.record(latency)
+        self.service.record(service)
+        self.statuses[str(status)] += 1
+        self.bytes += size
+        self.timeline.setdefault(second, Counter())["ok" if status < 400 else "failed"] += 1
+
+    def fail(self, second: int, kind: str) -> None:
+        self.errors[kind] += 1
+        self.timeline.setdefault(second, Counter())["failed"] += 1
+
+    @staticmethod
+    def summary(histogram: FineHistogram) -> dict:
+        result = {"p{}".format(p): histogram.percentile(p) for p in PERCENTILES}
+        result["max"] = histogram.max
+        result["mean"] = round(histogram.total / histogram.count, 1) if histogram.count else 0
+        return result
+
+    def to_dict(self) -> dict:
+        done = self.latency.count
+        ok = sum(n for status, n in self.statuses.items() if int(status) < 400)
+        failed = done - ok + sum(self.errors.values())
+        return {
+            "target": self.target,
+            "pattern": self.pattern,
+            "elapsed_s": round(self.elapsed, 3),
+            "requests": done + sum(self.errors.values()),
+            "ok": ok,
+            "failed": failed,
+            "throughput_rps": round(done / self.elapsed, 1) if self.elapsed else 0.0,
+            "ok_rps": round(ok / self.elapsed, 1) if self.elapsed else 0.0,
+            "bytes": self.bytes,
+            "statuses": dict(self.statuses),
+            "errors": dict(self.errors),
+            "latency_us": self.summary(self.latency),
+            "service_us": self.summary(self.service),
+            "timeline": [dict(second=s, **self.timeline[s]) for s in sorted(self.timeline)],
+            "latency_histogram": self.latency.to_dict(),
+        }
+
+
+def classify(error: BaseException) -> str:
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(error, ConnectionRefusedError):
+        return "refused"
+    if isinstance(error, ConnectionResetError):
+        return "reset"
+    if isinstance(error, (asyncio.IncompleteReadError, EOFError)):
+        return "truncated"
+    if isinstance(error, OSError):
+        return "os_error"
+    return "protocol"
+
+
+class LoadGenerator(object):
+    """
+    Fetches ``url`` once per scheduled arrival, each client on a fresh
+    connection like distinct machines would; with ``via`` ("host:port")
+    through that proxy. https:// URLs are fetched directly over TLS and
+    cannot go through ``via``. ``revalidate`` is the share of clients that
+    already hold the PAC file and send If-None-Match. At most ``inflight``
+    requests run at once; later arrivals queue, and that wait counts in
+    their latency.
+    """
+
+    def __init__(self, url: str, via: str=None, revalidate: float=0.0, timeout: float=10.0,
+                 inflight: int=512, seed: int=1):
+        self.url = url
+        self.parts = urlparse(url)
+        if self.parts.scheme not in ("http", "https"):
+            raise ValueError("Not an http(s) URL: {}".format(url))
+        if self.parts.scheme == "https" and via:
+            raise ValueError("HTTPS URLs cannot be fetched through a proxy")
+        self.context = ssl.create_default_context() if self.parts.scheme == "https" else None
+        self.via = via
+        self.revalidate = revalidate
+        self.timeout = timeout
+        self.inflight = inflight
+        self.rnd = random.Random(seed)
+        self.etag = None # type: Optional[str]
+
+    def address(self) -> Tuple[str, int]:
+        if self.via:
+            host, _, port = self.via.rpartition(":")
+            return host, int(port)
+        return self.parts.hostname, self.parts.port or (443 if self.context else 80)
+
+    def request(self, conditional: bool) -> bytes:
+        target = self.url if self.via else (self.parts.path or "/") + (
+            "?" + self.parts.query if self.parts.query else "")
+        lines = ["GET {} HTTP/1.1".format(target), "Host: {}".format(self.parts.netloc),
+                 "User-Agent: ipsx-loadgen", "Accept-Encoding: gzip", "Connection: close"]
+        if conditional and self.etag:
+            lines.append("If-None-Match: {}".format(self.etag))
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def fetch(self, conditional: bool) -> Tuple[int, int]:
+        """
+        Returns:
+            tuple - Status code and response size in bytes.
+        """
+        reader, writer = await asyncio.open_connection(
+            *self.address(), ssl=self.context, server_hostname=self.parts.hostname if self.context else None)
+        try:
+            writer.write(self.request(conditional))
+            head = await reader.readuntil(b"\r\n\r\n")
+            first, headers = parse_head(head)
+            status = int(first[1])
+            length = header(headers, b"content-length")
+            if length is not None:
+                body = await reader.readexactly(int(length))
+            else:
+                body = await reader.read()
+            etag = header(headers, b"etag")
+            if etag and status == 200:
+                self.etag = etag.decode("latin-1")
+            return status, len(head) + len(body)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                # Already reset; the close itself is done
+                pass
+
+    async def client(self, report: LoadReport, start: float, offset: float, slots: asyncio.Semaphore) -> None:
+        loop = asyncio.get_running_loop()
+        delay = start + offset - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        second = int(offset)
+        conditional = self.rnd.random() < self.revalidate
+        async with slots:
+            sent = loop.time()
+            try:
+                status, size = await asyncio.wait_for(self.fetch(conditional), self.timeout)
+            except Exception as e:
+                report.fail(second, classify(e))
+                return
+        done = loop.time()
+        report.record(second, int((done - start - offset) * 1e6), int((done - sent) * 1e6), status, size)
+
+    async def run(self, arrivals: List[float], pattern: dict=None) -> LoadReport:
+        report = LoadReport(self.url + (" via " + self.via if self.via else ""), pattern or {})
+        slots = asyncio.Semaphore(self.inflight)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await asyncio.gather(*(self.client(report, start, offset, slots) for offset in arrivals))
+        report.elapsed = loop.time() - start
+        return report
+
+
+STAND_IN_PAC = b"""
+function FindProxyForURL(url, host) {
+    if (isPlainHostName(host) || dnsDomainIs(host, ".corp.example"))
+        return "DIRECT";
+    if (shExpMatch(host, "*.cdn.example"))
+        return "PROXY cdn-proxy.example:8080";
+    return "PROXY proxy.example:8080; DIRECT";
+}
+"""
+
+
+class StandIn(object):
+    """
+    Local stand-in for the PAC origin (a PacServer), and optionally a
+    ForwardingProxy in front of it, each on its own thread.
+    """
+
+    def __init__(self, body: bytes=STAND_IN_PAC, proxy: bool=False):
+        from pac import PacEngine, PacHelpers
+        from pacserver import PacServer
+        from fwdproxy import ForwardingProxy
+        self.origin = PacServer(body)
+        engine = PacEngine.from_source('function FindProxyForURL(url, host) { return "DIRECT"; }',
+                                       PacHelpers(resolver=lambda host: None))
+        self.proxy = ForwardingProxy(engine) if proxy else None
+
+    def __enter__(self) -> "StandIn":
+        self.origin.start_in_thread()
+        if self.proxy is not None:
+            self.proxy.start_in_thread()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self.proxy is not None:
+            self.proxy.stop_thread()
+        self.origin.stop_thread()
+
+
+def main(argv: list=None) -> int:
+    cli = argparse.ArgumentParser(description="Replay PAC file fetches from a fleet of clients")
+    target = cli.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="PAC file URL to fetch")
+    target.add_argument("--origin", action="store_true", help="Serve a PAC file locally and fetch that")
+    cli.add_argument("--via", metavar="HOST:PORT", help="Send the requests through this proxy")
+    cli.add_argument("--local-proxy", action="store_true", help="With --origin, go through a local ForwardingProxy")
+    cli.add_argument("--pattern", choices=sorted(PATTERNS), default="steady")
+    cli.add_argument("--duration", type=float, default=10.0, help="Seconds over which clients arrive")
+    cli.add_argument("--rate", type=float, default=100.0, help="Arrivals per second (steady; peak for ramp)")
+    cli.add_argument("--clients", type=int, default=1000, help="Number of clients (storm)")
+    cli.add_argument("--revalidate", type=float, default=0.0, help="Share of clients sending If-None-Match")
+    cli.add_argument("--inflight", type=int, default=512, help="Most requests open at once")
+    cli.add_argument("--timeout", type=float, default=10.0)
+    cli.add_argument("--seed", type=int, default=1)
+    cli.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = cli.parse_args(argv)
+    if args.local_proxy and not args.origin:
+        cli.error("--local-proxy requires --origin")
+
+    arrivals = schedule(args.pattern, args.duration, args.rate, args.clients, args.seed)
+    pattern = {"name": args.pattern, "duration_s": args.duration, "arrivals": len(arrivals)}
+    pattern.update({"clients": args.clients} if args.pattern == "storm" else {"rate": args.rate})
+
+    stand_in = StandIn(proxy=args.local_proxy) if args.origin else None
+    try:
+        if stand_in is not None:
+            stand_in.__enter__()
+            url = stand_in.origin.url
+            via = stand_in.proxy.address if stand_in.proxy is not None else args.via
+        else:
+            url, via = args.url, args.via
+        try:
+            generator = LoadGenerator(url, via, args.revalidate, args.timeout, args.inflight, args.seed)
+        except ValueError as e:
+            cli.error(str(e))
+        report = asyncio.run(generator.run(arrivals, pattern)).to_dict()
+    finally:
+        if stand_in is not None:
+            stand_in.__exit__()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    brief = {k: report[k] for k in ("requests", "ok", "failed", "throughput_rps")}
+    sys.stderr.write("{} p50={}us p99={}us errors={}\n".format(
+        json.dumps(brief), report["latency_us"]["p50"], report["latency_us"]["p99"], report["errors"]))
+    return 0 if report["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
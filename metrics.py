@@ -0,0 +1,340 @@
+# #!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import json
+import time
+import functools
+import threading
+
+from typing import Callable, Dict, List, Tuple
+
+
+class Histogram(object):
+    """
+    Log-linear latency histogram in the style of HdrHistogram.
+
+    Values are microseconds. Each power of two is split in SUB_BUCKETS
+    equal buckets, so every recorded value is known to within 25% and a
+    record() is a couple of integer operations and a list increment.
+    """
+
+    SUB_BITS = 2 # record() hardcodes these
+    SUB_BUCKETS = 1 << SUB_BITS
+    BUCKETS = 64 * SUB_BUCKETS
+
+    __slots__ = ("counts", "count", "total", "max", "lock")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.counts = [0] * self.BUCKETS
+            self.count = 0
+            self.total = 0
+            self.max = 0
+
+    @classmethod
+    def index(cls, value: int) -> int:
+        if value < 2 * cls.SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - cls.SUB_BITS - 1
+        return (shift << cls.SUB_BITS) + (value >> shift)
+
+    @classmethod
+    def bounds(cls, index: int) -> Tuple[int, int]:
+        """
+        Returns:
+            tuple - Lowest value of the bucket and the first value past it.
+        """
+        if index < 2 * cls.SUB_BUCKETS:
+            return index, index + 1
+        shift = (index >> cls.SUB_BITS) - 1
+        mantissa = (index & (cls.SUB_BUCKETS - 1)) + cls.SUB_BUCKETS
+        return mantissa << shift, (mantissa + 1) << shift
+
+    def record(self, value: int) -> None:
+        # index() inlined; this runs on every instrumented call
+        if value < 8:
+            index = value
+        else:
+            shift = value.bit_length() - 3
+            index = (shift << 2) + (value >> shift)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, pct: float) -> int:
+        """
+        Upper bound of the bucket holding the ``pct`` percentile, capped by
+        the largest recorded value; 0 when empty.
+        """
+        if not self.count:
+            return 0
+        rank = max(1, int(self.count * pct / 100 + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.bounds(index)[1] - 1, self.max)
+        return self.max
+
+    def merge(self, other: "Histogram") -> None:
+        with self.lock:
+            for index, count in enumerate(other.counts):
+                self.counts[index] += count
+            self.count += other.count
+            self.total += other.total
+            self.max = max(self.max, other.max)
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "max": self.max,
+            "buckets": {str(i): c for i, c in enumerate(self.counts) if c},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Histogram":
+        histogram = cls()
+        for index, count in data["buckets"].items():
+            histogram.counts[int(index)] = count
+        histogram.count, histogram.total, histogram.max = data["count"], data["sum"], data["max"]
+        return histogram
+
+
+class FineHistogram(Histogram):
+    """
+    Histogram with 128 buckets per power of two, so values are known to
+    within 1% like HdrHistogram with two significant digits. Records cost
+    a method call more; meant for reports such as load tests, while the
+    always-on metrics keep the coarse one.
+    """
+
+    SUB_BITS = 7
+    SUB_BUCKETS = 1 << SUB_BITS
+    BUCKETS = 64 * SUB_BUCKETS
+
+    __slots__ = ()
+
+    def record(self, value: int) -> None:
+        index = self.index(value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+
+class Span(object):
+    """
+    Context manager timing one operation into a Metrics histogram.
+    """
+
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics: "Metrics", name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, kind, *exc) -> None:
+        self.metrics.observe(self.name, (time.perf_counter_ns() - self.start) // 1000)
+        if kind is not None:
+            self.metrics.count(self.name + ".failures")
+
+
+class Metrics(object):
+    """
+    Named latency histograms (microseconds) and counters.
+    """
+
+    def __init__(self):
+        self.histograms = {} # type: Dict[str, Histogram]
+        self.counters = {} # type: Dict[str, int]
+        self.lock = threading.Lock()
+
+    def histogram(self, name: str) -> Histogram:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def observe(self, name: str, micros: int) -> None:
+        self.histogram(name).record(micros)
+
+    def count(self, name: str, amount: int=1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def span(self, name: str) -> Span:
+        return Span(self, name)
+
+    def reset(self) -> None:
+        # Histograms are cleared in place: timed() functions hold on to them
+        for histogram in list(self.histograms.values()):
+            histogram.clear()
+        with self.lock:
+            self.counters = {}
+
+    def recorded(self) -> List[str]:
+        return sorted(name for name, h in list(self.histograms.items()) if h.count)
+
+    def summary(self, name: str) -> Dict[str, int]:
+        histogram = self.histogram(name)
+        return {
+            "count": histogram.count,
+            "p50_us": histogram.percentile(50),
+            "p99_us": histogram.percentile(99),
+            "max_us": histogram.max,
+            "mean_us": histogram.total // histogram.count if histogram.count else 0,
+        }
+
+    def snapshot(self) -> dict:
+        """
+        JSON-friendly view: per-operation percentiles, counters, and the raw
+        histograms so snapshots can be merged later.
+        """
+        names = self.recorded()
+        return {
+            "time": time.time(),
+            "operations": {name: self.summary(name) for name in names},
+            "counters": dict(sorted(self.counters.items())),
+            "histograms": {name: self.histograms[name].to_dict() for name in names},
+        }
+
+    def merge_snapshot(self, data: dict) -> "Metrics":
+        for name, histogram in data.get("histograms", {}).items():
+            self.histogram(name).merge(Histogram.from_dict(histogram))
+        for name, amount in data.get("counters", {}).items():
+            self.count(name, amount)
+        return self
+
+    @staticmethod
+    def metric_name(name: str) -> str:
+        return "ipsx_" + "".join(c if c.isalnum() else "_" for c in name)
+
+    def prometheus(self) -> str:
+        """
+        Prometheus text exposition format, e.g. for node_exporter's textfile
+        collector. Histograms are in seconds, with one bucket per non-empty
+        histogram bucket.
+        """
+        lines = []
+        for name in self.recorded():
+            histogram = self.histograms[name]
+            metric = self.metric_name(name) + "_seconds"
+            lines.append("# TYPE {} histogram".format(metric))
+            seen = 0
+            for index, count in enumerate(histogram.counts):
+                if count:
+                    seen += count
+                    le = histogram.bounds(index)[1] / 1e6
+                    lines.append('{}_bucket{{le="{:g}"}} {}'.format(metric, le, seen))
+            lines.append('{}_bucket{{le="+Inf"}} {}'.format(metric, histogram.count))
+            lines.append("{}_sum {:g}".format(metric, histogram.total / 1e6))
+            lines.append("{}_count {}".format(metric, histogram.count))
+        for name, value in sorted(self.counters.items()):
+            metric = self.metric_name(name) + "_total"
+            lines.append("# TYPE {} counter".format(metric))
+            lines.append("{} {}".format(metric, value))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _write(path: str, text: str) -> None:
+        temp = "{}.tmp".format(path)
+        with open(temp, "w") as file_:
+            file_.write(text)
+        os.replace(temp, path)
+
+    def write_prometheus(self, path: str) -> None:
+        self._write(path, self.prometheus())
+
+    def save(self, path: str) -> None:
+        """
+        Appends this process's numbers to ``path`` as one JSON line, in a
+        single write. The file is never rewritten, so processes saving at
+        the same time cannot lose each other's numbers; load() adds the
+        lines up.
+        """
+        line = (json.dumps(self.snapshot()) + "\n").encode("utf-8")
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def load(cls, path: str) -> "Metrics":
+        metrics = cls()
+        with open(path, "r") as file_:
+            for line in file_:
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    # Torn by a process that died mid-write
+                    continue
+                metrics.merge_snapshot(data)
+        return metrics
+
+
+METRICS = Metrics()
+
+
+def timed(name: str) -> Callable:
+    """
+    Decorator recording every call of the function in METRICS under
+    ``name``. Exceptions, results with a false ``ok`` (a failed
+    proxy.Result) and (False, error) tuples are counted as
+    ``name.failures``.
+    """
+    def decorate(fn: Callable) -> Callable:
+        histogram = METRICS.histogram(name)
+        failures = name + ".failures"
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                METRICS.count(failures)
+                raise
+            finally:
+                histogram.record((time.perf_counter_ns() - start) // 1000)
+            if getattr(result, "ok", True) is False or (
+                    type(result) is tuple and result and result[0] is False):
+                METRICS.count(failures)
+            return result
+        return wrapper
+    return decorate
@@ -0,0 +1,282 @@
+# #!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import ssl
+import time
+import asyncio
+import threading
+
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlparse
+from httphead import parse_head, header
+from pacfetch import PacFetcher
+from util import validate_pac_url
+
+
+async def http_get(url: str, timeout: float=5.0, max_size: int=1 << 20,
+                   address: str=None) -> Tuple[int, bytes]:
+    """
+    Minimal asyncio HTTP(S) GET; with ``address``, connects there instead of
+    resolving the URL's host.
+
+    Returns:
+        tuple - Status code and body.
+    """
+    parts = urlparse(url)
+    https = parts.scheme == "https"
+    host, port = parts.hostname, parts.port or (443 if https else 80)
+    context = ssl.create_default_context() if https else None
+    connect = asyncio.open_connection(address or host, port, ssl=context,
+                                      server_hostname=host if https else None)
+    reader, writer = await asyncio.wait_for(connect, timeout)
+    try:
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        writer.write("GET {} HTTP/1.1\r\nHost: {}\r\nUser-Agent: ipsx\r\nAccept-Encoding: identity\r\n"
+                     "Connection: close\r\n\r\n".format(path or "/", parts.netloc).encode("latin-1"))
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+        first, headers = parse_head(head)
+        status = int(first[1])
+        if (header(headers, b"transfer-encoding") or b"").lower() == b"chunked":
+            chunks, size = [], 0
+            while True:
+                line = await asyncio.wait_for(reader.readuntil(b"\r\n"), timeout)
+                length = int(line.split(b";", 1)[0], 16)
+                if length == 0:
+                    break
+                size += length
+                if size > max_size:
+                    raise ValueError("PAC file too large")
+                chunks.append(await asyncio.wait_for(reader.readexactly(length + 2), timeout))
+            body = b"".join(c[:-2] for c in chunks)
+        else:
+            length = header(headers, b"content-length")
+            if length:
+                if int(length) > max_size:
+                    raise ValueError("PAC file too large")
+                body = await asyncio.wait_for(reader.readexactly(int(length)), timeout)
+            else:
+                # Close-delimited: read() returns what has arrived so far
+                chunks, size = [], 0
+                while True:
+                    chunk = await asyncio.wait_for(reader.read(65536), timeout)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > max_size:
+                        raise ValueError("PAC file too large")
+                    chunks.append(chunk)
+                body = b"".join(chunks)
+        return status, body
+    finally:
+        writer.close()
+        try:
+            await asyncio.wait_for(writer.wait_closed(), timeout)
+        except (OSError, asyncio.TimeoutError):
+            # Reset or unanswered TLS close; the transport is closed anyway
+            pass
+
+
+class Probe(object):
+    """
+    Outcome of one mirror check. ``latency`` is the time to the full body,
+    in seconds.
+    """
+
+    __slots__ = ("url", "ok", "latency", "error", "time")
+
+    def __init__(self, url: str, ok: bool, latency: float=0.0, error: str=""):
+        self.url = url
+        self.ok = ok
+        self.latency = latency
+        self.error = error
+        self.time = time.time()
+
+    def to_dict(self) -> dict:
+        return {"url": self.url, "ok": self.ok, "latency_ms": round(self.latency * 1000, 1),
+                "error": self.error}
+
+    def __repr__(self) -> str:
+        return "Probe({!r}, ok={!r}, latency={:.3f})".format(self.url, self.ok, self.latency)
+
+
+class ProbeCache(object):
+    """
+    Remembers probes for ``ttl`` seconds, failed ones for ``failure_ttl``.
+    """
+
+    def __init__(self, ttl: float=60.0, failure_ttl: float=15.0, clock: Callable[[], float]=time.monotonic):
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.clock = clock
+        self.entries = {} # type: Dict[str, Tuple[Probe, float]]
+        self.lock = threading.Lock()
+
+    def get(self, url: str) -> Optional[Probe]:
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None:
+                return None
+            if entry[1] <= self.clock():
+                del self.entries[url]
+                return None
+            return entry[0]
+
+    def put(self, probe: Probe) -> None:
+        ttl = self.ttl if probe.ok else self.failure_ttl
+        with self.lock:
+            self.entries[probe.url] = (probe, self.clock() + ttl)
+
+    def discard(self, url: str) -> None:
+        with self.lock:
+            self.entries.pop(url, None)
+
+
+class MirrorSet(object):
+    """
+    Candidate URLs of the same PAC file. Probes run concurrently on one
+    event loop and go through the ProbeCache, so repeated selections within
+    the TTL do not touch the network.
+    """
+
+    def __init__(self, urls: Iterable[str], cache: ProbeCache=None, timeout: float=5.0,
+                 max_size: int=PacFetcher.MAX_SIZE):
+        self.urls = []
+        self.invalid = []
+        for url in urls:
+            url = url.strip()
+            if url in self.urls or url in self.invalid:
+                continue
+            (self.urls if validate_pac_url(url) else self.invalid).append(url)
+        self.cache = cache if cache is not None else ProbeCache()
+        self.timeout = timeout
+        self.max_size = max_size
+
+    @staticmethod
+    def split(text: str) -> List[str]:
+        """
+        Candidate URLs typed in one line, separated by spaces or commas.
+        """
+        return [u for u in text.replace(",", " ").split() if u]
+
+    async def probe_one(self, url: str) -> Probe:
+        start = time.perf_counter()
+        try:
+            status, body = await asyncio.wait_for(http_get(url, self.timeout, self.max_size), self.timeout)
+            if status != 200:
+                raise ValueError("HTTP {}".format(status))
+            if PacFetcher.MARKER not in body:
+                raise ValueError("Not a PAC file")
+        except Exception as e:
+            probe = Probe(url, False, time.perf_counter() - start, str(e) or type(e).__name__)
+        else:
+            probe = Probe(url, True, time.perf_counter() - start)
+        self.cache.put(probe)
+        return probe
+
+    async def probe_many(self, urls: List[str], fresh: bool=False) -> List[Probe]:
+        cached = {} if fresh else {url: self.cache.get(url) for url in urls}
+        missing = [url for url in urls if cached.get(url) is None]
+        probes = dict(zip(missing, await asyncio.gather(*(self.probe_one(u) for u in missing))))
+        return [cached.get(url) or probes[url] for url in urls]
+
+    def probe(self, urls: List[str]=None, fresh: bool=False) -> List[Probe]:
+        return asyncio.run(self.probe_many(self.urls if urls is None else urls, fresh))
+
+    @staticmethod
+    def rank(probes: List[Probe]) -> List[Probe]:
+        return sorted((p for p in probes if p.ok), key=lambda p: p.latency)
+
+    def fastest(self, fresh: bool=False) -> Optional[Probe]:
+        ranked = self.rank(self.probe(fresh=fresh))
+        return ranked[0] if ranked else None
+
+
+class HealthMonitor(object):
+    """
+    Keeps the system on a healthy mirror.
+
+    Every ``interval`` seconds the active mirror is probed (through the
+    cache, so most checks are free). When it fails, or answers slower than
+    ``slow`` seconds, all mirrors are probed afresh and ``apply`` is called
+    with the fastest healthy one, e.g. ProxyHelper.install_pac_file; the
+    active mirror only changes when the Result it returns is ok.
+    """
+
+    def __init__(self, mirrors: MirrorSet, active: str, apply: Callable[[str], object],
+                 interval: float=30.0, slow: float=2.0, log: Callable[[str, str], object]=None):
+        self.mirrors = mirrors
+        self.active = active
+        self.apply = apply
+        self.interval = interval
+        self.slow = slow
+        self.log = log
+        self.failovers = 0
+        self.stopping = threading.Event()
+        self.thread = None # type: threading.Thread
+
+    def check(self) -> Optional[Probe]:
+        """
+        One health check; returns the mirror failed over to, if any.
+        """
+        if self.stopping.is_set():
+            return None
+        probe, = self.mirrors.probe([self.active])
+        if probe.ok and probe.latency <= self.slow:
+            return None
+        others = [u for u in self.mirrors.urls if u != self.active]
+        ranked = self.mirrors.rank(self.mirrors.probe(others, fresh=True))
+        if not ranked:
+            return None
+        best = ranked[0]
+        if probe.ok and best.latency >= probe.latency:
+            return None
+        reason = probe.error if not probe.ok else "{:.0f} ms".format(probe.latency * 1000)
+        installed = self.apply(best.url)
+        if not installed:
+            if self.log is not None:
+                self.log("Cannot switch PAC mirror to {}: {}".format(best.url, installed.message), "mirror")
+            return None
+        if self.log is not None:
+            self.log("Switched PAC mirror from {} ({}) to {}".format(self.active, reason, best.url), "mirror")
+        self.active = best.url
+        self.failovers += 1
+        return best
+
+    def run(self) -> None:
+        while not self.stopping.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                if self.log is not None:
+                    self.log("Mirror health check failed: {}".format(e), "mirror")
+
+    def start(self) -> threading.Thread:
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self) -> None:
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
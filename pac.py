@@ -0,0 +1,1517 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+In-process PAC (proxy auto-config) evaluation.
+
+PAC files are JavaScript, but in practice they only use a small part of
+the language: functions, variables, conditionals, loops, string/array
+helpers and the standard PAC helper functions. This module parses that
+subset and compiles it into nested Python closures, so no JavaScript
+runtime is needed.
+"""
+
+import re
+import math
+import time
+import socket
+import threading
+import datetime
+import ipaddress
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+import dnscache
+
+
+class PacError(ValueError):
+    pass
+
+
+class Undefined(object):
+
+    __slots__ = ()
+
+    def __repr__(self) -> str:
+        return "undefined"
+
+    def __bool__(self) -> bool:
+        return False
+
+
+UNDEFINED = Undefined()
+
+
+# --------------------------------------------------------------------------
+# Tokenizer
+# --------------------------------------------------------------------------
+
+TOKEN = re.compile(r"""
+    (?P<ws>\s+|//[^\n]*|/\*.*?\*/)
+  | (?P<num>0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<str>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')
+  | (?P<name>[A-Za-z_$][\w$]*)
+  | (?P<op>===|!==|>>>|\+\+|--|&&|\|\||==|!=|<=|>=|\+=|-=|\*=|/=|%=|<<|>>
+        |[-+*/%=<>!?:.,;(){}\[\]&|^~])
+""", re.S | re.X)
+
+REGEX = re.compile(r"/((?:[^/\\\n\[]|\\.|\[(?:[^\]\\\n]|\\.)*\])+)/([gimsuy]*)")
+
+ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f", "v": "\v", "0": "\0"}
+ESCAPE = re.compile(r"\\(u[0-9a-fA-F]{4}|x[0-9a-fA-F]{2}|.)", re.S)
+
+# After these tokens a "/" starts a regular expression, not a division
+REGEX_PREFIX = {None, "(", ",", "=", ":", "[", "!", "&&", "||", "?", "{", "}", ";",
+                "==", "!=", "===", "!==", "return", "typeof", "+", "-", "*", "%"}
+
+
+def _unescape(match) -> str:
+    seq = match.group(1)
+    if len(seq) > 1:
+        return chr(int(seq[1:], 16))
+    return ESCAPES.get(seq, seq)
+
+
+def tokenize(source: str) -> List[Tuple[str, Any]]:
+    """
+    Splits PAC source into (kind, value) tokens.
+
+    Raises:
+        PacError - On characters that cannot start a token.
+    """
+    tokens = []
+    pos, end = 0, len(source)
+    prev = None
+    while pos < end:
+        if source[pos] == "/" and prev in REGEX_PREFIX:
+            match = REGEX.match(source, pos)
+            if match is not None and not source.startswith(("//", "/*"), pos):
+                tokens.append(("regex", (match.group(1), match.group(2))))
+                prev = "regex"
+                pos = match.end()
+                continue
+        match = TOKEN.match(source, pos)
+        if match is None:
+            raise PacError("Invalid PAC script: unexpected {!r}".format(source[pos]))
+        kind = match.lastgroup
+        text = match.group(kind)
+        pos = match.end()
+        if kind == "ws":
+            continue
+        if kind == "num":
+            value = int(text, 16) if text[:2] in ("0x", "0X") else float(text)
+            if isinstance(value, float) and value.is_integer() and "e" not in text.lower():
+                value = int(value)
+            tokens.append(("num", value))
+        elif kind == "str":
+            tokens.append(("str", ESCAPE.sub(_unescape, text[1:-1])))
+        else:
+            tokens.append((kind, text))
+        prev = text if kind in ("op", "name") else kind
+    tokens.append(("eof", None))
+    return tokens
+
+
+# --------------------------------------------------------------------------
+# Parser
+# --------------------------------------------------------------------------
+
+BINARY = {
+    "*": 10, "/": 10, "%": 10,
+    "+": 9, "-": 9,
+    "<<": 8, ">>": 8, ">>>": 8,
+    "<": 7, ">": 7, "<=": 7, ">=": 7, "in": 7,
+    "==": 6, "!=": 6, "===": 6, "!==": 6,
+    "&": 5, "^": 4, "|": 3,
+    "&&": 2, "||": 1,
+}
+
+ASSIGN = ("=", "+=", "-=", "*=", "/=", "%=")
+
+
+class Parser(object):
+    """
+    Recursive descent parser producing a tuple based AST.
+
+    Statements: ("func", name, params, body), ("var", [(name, expr)]),
+    ("if", test, then, other), ("for", init, test, update, body),
+    ("forin", name, expr, body), ("while", test, body), ("return", expr),
+    ("block", [stmt]), ("expr", expr), ("break",), ("continue",).
+
+    Expressions: ("num"|"str"|"regex"|"name", value), ("const", value),
+    ("array", [expr]), ("object", [(key, expr)]), ("call", callee, [expr]),
+    ("member", expr, name), ("index", expr, expr), ("unary", op, expr),
+    ("binary", op, left, right), ("cond", test, then, other),
+    ("assign", op, target, expr), ("update", op, prefix, target),
+    ("funcexpr", name, params, body).
+    """
+
+    def __init__(self, source: str):
+        self.tokens = tokenize(source)
+        self.pos = 0
+
+    def peek(self, offset: int=0) -> Tuple[str, Any]:
+        return self.tokens[self.pos + offset]
+
+    def next(self) -> Tuple[str, Any]:
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def at(self, value: str) -> bool:
+        kind, text = self.tokens[self.pos]
+        return kind in ("op", "name") and text == value
+
+    def accept(self, value: str) -> bool:
+        if self.at(value):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, value: str) -> None:
+        if not self.accept(value):
+            raise PacError("Invalid PAC script: expected {!r}, got {!r}".format(value, self.peek()[1]))
+
+    def name(self) -> str:
+        kind, text = self.next()
+        if kind != "name":
+            raise PacError("Invalid PAC script: expected a name, got {!r}".format(text))
+        return text
+
+    def program(self) -> List[tuple]:
+        body = []
+        while self.peek()[0] != "eof":
+            body.append(self.statement())
+        return body
+
+    def block(self) -> List[tuple]:
+        self.expect("{")
+        body = []
+        while not self.accept("}"):
+            body.append(self.statement())
+        return body
+
+    def function(self) -> Tuple[str, List[str], List[tuple]]:
+        name = self.name() if self.peek()[0] == "name" else None
+        self.expect("(")
+        params = []
+        while not self.accept(")"):
+            params.append(self.name())
+            if not self.at(")"):
+                self.expect(",")
+        return name, params, self.block()
+
+    def statement(self) -> tuple:
+        if self.accept(";"):
+            return ("block", [])
+        if self.at("{"):
+            return ("block", self.block())
+        if self.accept("function"):
+            return ("func",) + self.function()
+        if self.at("var") or self.at("let") or self.at("const"):
+            self.next()
+            stmt = self.declarations()
+            self.accept(";")
+            return stmt
+        if self.accept("if"):
+            # "else if" chains are collected iteratively; generated PAC
+            # files can chain thousands of them
+            branches = []
+            other = None
+            while True:
+                self.expect("(")
+                test = self.expression()
+                self.expect(")")
+                branches.append((test, self.statement()))
+                if not self.accept("else"):
+                    break
+                if not self.accept("if"):
+                    other = self.statement()
+                    break
+            for test, then in reversed(branches):
+                other = ("if", test, then, other)
+            return other
+        if self.accept("for"):
+            return self.for_statement()
+        if self.accept("while"):
+            self.expect("(")
+            test = self.expression()
+            self.expect(")")
+            return ("while", test, self.statement())
+        if self.accept("return"):
+            expr = None
+            if not self.at(";") and not self.at("}"):
+                expr = self.expression()
+            self.accept(";")
+            return ("return", expr)
+        if self.accept("break"):
+            self.accept(";")
+            return ("break",)
+        if self.accept("continue"):
+            self.accept(";")
+            return ("continue",)
+        expr = self.expression()
+        self.accept(";")
+        return ("expr", expr)
+
+    def declarations(self) -> tuple:
+        decls = []
+        while True:
+            name = self.name()
+            init = self.assignment() if self.accept("=") else None
+            decls.append((name, init))
+            if not self.accept(","):
+                return ("var", decls)
+
+    def for_statement(self) -> tuple:
+        self.expect("(")
+        init = None
+        if self.at("var") or self.at("let") or self.at("const"):
+            self.next()
+            if self.peek(1) == ("name", "in") or self.peek(1) == ("name", "of"):
+                name = self.name()
+                kind = self.next()[1]
+                expr = self.expression()
+                self.expect(")")
+                return ("for" + kind, name, expr, self.statement())
+            init = self.declarations()
+        elif not self.at(";"):
+            init = ("expr", self.expression())
+        self.expect(";")
+        test = None if self.at(";") else self.expression()
+        self.expect(";")
+        update = None if self.at(")") else self.expression()
+        self.expect(")")
+        return ("for", init, test, update, self.statement())
+
+    def expression(self) -> tuple:
+        expr = self.assignment()
+        while self.accept(","):
+            expr = ("binary", ",", expr, self.assignment())
+        return expr
+
+    def assignment(self) -> tuple:
+        target = self.conditional()
+        kind, text = self.peek()
+        if kind == "op" and text in ASSIGN:
+            self.next()
+            if target[0] not in ("name", "member", "index"):
+                raise PacError("Invalid PAC script: bad assignment target")
+            return ("assign", text, target, self.assignment())
+        return target
+
+    def conditional(self) -> tuple:
+        test = self.binary(1)
+        if self.accept("?"):
+            then = self.assignment()
+            self.expect(":")
+            return ("cond", test, then, self.assignment())
+        return test
+
+    def binary(self, min_prec: int) -> tuple:
+        left = self.unary()
+        while True:
+            kind, text = self.peek()
+            prec = BINARY.get(text) if kind in ("op", "name") else None
+            if prec is None or prec < min_prec:
+                return left
+            self.next()
+            left = ("binary", text, left, self.binary(prec + 1))
+
+    def unary(self) -> tuple:
+        kind, text = self.peek()
+        if kind == "op" and text in ("!", "-", "+", "~"):
+            self.next()
+            return ("unary", text, self.unary())
+        if kind == "op" and text in ("++", "--"):
+            self.next()
+            return ("update", text, True, self.unary())
+        if kind == "name" and text == "typeof":
+            self.next()
+            return ("unary", text, self.unary())
+        expr = self.postfix()
+        kind, text = self.peek()
+        if kind == "op" and text in ("++", "--"):
+            self.next()
+            return ("update", text, False, expr)
+        return expr
+
+    def postfix(self) -> tuple:
+        expr = self.primary()
+        while True:
+            if self.accept("."):
+                expr = ("member", expr, self.name())
+            elif self.accept("["):
+                expr = ("index", expr, self.expression())
+                self.expect("]")
+            elif self.accept("("):
+                args = []
+                while not self.accept(")"):
+                    args.append(self.assignment())
+                    if not self.at(")"):
+                        self.expect(",")
+                expr = ("call", expr, args)
+            else:
+                return expr
+
+    CONSTANTS = {"true": True, "false": False, "null": None, "undefined": UNDEFINED}
+
+    def primary(self) -> tuple:
+        kind, value = self.next()
+        if kind in ("num", "str", "regex"):
+            return (kind, value)
+        if kind == "name":
+            if value in self.CONSTANTS:
+                return ("const", self.CONSTANTS[value])
+            if value == "function":
+                return ("funcexpr",) + self.function()
+            return ("name", value)
+        if value == "(":
+            expr = self.expression()
+            self.expect(")")
+            return expr
+        if value == "[":
+            items = []
+            while not self.accept("]"):
+                items.append(self.assignment())
+                if not self.at("]"):
+                    self.expect(",")
+            return ("array", items)
+        if value == "{":
+            pairs = []
+            while not self.accept("}"):
+                key_kind, key = self.next()
+                if key_kind not in ("name", "str", "num"):
+                    raise PacError("Invalid PAC script: bad object key {!r}".format(key))
+                self.expect(":")
+                pairs.append((str(key), self.assignment()))
+                if not self.at("}"):
+                    self.expect(",")
+            return ("object", pairs)
+        raise PacError("Invalid PAC script: unexpected {!r}".format(value))
+
+
+# --------------------------------------------------------------------------
+# Runtime semantics
+# --------------------------------------------------------------------------
+
+def to_str(value: Any) -> str:
+    if isinstance(value, str):
+        return value
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if value is None:
+        return "null"
+    if value is UNDEFINED:
+        return "undefined"
+    if isinstance(value, float):
+        if value != value:
+            return "NaN"
+        if value.is_integer():
+            return str(int(value))
+    if isinstance(value, list):
+        return ",".join("" if v is None or v is UNDEFINED else to_str(v) for v in value)
+    return str(value)
+
+
+def to_num(value: Any) -> Any:
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        text = value.strip()
+        if text == "":
+            return 0
+        try:
+            return int(text, 16) if text[:2] in ("0x", "0X") else float(text)
+        except ValueError:
+            return float("nan")
+    return float("nan")
+
+
+def to_int(value: Any) -> int:
+    num = to_num(value)
+    if isinstance(num, float):
+        if num != num or num in (float("inf"), float("-inf")):
+            return 0
+        return int(num)
+    return num
+
+
+def truthy(value: Any) -> bool:
+    if isinstance(value, float):
+        return value == value and value != 0
+    if isinstance(value, (list, dict, JSFunction)) or callable(value):
+        return True
+    return bool(value)
+
+
+def loose_equals(a: Any, b: Any) -> bool:
+    if (a is None or a is UNDEFINED) or (b is None or b is UNDEFINED):
+        return (a is None or a is UNDEFINED) and (b is None or b is UNDEFINED)
+    if isinstance(a, str) and isinstance(b, str):
+        return a == b
+    if isinstance(a, (list, dict)) or isinstance(b, (list, dict)):
+        return a is b
+    return to_num(a) == to_num(b)
+
+
+def strict_equals(a: Any, b: Any) -> bool:
+    if isinstance(a, bool) or isinstance(b, bool):
+        return a is b
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return a == b
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, (list, dict)):
+        return a is b
+    return a == b
+
+
+def add(a: Any, b: Any) -> Any:
+    if isinstance(a, str) or isinstance(b, str) or isinstance(a, list) or isinstance(b, list):
+        return to_str(a) + to_str(b)
+    return to_num(a) + to_num(b)
+
+
+def divide(a: Any, b: Any) -> float:
+    a, b = to_num(a), to_num(b)
+    try:
+        return a / b
+    except ZeroDivisionError:
+        if a == 0 or a != a:
+            return float("nan")
+        return float("inf") if a > 0 else float("-inf")
+
+
+def compare(op: str, a: Any, b: Any) -> bool:
+    if not (isinstance(a, str) and isinstance(b, str)):
+        a, b = to_num(a), to_num(b)
+    if op == "<":
+        return a < b
+    if op == ">":
+        return a > b
+    if op == "<=":
+        return a <= b
+    return a >= b
+
+
+def typeof(value: Any) -> str:
+    if value is UNDEFINED:
+        return "undefined"
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, JSFunction) or callable(value):
+        return "function"
+    return "object"
+
+
+ARITHMETIC = {
+    "-": lambda a, b: to_num(a) - to_num(b),
+    "*": lambda a, b: to_num(a) * to_num(b),
+    "/": divide,
+    "%": lambda a, b: float("nan") if to_num(b) == 0 else math.fmod(to_num(a), to_num(b)),
+    "&": lambda a, b: to_int(a) & to_int(b),
+    "|": lambda a, b: to_int(a) | to_int(b),
+    "^": lambda a, b: to_int(a) ^ to_int(b),
+    "<<": lambda a, b: (to_int(a) << (to_int(b) & 31)) & 0xffffffff,
+    ">>": lambda a, b: to_int(a) >> (to_int(b) & 31),
+    ">>>": lambda a, b: (to_int(a) & 0xffffffff) >> (to_int(b) & 31),
+}
+
+
+class JSRegExp(object):
+
+    __slots__ = ("source", "flags", "regex")
+
+    def __init__(self, source: str, flags: str=""):
+        self.source = source
+        self.flags = flags
+        opts = re.I if "i" in flags else 0
+        self.regex = re.compile(source, opts)
+
+
+def _string_method(value: str, name: str, args: list) -> Any:
+    arg = args[0] if args else UNDEFINED
+    if name == "toLowerCase":
+        return value.lower()
+    if name == "toUpperCase":
+        return value.upper()
+    if name == "indexOf":
+        return value.find(to_str(arg), to_int(args[1]) if len(args) > 1 else 0)
+    if name == "lastIndexOf":
+        return value.rfind(to_str(arg))
+    if name in ("substring", "slice", "substr"):
+        start = to_int(arg)
+        stop = UNDEFINED if len(args) < 2 else args[1]
+        if name == "substr":
+            start = max(0, len(value) + start) if start < 0 else start
+            return value[start:] if stop is UNDEFINED else value[start:start + max(0, to_int(stop))]
+        stop = len(value) if stop is UNDEFINED else to_int(stop)
+        if name == "substring":
+            start, stop = sorted((max(0, start), max(0, stop)))
+        return value[start:stop]
+    if name == "charAt":
+        index = to_int(arg)
+        return value[index] if 0 <= index < len(value) else ""
+    if name == "charCodeAt":
+        index = to_int(arg)
+        return ord(value[index]) if 0 <= index < len(value) else float("nan")
+    if name == "split":
+        if arg is UNDEFINED:
+            return [value]
+        if isinstance(arg, JSRegExp):
+            return arg.regex.split(value)
+        sep = to_str(arg)
+        return list(value) if sep == "" else value.split(sep)
+    if name == "replace":
+        repl = to_str(args[1]) if len(args) > 1 else "undefined"
+        if isinstance(arg, JSRegExp):
+            return arg.regex.sub(lambda m: repl, value, count=0 if "g" in arg.flags else 1)
+        return value.replace(to_str(arg), repl, 1)
+    if name == "match":
+        match = arg.regex.search(value) if isinstance(arg, JSRegExp) else None
+        return None if match is None else [match.group(0)] + list(match.groups())
+    if name == "search":
+        match = arg.regex.search(value) if isinstance(arg, JSRegExp) else None
+        return -1 if match is None else match.start()
+    if name == "trim":
+        return value.strip()
+    if name == "startsWith":
+        return value.startswith(to_str(arg))
+    if name == "endsWith":
+        return value.endswith(to_str(arg))
+    if name == "includes":
+        return to_str(arg) in value
+    if name == "concat":
+        return value + "".join(to_str(a) for a in args)
+    if name == "toString":
+        return value
+    raise PacError("Unsupported string method {}".format(name))
+
+
+def _array_method(value: list, name: str, args: list) -> Any:
+    arg = args[0] if args else UNDEFINED
+    if name == "indexOf":
+        for i, item in enumerate(value):
+            if strict_equals(item, arg):
+                return i
+        return -1
+    if name == "includes":
+        return any(strict_equals(item, arg) for item in value)
+    if name == "push":
+        value.extend(args)
+        return len(value)
+    if name == "pop":
+        return value.pop() if value else UNDEFINED
+    if name == "join":
+        sep = "," if arg is UNDEFINED else to_str(arg)
+        return sep.join("" if v is None or v is UNDEFINED else to_str(v) for v in value)
+    if name == "slice":
+        start = to_int(arg)
+        stop = len(value) if len(args) < 2 else to_int(args[1])
+        return value[start:stop]
+    if name == "concat":
+        out = list(value)
+        for a in args:
+            out.extend(a if isinstance(a, list) else [a])
+        return out
+    if name == "reverse":
+        value.reverse()
+        return value
+    if name == "toString":
+        return to_str(value)
+    raise PacError("Unsupported array method {}".format(name))
+
+
+def get_member(obj: Any, name: Any) -> Any:
+    if isinstance(obj, str):
+        if name == "length":
+            return len(obj)
+        index = to_num(name)
+        if isinstance(index, int) and 0 <= index < len(obj):
+            return obj[index]
+        return UNDEFINED
+    if isinstance(obj, list):
+        if name == "length":
+            return len(obj)
+        index = to_num(name)
+        if isinstance(index, float) and index.is_integer():
+            index = int(index)
+        if isinstance(index, int) and 0 <= index < len(obj):
+            return obj[index]
+        return UNDEFINED
+    if isinstance(obj, dict):
+        return obj.get(to_str(name), UNDEFINED)
+    if isinstance(obj, JSRegExp):
+        if name == "source":
+            return obj.source
+        return UNDEFINED
+    if obj is None or obj is UNDEFINED:
+        raise PacError("Cannot read property {} of {}".format(to_str(name), to_str(obj)))
+    return UNDEFINED
+
+
+def set_member(obj: Any, name: Any, value: Any) -> None:
+    if isinstance(obj, dict):
+        obj[to_str(name)] = value
+    elif isinstance(obj, list):
+        index = to_int(name)
+        if index >= len(obj):
+            obj.extend([UNDEFINED] * (index + 1 - len(obj)))
+        obj[index] = value
+    elif obj is None or obj is UNDEFINED:
+        raise PacError("Cannot set property {} of {}".format(to_str(name), to_str(obj)))
+
+
+def call_method(obj: Any, name: str, args: list) -> Any:
+    if isinstance(obj, str):
+        return _string_method(obj, name, args)
+    if isinstance(obj, list):
+        return _array_method(obj, name, args)
+    if isinstance(obj, JSRegExp):
+        if name == "test":
+            return obj.regex.search(to_str(args[0] if args else UNDEFINED)) is not None
+        if name == "exec":
+            match = obj.regex.search(to_str(args[0] if args else UNDEFINED))
+            return None if match is None else [match.group(0)] + list(match.groups())
+    return call(get_member(obj, name), args)
+
+
+def call(fn: Any, args: list) -> Any:
+    if isinstance(fn, JSFunction):
+        return fn(*args)
+    if callable(fn):
+        return fn(*args)
+    raise PacError("{} is not a function".format(to_str(fn)))
+
+
+# --------------------------------------------------------------------------
+# Compiler
+# --------------------------------------------------------------------------
+
+class Scope(object):
+
+    __slots__ = ("vars", "parent")
+
+    def __init__(self, vars: Dict[str, Any], parent: "Scope"=None):
+        self.vars = vars
+        self.parent = parent
+
+
+class Return(object):
+
+    __slots__ = ("value",)
+
+    def __init__(self, value: Any):
+        self.value = value
+
+
+BREAK, CONTINUE = object(), object()
+
+
+class JSFunction(object):
+
+    __slots__ = ("name", "params", "hoisted", "body", "scope")
+
+    def __init__(self, name: str, params: List[str], hoisted: list, body: Callable, scope: Scope):
+        self.name = name
+        self.params = params
+        self.hoisted = hoisted
+        self.body = body
+        self.scope = scope
+
+    def __call__(self, *args: Any) -> Any:
+        local = dict.fromkeys(self.hoisted[0], UNDEFINED)
+        for i, param in enumerate(self.params):
+            local[param] = args[i] if i < len(args) else UNDEFINED
+        local["arguments"] = list(args)
+        scope = Scope(local, self.scope)
+        for name, make in self.hoisted[1]:
+            local[name] = make(scope)
+        signal = self.body(scope)
+        if type(signal) is Return:
+            return signal.value
+        return UNDEFINED
+
+
+def hoist(body: List[tuple]) -> Tuple[List[str], List[tuple]]:
+    """
+    Collects the ``var`` names and function declarations of a function
+    body (without descending into nested functions).
+    """
+    names, funcs = [], []
+
+    def walk(stmt):
+        if stmt is None:
+            return
+        kind = stmt[0]
+        if kind == "var":
+            names.extend(name for name, _ in stmt[1])
+        elif kind == "func":
+            funcs.append(stmt)
+        elif kind == "if":
+            while stmt is not None and stmt[0] == "if":
+                walk(stmt[2])
+                stmt = stmt[3]
+            walk(stmt)
+        elif kind == "block":
+            for s in stmt[1]:
+                walk(s)
+        elif kind == "for":
+            walk(stmt[1])
+            walk(stmt[4])
+        elif kind in ("forin", "forof"):
+            names.append(stmt[1])
+            walk(stmt[3])
+        elif kind == "while":
+            walk(stmt[2])
+
+    for stmt in body:
+        walk(stmt)
+    return names, funcs
+
+
+def flatten(node: tuple, op: str) -> List[tuple]:
+    """
+    Returns the operands of a chain of the same binary operator, e.g. the
+    conditions of ``a || b || c``, without recursing.
+    """
+    operands = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node[0] == "binary" and node[1] == op:
+            stack.append(node[3])
+            stack.append(node[2])
+        else:
+            operands.append(node)
+    return operands
+
+
+def _lookup(name: str) -> Callable[[Scope], Any]:
+    def lookup(scope):
+        while scope is not None:
+            vars = scope.vars
+            if name in vars:
+                return vars[name]
+            scope = scope.parent
+        raise PacError("{} is not defined".format(name))
+    return lookup
+
+
+def _store(name: str) -> Callable[[Scope, Any], None]:
+    def store(scope, value):
+        top = scope
+        while scope is not None:
+            if name in scope.vars:
+                scope.vars[name] = value
+                return
+            top = scope
+            scope = scope.parent
+        top.vars[name] = value
+    return store
+
+
+class Compiler(object):
+    """
+    Turns the AST into nested closures taking a Scope.
+
+    Expression closures return a value; statement closures return None,
+    BREAK, CONTINUE or a Return instance.
+    """
+
+    def function(self, name: str, params: List[str], body: List[tuple]) -> Callable[[Scope], JSFunction]:
+        names, funcs = hoist(body)
+        block = self.block(body)
+        compiled = [(fname, self.function(fname, fparams, fbody)) for _, fname, fparams, fbody in funcs]
+        hoisted = (names, compiled)
+        return lambda scope: JSFunction(name, params, hoisted, block, scope)
+
+    def program(self, body: List[tuple]) -> Callable[[Scope], None]:
+        names, funcs = hoist(body)
+        block = self.block(body)
+        compiled = [(fname, self.function(fname, fparams, fbody)) for _, fname, fparams, fbody in funcs]
+
+        def run(scope):
+            for name in names:
+                scope.vars.setdefault(name, UNDEFINED)
+            for name, make in compiled:
+                scope.vars[name] = make(scope)
+            block(scope)
+        return run
+
+    def block(self, body: List[tuple]) -> Callable[[Scope], Any]:
+        stmts = [self.stmt(s) for s in body if s[0] != "func"]
+        if len(stmts) == 1:
+            return stmts[0]
+
+        def run(scope):
+            for stmt in stmts:
+                signal = stmt(scope)
+                if signal is not None:
+                    return signal
+            return None
+        return run
+
+    def stmt(self, node: tuple) -> Callable[[Scope], Any]:
+        kind = node[0]
+        if kind == "expr":
+            expr = self.expr(node[1])
+
+            def run(scope):
+                expr(scope)
+            return run
+        if kind == "return":
+            expr = self.expr(node[1]) if node[1] is not None else (lambda scope: UNDEFINED)
+            return lambda scope: Return(expr(scope))
+        if kind == "if":
+            branches = []
+            while node is not None and node[0] == "if":
+                branches.append((self.expr(node[1]), self.stmt(node[2])))
+                node = node[3]
+            other = self.stmt(node) if node is not None else (lambda scope: None)
+            if len(branches) == 1:
+                (test, then), = branches
+
+                def run(scope):
+                    if truthy(test(scope)):
+                        return then(scope)
+                    return other(scope)
+                return run
+
+            def run(scope):
+                for test, then in branches:
+                    if truthy(test(scope)):
+                        return then(scope)
+                return other(scope)
+            return run
+        if kind == "block":
+            return self.block(node[1])
+        if kind == "var":
+            assigns = [(_store(name), self.expr(init)) for name, init in node[1] if init is not None]
+
+            def run(scope):
+                for store, init in assigns:
+                    store(scope, init(scope))
+            return run
+        if kind == "func":
+            return lambda scope: None
+        if kind == "for":
+            init = self.stmt(node[1]) if node[1] is not None else (lambda scope: None)
+            test = self.expr(node[2]) if node[2] is not None else (lambda scope: True)
+            update = self.expr(node[3]) if node[3] is not None else (lambda scope: None)
+            body = self.stmt(node[4])
+
+            def run(scope):
+                init(scope)
+                while truthy(test(scope)):
+                    signal = body(scope)
+                    if signal is BREAK:
+                        break
+                    if signal is not None and signal is not CONTINUE:
+                        return signal
+                    update(scope)
+            return run
+        if kind in ("forin", "forof"):
+            store = _store(node[1])
+            expr = self.expr(node[2])
+            body = self.stmt(node[3])
+            keys = kind == "forin"
+
+            def run(scope):
+                obj = expr(scope)
+                if keys:
+                    items = [str(i) for i in range(len(obj))] if isinstance(obj, (list, str)) else list(obj)
+                else:
+                    items = list(obj)
+                for item in items:
+                    store(scope, item)
+                    signal = body(scope)
+                    if signal is BREAK:
+                        break
+                    if signal is not None and signal is not CONTINUE:
+                        return signal
+            return run
+        if kind == "while":
+            test = self.expr(node[1])
+            body = self.stmt(node[2])
+
+            def run(scope):
+                while truthy(test(scope)):
+                    signal = body(scope)
+                    if signal is BREAK:
+                        break
+                    if signal is not None and signal is not CONTINUE:
+                        return signal
+            return run
+        if kind == "break":
+            return lambda scope: BREAK
+        if kind == "continue":
+            return lambda scope: CONTINUE
+        raise PacError("Unsupported statement {}".format(kind))
+
+    def expr(self, node: tuple) -> Callable[[Scope], Any]:
+        kind = node[0]
+        if kind in ("num", "str", "const"):
+            value = node[1]
+            return lambda scope: value
+        if kind == "regex":
+            source, flags = node[1]
+            try:
+                JSRegExp(source, flags)
+            except re.error as e:
+                raise PacError("Invalid regular expression /{}/: {}".format(source, e))
+            return lambda scope: JSRegExp(source, flags)
+        if kind == "name":
+            return _lookup(node[1])
+        if kind == "array":
+            items = [self.expr(i) for i in node[1]]
+            return lambda scope: [i(scope) for i in items]
+        if kind == "object":
+            pairs = [(k, self.expr(v)) for k, v in node[1]]
+            return lambda scope: {k: v(scope) for k, v in pairs}
+        if kind == "funcexpr":
+            return self.function(*node[1:])
+        if kind == "member":
+            obj = self.expr(node[1])
+            name = node[2]
+            return lambda scope: get_member(obj(scope), name)
+        if kind == "index":
+            obj = self.expr(node[1])
+            key = self.expr(node[2])
+            return lambda scope: get_member(obj(scope), key(scope))
+        if kind == "call":
+            return self.call(node)
+        if kind == "unary":
+            return self.unary(node)
+        if kind == "binary":
+            return self.binary(node)
+        if kind == "cond":
+            test, then, other = self.expr(node[1]), self.expr(node[2]), self.expr(node[3])
+            return lambda scope: then(scope) if truthy(test(scope)) else other(scope)
+        if kind == "assign":
+            return self.assign(node)
+        if kind == "update":
+            return self.update(node)
+        raise PacError("Unsupported expression {}".format(kind))
+
+    def call(self, node: tuple) -> Callable[[Scope], Any]:
+        callee = node[1]
+        args = [self.expr(a) for a in node[2]]
+        if callee[0] == "member":
+            obj = self.expr(callee[1])
+            name = callee[2]
+            return lambda scope: call_method(obj(scope), name, [a(scope) for a in args])
+        fn = self.expr(callee)
+        if len(args) == 1:
+            arg = args[0]
+            return lambda scope: call(fn(scope), [arg(scope)])
+        if len(args) == 2:
+            a0, a1 = args
+            return lambda scope: call(fn(scope), [a0(scope), a1(scope)])
+        return lambda scope: call(fn(scope), [a(scope) for a in args])
+
+    def unary(self, node: tuple) -> Callable[[Scope], Any]:
+        op = node[1]
+        operand = self.expr(node[2])
+        if op == "!":
+            return lambda scope: not truthy(operand(scope))
+        if op == "-":
+            return lambda scope: -to_num(operand(scope))
+        if op == "+":
+            return lambda scope: to_num(operand(scope))
+        if op == "~":
+            return lambda scope: ~to_int(operand(scope))
+        if node[2][0] == "name":
+            # typeof on an undeclared name is not an error
+            lookup = operand
+
+            def safe_typeof(scope):
+                try:
+                    return typeof(lookup(scope))
+                except PacError:
+                    return "undefined"
+            return safe_typeof
+        return lambda scope: typeof(operand(scope))
+
+    def binary(self, node: tuple) -> Callable[[Scope], Any]:
+        op = node[1]
+        if op in ("&&", "||"):
+            operands = [self.expr(n) for n in flatten(node, op)]
+            stop = op == "||"
+
+            def run(scope):
+                for operand in operands:
+                    value = operand(scope)
+                    if truthy(value) is stop:
+                        return value
+                return value
+            return run
+        left, right = self.expr(node[2]), self.expr(node[3])
+        if op == ",":
+            return lambda scope: (left(scope), right(scope))[1]
+        if op == "+":
+            return lambda scope: add(left(scope), right(scope))
+        if op == "==":
+            return lambda scope: loose_equals(left(scope), right(scope))
+        if op == "!=":
+            return lambda scope: not loose_equals(left(scope), right(scope))
+        if op == "===":
+            return lambda scope: strict_equals(left(scope), right(scope))
+        if op == "!==":
+            return lambda scope: not strict_equals(left(scope), right(scope))
+        if op in ("<", ">", "<=", ">="):
+            return lambda scope: compare(op, left(scope), right(scope))
+        if op == "in":
+            def run(scope):
+                key, obj = left(scope), right(scope)
+                if isinstance(obj, dict):
+                    return to_str(key) in obj
+                return 0 <= to_int(key) < len(obj)
+            return run
+        fn = ARITHMETIC[op]
+        return lambda scope: fn(left(scope), right(scope))
+
+    def _target(self, target: tuple) -> Tuple[Callable, Callable]:
+        if target[0] == "name":
+            return self.expr(target), _store(target[1])
+        obj = self.expr(target[1])
+        key = (lambda scope: target[2]) if target[0] == "member" else self.expr(target[2])
+        return (lambda scope: get_member(obj(scope), key(scope)),
+                lambda scope, value: set_member(obj(scope), key(scope), value))
+
+    def assign(self, node: tuple) -> Callable[[Scope], Any]:
+        op, target, value = node[1], node[2], self.expr(node[3])
+        load, store = self._target(target)
+        combine = None
+        if op == "+=":
+            combine = add
+        elif op != "=":
+            combine = ARITHMETIC[op[0]]
+
+        def run(scope):
+            result = value(scope)
+            if combine is not None:
+                result = combine(load(scope), result)
+            store(scope, result)
+            return result
+        return run
+
+    def update(self, node: tuple) -> Callable[[Scope], Any]:
+        delta = 1 if node[1] == "++" else -1
+        prefix = node[2]
+        load, store = self._target(node[3])
+
+        def run(scope):
+            old = to_num(load(scope))
+            store(scope, old + delta)
+            return old + delta if prefix else old
+        return run
+
+
+# --------------------------------------------------------------------------
+# PAC helper functions
+# --------------------------------------------------------------------------
+
+def local_address() -> str:
+    """
+    Best guess of the primary local IPv4 address (no packet is sent).
+    """
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.connect(("192.0.2.1", 80))
+            return sock.getsockname()[0]
+        finally:
+            sock.close()
+    except OSError:
+        return "127.0.0.1"
+
+
+WEEKDAYS = ("MON", "TUE", "WED", "THU", "FRI", "SAT", "SUN")
+MONTHS = ("JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT", "NOV", "DEC")
+
+_SH_EXP_CACHE = {}
+
+
+def sh_exp_match(text: Any, pattern: Any) -> bool:
+    pattern = to_str(pattern)
+    regex = _SH_EXP_CACHE.get(pattern)
+    if regex is None:
+        parts = ("." if c == "?" else ".*" if c == "*" else re.escape(c) for c in pattern)
+        regex = _SH_EXP_CACHE[pattern] = re.compile("".join(parts), re.S)
+    return regex.fullmatch(to_str(text)) is not None
+
+
+def _in_range(value: int, low: int, high: int) -> bool:
+    if low <= high:
+        return low <= value <= high
+    return value >= low or value <= high
+
+
+class PacHelpers(object):
+    """
+    The standard PAC helper API. ``resolver`` maps a host name to an IPv4
+    address string (or None), by default through the shared DnsCache, and
+    ``clock`` returns the current datetime.
+    """
+
+    def __init__(self, resolver: Callable[[str], str]=None, my_ip: str=None,
+                 clock: Callable[[], datetime.datetime]=None):
+        self.resolver = resolver or dnscache.shared().get
+        self.my_ip = my_ip
+        self.clock = clock or datetime.datetime.now
+
+    def namespace(self) -> Dict[str, Any]:
+        return {
+            "isPlainHostName": self.isPlainHostName,
+            "dnsDomainIs": self.dnsDomainIs,
+            "localHostOrDomainIs": self.localHostOrDomainIs,
+            "isResolvable": self.isResolvable,
+            "isInNet": self.isInNet,
+            "dnsResolve": self.dnsResolve,
+            "convert_addr": self.convert_addr,
+            "myIpAddress": self.myIpAddress,
+            "dnsDomainLevels": self.dnsDomainLevels,
+            "shExpMatch": sh_exp_match,
+            "weekdayRange": self.weekdayRange,
+            "dateRange": self.dateRange,
+            "timeRange": self.timeRange,
+            "alert": lambda *args: UNDEFINED,
+            "parseInt": self.parseInt,
+            "isNaN": lambda value=UNDEFINED: to_num(value) != to_num(value),
+            "String": lambda value="": to_str(value),
+            "Number": lambda value=0: to_num(value),
+        }
+
+    @staticmethod
+    def isPlainHostName(host: Any=UNDEFINED) -> bool:
+        return "." not in to_str(host)
+
+    @staticmethod
+    def dnsDomainIs(host: Any=UNDEFINED, domain: Any=UNDEFINED) -> bool:
+        return to_str(host).lower().endswith(to_str(domain).lower())
+
+    @staticmethod
+    def localHostOrDomainIs(host: Any=UNDEFINED, hostdom: Any=UNDEFINED) -> bool:
+        host, hostdom = to_str(host).lower(), to_str(hostdom).lower()
+        if host == hostdom:
+            return True
+        return "." not in host and hostdom.startswith(host + ".")
+
+    @staticmethod
+    def dnsDomainLevels(host: Any=UNDEFINED) -> int:
+        return to_str(host).count(".")
+
+    @staticmethod
+    def convert_addr(ip: Any=UNDEFINED) -> int:
+        try:
+            return int(ipaddress.IPv4Address(to_str(ip)))
+        except ValueError:
+            return 0
+
+    @staticmethod
+    def parseInt(value: Any=UNDEFINED, radix: Any=10) -> Any:
+        match = re.match(r"\s*([-+]?[0-9a-zA-Z]+)", to_str(value))
+        if match is None:
+            return float("nan")
+        text, base = match.group(1), to_int(radix) or 10
+        for end in range(len(text), 0, -1):
+            try:
+                return int(text[:end], base)
+            except ValueError:
+                continue
+        return float("nan")
+
+    def dnsResolve(self, host: Any=UNDEFINED) -> Any:
+        host = to_str(host)
+        try:
+            ipaddress.ip_address(host)
+            return host
+        except ValueError:
+            return self.resolver(host)
+
+    def isResolvable(self, host: Any=UNDEFINED) -> bool:
+        return self.dnsResolve(host) is not None
+
+    def isInNet(self, host: Any=UNDEFINED, pattern: Any=UNDEFINED, mask: Any=UNDEFINED) -> bool:
+        addr = self.dnsResolve(host)
+        if addr is None:
+            return False
+        try:
+            value = int(ipaddress.IPv4Address(addr))
+            net = int(ipaddress.IPv4Address(to_str(pattern)))
+            bits = int(ipaddress.IPv4Address(to_str(mask)))
+        except ValueError:
+            return False
+        return value & bits == net & bits
+
+    def myIpAddress(self) -> str:
+        if self.my_ip is None:
+            self.my_ip = local_address()
+        return self.my_ip
+
+    def _gmt(self, args: tuple) -> Tuple[tuple, datetime.datetime]:
+        if args and to_str(args[-1]) == "GMT":
+            return args[:-1], datetime.datetime.utcnow()
+        return args, self.clock()
+
+    def weekdayRange(self, *args: Any) -> bool:
+        args, now = self._gmt(args)
+        days = [WEEKDAYS.index(to_str(a).upper()) for a in args if to_str(a).upper() in WEEKDAYS]
+        if not days:
+            return False
+        today = now.weekday()
+        return today == days[0] if len(days) == 1 else _in_range(today, days[0], days[1])
+
+    def timeRange(self, *args: Any) -> bool:
+        args, now = self._gmt(args)
+        nums = [to_int(a) for a in args]
+        current = now.hour * 3600 + now.minute * 60 + now.second
+        if len(nums) == 1:
+            return now.hour == nums[0]
+        if len(nums) == 2:
+            low, high = nums[0] * 3600, nums[1] * 3600 - 1
+        elif len(nums) == 4:
+            low, high = nums[0] * 3600 + nums[1] * 60, nums[2] * 3600 + nums[3] * 60 - 1
+        elif len(nums) == 6:
+            low = nums[0] * 3600 + nums[1] * 60 + nums[2]
+            high = nums[3] * 3600 + nums[4] * 60 + nums[5]
+        else:
+            return False
+        return _in_range(current, low, high)
+
+    def dateRange(self, *args: Any) -> bool:
+        args, now = self._gmt(args)
+        fields = []
+        for arg in args:
+            text = to_str(arg).upper()
+            if text in MONTHS:
+                fields.append(("month", MONTHS.index(text) + 1))
+            else:
+                num = to_int(arg)
+                fields.append(("year", num) if num > 31 else ("day", num))
+        if not fields:
+            return False
+        kinds = [k for k, _ in fields]
+        if len(fields) % 2 == 1 or kinds[:len(kinds) // 2] != kinds[len(kinds) // 2:]:
+            if len(fields) == 1:
+                kind, value = fields[0]
+                return {"day": now.day, "month": now.month, "year": now.year}[kind] == value
+            return False
+        half = len(fields) // 2
+        order = {"year": 0, "month": 1, "day": 2}
+        pick = sorted(set(kinds[:half]), key=order.get)
+        current = tuple(getattr(now, k) for k in pick)
+        low = tuple(dict(fields[:half])[k] for k in pick)
+        high = tuple(dict(fields[half:])[k] for k in pick)
+        if "year" in pick:
+            return low <= current <= high
+        return _in_range(current, low, high) if low > high else low <= current <= high
+
+
+# --------------------------------------------------------------------------
+# Public API
+# --------------------------------------------------------------------------
+
+class PacScript(object):
+    """
+    A compiled PAC script. Top-level declarations share one scope with the
+    helper functions; FindProxyForURL must be among them.
+
+    Raises:
+        PacError - If the script cannot be parsed or has no FindProxyForURL.
+    """
+
+    def __init__(self, source: str, helpers: PacHelpers=None):
+        self.source = source
+        self.helpers = helpers or PacHelpers()
+        self.ast = Parser(source).program()
+        self.globals = Scope(self.helpers.namespace())
+        Compiler().program(self.ast)(self.globals)
+        self.find = self.globals.vars.get("FindProxyForURL")
+        if not isinstance(self.find, JSFunction):
+            raise PacError("Invalid PAC script: FindProxyForURL is not defined")
+
+    def find_proxy(self, url: str, host: str) -> str:
+        """
+        Runs FindProxyForURL.
+
+        Returns:
+            str - The PAC answer, e.g. "PROXY p:8080; DIRECT".
+
+        Raises:
+            PacError - On runtime errors in the script.
+        """
+        try:
+            return to_str(self.find(url, host))
+        except (RecursionError, TypeError, re.error) as e:
+            raise PacError(str(e))
+
+
+class DecisionCache(object):
+    """
+    LRU cache of PAC answers keyed by (scheme, host). Thread-safe: the
+    forwarding proxy reads it on its event loop while the evaluator
+    thread fills it.
+
+    Args:
+        size (int) - Maximum number of entries kept.
+        ttl (float) - Seconds an answer stays valid; 0 keeps it until evicted.
+    """
+
+    def __init__(self, size: int=65536, ttl: float=0):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Tuple[str, str]) -> str:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            answer, expires = entry
+            if expires and expires < time.monotonic():
+                del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return answer
+
+    def put(self, key: Tuple[str, str], answer: str) -> None:
+        expires = time.monotonic() + self.ttl if self.ttl else 0
+        with self.lock:
+            self.entries[key] = (answer, expires)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+URL_HOST = re.compile(r"([^:/?#]*)://(?:[^@/?#]*@)?(?:\[([^\]]*)\]|([^:/?#]*))")
+
+
+def split_url(url: str) -> Tuple[str, str]:
+    """
+    Extracts (scheme, host) from a URL; cheaper than urllib for the
+    well-formed URLs PAC lookups deal with.
+    """
+    match = URL_HOST.match(url)
+    if match is None:
+        return "", url.lower()
+    scheme, ipv6, host = match.groups()
+    return scheme.lower(), (host if ipv6 is None else ipv6).lower()
+
+
+class PacEngine(object):
+    """
+    Answers "which proxy does this URL use" with a per-host decision cache.
+
+    The cache assumes the script decides on scheme and host only, which
+    holds for the vast majority of PAC files; pass ``cache=None`` to run
+    the script for every URL. Script errors answer "DIRECT", like browsers.
+    """
+
+    FALLBACK = "DIRECT"
+
+    def __init__(self, script: PacScript, cache: DecisionCache=UNDEFINED):
+        self.script = script
+        self.cache = DecisionCache() if cache is UNDEFINED else cache
+        self.errors = 0
+
+    @classmethod
+    def from_source(cls, source: str, helpers: PacHelpers=None, **kwargs) -> "PacEngine":
+        return cls(PacScript(source, helpers), **kwargs)
+
+    @classmethod
+    def from_url(cls, url: str, fetcher: "PacFetcher"=None, helpers: PacHelpers=None,
+                 **kwargs) -> "PacEngine":
+        """
+        Downloads and compiles a PAC file, e.g. the one returned by
+        ProxyHelper.read_pac_link().
+        """
+        from pacfetch import PacFetcher
+        fetcher = fetcher or PacFetcher()
+        body = fetcher.fetch(url).body
+        return cls.from_source(body.decode("utf-8", "replace"), helpers, **kwargs)
+
+    def evaluate(self, url: str) -> str:
+        scheme, host = split_url(url)
+        cache = self.cache
+        if cache is not None:
+            key = (scheme, host)
+            answer = cache.get(key)
+            if answer is not None:
+                return answer
+        return self.compute(url)
+
+    def cached(self, url: str) -> str:
+        """
+        Returns:
+            str - The cached answer for ``url``, or None.
+        """
+        return self.cache.get(split_url(url)) if self.cache is not None else None
+
+    def compute(self, url: str) -> str:
+        """
+        Runs the script for ``url`` and caches its answer, bypassing the
+        cache lookup; evaluate() is cached() followed by compute().
+        """
+        scheme, host = split_url(url)
+        try:
+            answer = self.decide(url, host)
+        except PacError:
+            self.errors += 1
+            return self.FALLBACK
+        if self.cache is not None:
+            self.cache.put((scheme, host), answer)
+        return answer
+
+    def decide(self, url: str, host: str) -> str:
+        return self.script.find_proxy(url, host)
+
+    def evaluate_many(self, urls: Iterable[str]) -> Iterator[Tuple[str, str]]:
+        """
+        Streams (url, answer) pairs for an iterable of URLs, e.g. the lines
+        of an access log; nothing is buffered.
+        """
+        evaluate = self.evaluate
+        for url in urls:
+            url = url.strip()
+            if url:
+                yield url, evaluate(url)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import json
+import hashlib
+import threading
+import http.client
+
+from collections import OrderedDict
+from typing import Dict, Tuple
+from urllib.parse import urlparse, urljoin
+
+
+class PacResponse(object):
+
+    __slots__ = ("url", "status", "body", "etag", "last_modified", "from_cache")
+
+    def __init__(self, url: str, status: int, body: bytes, etag: str="",
+                 last_modified: str="", from_cache: bool=False):
+        self.url = url
+        self.status = status
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.from_cache = from_cache
+
+
+class ConnectionPool(object):
+    """
+    Keep-alive HTTP(S) connections, pooled per (scheme, host, port).
+    """
+
+    def __init__(self, timeout: float=10.0, max_idle: int=4):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, scheme: str, host: str, port: int) -> http.client.HTTPConnection:
+        key = (scheme, host, port)
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                return conns.pop()
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def release(self, scheme: str, conn: http.client.HTTPConnection) -> None:
+        key = (scheme, conn.host, conn.port)
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def close(self) -> None:
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+class DiskCache(object):
+    """
+    Size-bounded on-disk cache of PAC bodies with LRU eviction.
+
+    Bodies are stored under the SHA-1 of their URL; validators (ETag and
+    Last-Modified) and the recency order live in a small JSON index.
+    """
+
+    INDEX = "index.json"
+
+    def __init__(self, directory: str, max_bytes: int=8 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(os.path.join(directory, self.INDEX), "r") as file_:
+                self.entries.update(json.load(file_))
+        except (OSError, ValueError):
+            pass
+        self.size = sum(e["size"] for e in self.entries.values())
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def path(self, url: str) -> str:
+        return os.path.join(self.directory, self.key(url))
+
+    def _save_index(self) -> None:
+        tmp = os.path.join(self.directory, self.INDEX + ".tmp")
+        with open(tmp, "w") as file_:
+            json.dump(list(self.entries.items()), file_)
+        os.replace(tmp, os.path.join(self.directory, self.INDEX))
+
+    def validators(self, url: str) -> Dict[str, str]:
+        with self.lock:
+            entry = self.entries.get(url)
+            return dict(entry) if entry else {}
+
+    def get(self, url: str) -> bytes:
+        """
+        Returns:
+            bytes - The cached body, or None when missing.
+        """
+        with self.lock:
+            if url not in self.entries:
+                return None
+            self.entries.move_to_end(url)
+        try:
+            with open(self.path(url), "rb") as file_:
+                return file_.read()
+        except OSError:
+            self.discard(url)
+            return None
+
+    def put(self, url: str, body: bytes, etag: str="", last_modified: str="") -> None:
+        if len(body) > self.max_bytes:
+            return
+        tmp = self.path(url) + ".tmp"
+        with open(tmp, "wb") as file_:
+            file_.write(body)
+        os.replace(tmp, self.path(url))
+        with self.lock:
+            old = self.entries.pop(url, None)
+            if old is not None:
+                self.size -= old["size"]
+            self.entries[url] = {"etag": etag, "last_modified": last_modified, "size": len(body)}
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                stale, entry = self.entries.popitem(last=False)
+                self.size -= entry["size"]
+                try:
+                    os.remove(self.path(stale))
+                except OSError:
+                    pass
+            self._save_index()
+
+    def discard(self, url: str) -> None:
+        with self.lock:
+            entry = self.entries.pop(url, None)
+            if entry is None:
+                return
+            self.size -= entry["size"]
+            self._save_index()
+        try:
+            os.remove(self.path(url))
+        except OSError:
+            pass
+
+
+class PacFetcher(object):
+    """
+    Downloads PAC files, revalidating cached copies with conditional GETs.
+    """
+
+    MAX_SIZE = 1 << 20
+    MAX_REDIRECTS = 3
+    REDIRECTS = (301, 302, 303, 307, 308)
+    MARKER = b"FindProxyForURL"
+
+    def __init__(self, cache: DiskCache=None, pool: ConnectionPool=None,
+                 max_size: int=MAX_SIZE):
+        self.cache = cache
+        self.pool = pool if pool is not None else ConnectionPool()
+        self.max_size = max_size
+
+    def _request(self, url: str, headers: Dict[str, str]) -> Tuple[int, Dict[str, str], bytes]:
+        parts = urlparse(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+        for attempt in (0, 1):
+            conn = self.pool.acquire(parts.scheme, parts.hostname, port)
+            try:
+                conn.request("GET", target, headers=headers)
+                resp = conn.getresponse()
+                length = resp.getheader("Content-Length")
+                if length is not None and int(length) > self.max_size:
+                    conn.close()
+                    raise ValueError("PAC file too large ({} bytes)".format(length))
+                body = resp.read(self.max_size + 1)
+                if len(body) > self.max_size:
+                    conn.close()
+                    raise ValueError("PAC file too large")
+                resp_headers = {k.lower(): v for k, v in resp.getheaders()}
+                if resp.will_close:
+                    conn.close()
+                else:
+                    self.pool.release(parts.scheme, conn)
+                return resp.status, resp_headers, body
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # Stale keep-alive connection; retry once on a fresh one
+                conn.close()
+                if attempt:
+                    raise
+            except Exception:
+                conn.close()
+                raise
+
+    def fetch(self, url: str) -> PacResponse:
+        """
+        Downloads a PAC file, using the cache when it is still valid.
+
+        Returns:
+            PacResponse - The PAC body and its validators.
+
+        Raises:
+            ValueError - If the answer is not a usable PAC file.
+            OSError - On network errors.
+        """
+        headers = {"Accept": "application/x-ns-proxy-autoconfig, */*"}
+        cached = self.cache.validators(url) if self.cache else {}
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+        target = url
+        for _ in range(self.MAX_REDIRECTS + 1):
+            status, resp_headers, body = self._request(target, headers)
+            if status not in self.REDIRECTS or "location" not in resp_headers:
+                break
+            target = urljoin(target, resp_headers["location"])
+        else:
+            raise ValueError("Too many redirects")
+        if status == 304 and cached:
+            body = self.cache.get(url)
+            if body is not None:
+                return PacResponse(url, status, body, cached.get("etag", ""),
+                                   cached.get("last_modified", ""), True)
+            return self.fetch(url)
+        if status != 200:
+            raise ValueError("HTTP {}".format(status))
+        if self.MARKER not in body:
+            raise ValueError("Not a PAC file")
+        etag = resp_headers.get("etag", "")
+        last_modified = resp_headers.get("last-modified", "")
+        if self.cache:
+            self.cache.put(url, body, etag, last_modified)
+        return PacResponse(url, status, body, etag, last_modified)
+
+    def check(self, url: str) -> Tuple[bool, str]:
+        try:
+            self.fetch(url)
+        except Exception as e:
+            return False, str(e)
+        return True, ""
+
+    def close(self) -> None:
+        self.pool.close()
@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Static compilation of PAC host rules.
+
+Most PAC files are long chains of ``if (<host test>) return "<answer>";``
+statements. The rules whose tests are dnsDomainIs/shExpMatch/isInNet/
+isPlainHostName checks on the host are lowered into a reversed-label
+suffix trie and a CIDR radix tree; a lookup then finds the first matching
+rule without walking the chain. As soon as the chain reaches a statement
+that cannot be lowered, lookups that found no earlier rule fall back to
+running the script.
+"""
+
+import json
+import hashlib
+import ipaddress
+
+from typing import Any, Dict, List, Set, Tuple
+from pac import PacScript, PacEngine, DecisionCache, flatten, hoist, UNDEFINED
+
+
+MISS = float("inf")
+
+
+class Unsupported(Exception):
+    pass
+
+
+class PacIndex(object):
+    """
+    Compiled lookup structures for the host rules of a PAC script.
+
+    Trie nodes are plain dicts so the index serializes to JSON as is:
+    ``c`` maps a label to its child, ``e`` is the rule matching the node's
+    name exactly, ``s`` the rule matching strict subdomains and ``p`` maps
+    a suffix of the next label to the rule it matches.
+    Radix nodes are ``[zero, one, rule]`` lists over the address bits.
+    """
+
+    VERSION = 1
+
+    def __init__(self, digest: str, answers: List[str], trie: Dict[str, Any]=None,
+                 radix: list=None, plain: float=MISS, always: float=MISS):
+        self.digest = digest
+        self.answers = answers
+        self.trie = trie if trie is not None else {}
+        self.radix = radix
+        self.plain = plain
+        self.always = always
+        self.radix_min = MISS
+
+    @staticmethod
+    def hash_source(source: str) -> str:
+        return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+    # ------------------------------------------------------------------
+    # Compilation
+    # ------------------------------------------------------------------
+
+    @classmethod
+    def compile(cls, script: PacScript) -> "PacIndex":
+        """
+        Lowers the leading host rules of FindProxyForURL.
+        """
+        fn = script.find
+        index = cls(cls.hash_source(script.source), [])
+        host = fn.params[1] if len(fn.params) > 1 else None
+        assigned = cls._assigned(script.ast)
+        local = cls._locals(script.ast)
+        top, funcs = hoist(script.ast)
+        # Helpers the script redefines (globally or inside FindProxyForURL)
+        # are not the ones the index implements
+        shadowed = local | assigned | set(top) | {f[1] for f in funcs}
+        constants = {name: value for name, value in cls._constants(script, assigned).items()
+                     if name not in local}
+        # Rules after the first statement that cannot be lowered are left
+        # out: hosts matching none of the lowered rules run the script.
+        for stmt in cls._rules(script.ast):
+            try:
+                conds, answer = cls._rule(stmt, host, constants, shadowed)
+            except Unsupported:
+                break
+            if conds is None:
+                continue
+            rule = len(index.answers)
+            index.answers.append(answer)
+            for cond in conds:
+                index._insert(cond, rule)
+        index.radix_min = index._radix_min()
+        return index
+
+    @staticmethod
+    def _assigned(ast: List[tuple]) -> Set[str]:
+        """
+        Names assigned or updated anywhere in the script.
+        """
+        assigned = set()
+        stack = list(ast)
+        while stack:
+            node = stack.pop()
+            if isinstance(node, tuple):
+                if node and node[0] in ("assign", "update"):
+                    target = node[2] if node[0] == "assign" else node[3]
+                    if target[0] == "name":
+                        assigned.add(target[1])
+                stack.extend(node)
+            elif isinstance(node, list):
+                stack.extend(node)
+        return assigned
+
+    @staticmethod
+    def _locals(ast: List[tuple]) -> Set[str]:
+        """
+        Names FindProxyForURL declares itself: its parameters and its var
+        and function declarations, which are hoisted over the whole body.
+        """
+        names = set()
+        for stmt in ast:
+            if stmt[0] == "func" and stmt[1] == "FindProxyForURL":
+                hoisted, funcs = hoist(stmt[3])
+                names = set(stmt[2]) | set(hoisted) | {f[1] for f in funcs}
+        return names
+
+    @staticmethod
+    def _constants(script: PacScript, assigned: Set[str]) -> Dict[str, str]:
+        """
+        Top-level string variables that are never reassigned.
+        """
+        values = {}
+        for stmt in script.ast:
+            if stmt[0] == "var":
+                for name, init in stmt[1]:
+                    if init is not None and init[0] == "str" and name not in assigned:
+                        values[name] = init[1]
+        return values
+
+    @staticmethod
+    def _rules(ast: List[tuple]) -> List[tuple]:
+        """
+        Flattens the FindProxyForURL body into a list of statements, turning
+        ``if (a) return x; else <rest>`` into ``if (a) return x; <rest>``.
+        """
+        body = []
+        for stmt in ast:
+            if stmt[0] == "func" and stmt[1] == "FindProxyForURL":
+                body = list(stmt[3])
+        rules = []
+        pending = list(reversed(body))
+        while pending:
+            stmt = pending.pop()
+            if stmt[0] == "block":
+                pending.extend(reversed(stmt[1]))
+            elif stmt[0] == "if" and stmt[3] is not None:
+                rules.append(("if", stmt[1], stmt[2], None))
+                pending.append(stmt[3])
+            else:
+                rules.append(stmt)
+        return rules
+
+    @classmethod
+    def _rule(cls, stmt: tuple, host: str, constants: Dict[str, str], shadowed: Set[str]) -> Tuple[list, str]:
+        """
+        Returns (conditions, answer) for a lowerable rule, (None, None) for
+        a statement without effect on the answer.
+
+        Raises:
+            Unsupported - If the statement cannot be lowered.
+        """
+        kind = stmt[0]
+        if kind == "expr":
+            # host = host.toLowerCase(): hosts are looked up in lower case
+            expr = stmt[1]
+            if (expr[0] == "assign" and expr[1] == "=" and expr[2] == ("name", host)
+                    and expr[3][0] == "call" and not expr[3][2]
+                    and expr[3][1] == ("member", ("name", host), "toLowerCase")):
+                return None, None
+            raise Unsupported()
+        if kind == "return":
+            return [("always",)], cls._answer(stmt[1], constants)
+        if kind != "if":
+            raise Unsupported()
+        then = stmt[2]
+        while then[0] == "block" and len(then[1]) == 1:
+            then = then[1][0]
+        if then[0] != "return":
+            raise Unsupported()
+        answer = cls._answer(then[1], constants)
+        return [cls._condition(c, host, shadowed) for c in flatten(stmt[1], "||")], answer
+
+    @staticmethod
+    def _answer(expr: tuple, constants: Dict[str, str]) -> str:
+        if expr is not None and expr[0] == "str":
+            return expr[1]
+        if expr is not None and expr[0] == "name" and expr[1] in constants:
+            return constants[expr[1]]
+        raise Unsupported()
+
+    @staticmethod
+    def _string(node: tuple) -> str:
+        if node[0] != "str":
+            raise Unsupported()
+        return node[1]
+
+    @classmethod
+    def _condition(cls, node: tuple, host: str, shadowed: Set[str]) -> tuple:
+        if node[0] != "call" or node[1][0] != "name" or node[1][1] in shadowed:
+            raise Unsupported()
+        name, args = node[1][1], node[2]
+        if not args or args[0] != ("name", host):
+            if (name == "isInNet" and args and "dnsResolve" not in shadowed
+                    and args[0] == ("call", ("name", "dnsResolve"), [("name", host)])):
+                args = [("name", host)] + args[1:]
+            else:
+                raise Unsupported()
+        if name == "isPlainHostName" and len(args) == 1:
+            return ("plain",)
+        if name == "dnsDomainIs" and len(args) == 2:
+            return ("suffix", cls._string(args[1]).lower())
+        if name == "shExpMatch" and len(args) == 2:
+            pattern = cls._string(args[1])
+            if pattern != pattern.lower() or "?" in pattern:
+                raise Unsupported()
+            if "*" not in pattern:
+                return ("exact", pattern)
+            if pattern == "*":
+                return ("always",)
+            if pattern.startswith("*") and "*" not in pattern[1:]:
+                return ("suffix", pattern[1:])
+            raise Unsupported()
+        if name == "isInNet" and len(args) == 3:
+            try:
+                net = ipaddress.IPv4Network("{}/{}".format(cls._string(args[1]), cls._string(args[2])),
+                                            strict=False)
+            except ValueError:
+                raise Unsupported()
+            return ("net", int(net.network_address), net.prefixlen)
+        raise Unsupported()
+
+    def _node(self, labels: List[str]) -> Dict[str, Any]:
+        node = self.trie
+        for label in labels:
+            node = node.setdefault("c", {}).setdefault(label, {})
+        return node
+
+    def _insert(self, cond: tuple, rule: int) -> None:
+        kind = cond[0]
+        if kind == "always":
+            self.always = min(self.always, rule)
+        elif kind == "plain":
+            self.plain = min(self.plain, rule)
+        elif kind == "exact":
+            node = self._node(cond[1].split(".")[::-1])
+            node.setdefault("e", rule)
+        elif kind == "suffix":
+            suffix = cond[1]
+            if suffix == "":
+                self.always = min(self.always, rule)
+            elif suffix.startswith("."):
+                node = self._node(suffix[1:].split(".")[::-1])
+                node.setdefault("s", rule)
+            else:
+                labels = suffix.split(".")[::-1]
+                node = self._node(labels[:-1])
+                node.setdefault("p", {}).setdefault(labels[-1], rule)
+        elif kind == "net":
+            _, addr, bits = cond
+            if self.radix is None:
+                self.radix = [None, None, None]
+            node = self.radix
+            for i in range(bits):
+                bit = (addr >> (31 - i)) & 1
+                if node[bit] is None:
+                    node[bit] = [None, None, None]
+                node = node[bit]
+            if node[2] is None:
+                node[2] = rule
+
+    def _radix_min(self) -> float:
+        if self.radix is None:
+            return MISS
+        best, stack = MISS, [self.radix]
+        while stack:
+            node = stack.pop()
+            if node[2] is not None and node[2] < best:
+                best = node[2]
+            stack.extend(n for n in node[:2] if n is not None)
+        return best
+
+    # ------------------------------------------------------------------
+    # Lookup
+    # ------------------------------------------------------------------
+
+    def match_host(self, host: str) -> float:
+        """
+        Returns:
+            The index of the first rule matching on the host name, or MISS.
+        """
+        best = self.always
+        if self.plain < best and "." not in host:
+            best = self.plain
+        labels = host.split(".")
+        remaining = len(labels)
+        node = self.trie
+        for label in reversed(labels):
+            partial = node.get("p")
+            if partial is not None:
+                for i in range(len(label)):
+                    rule = partial.get(label[i:], MISS)
+                    if rule < best:
+                        best = rule
+            child = node.get("c", {}).get(label)
+            if child is None:
+                return best
+            node = child
+            remaining -= 1
+            rule = node.get("s" if remaining else "e", MISS)
+            if rule < best:
+                best = rule
+        return best
+
+    def match_addr(self, addr: str, best: float=MISS) -> float:
+        try:
+            value = int(ipaddress.IPv4Address(addr))
+        except ValueError:
+            return best
+        node = self.radix
+        for i in range(32):
+            if node[2] is not None and node[2] < best:
+                best = node[2]
+            node = node[(value >> (31 - i)) & 1]
+            if node is None:
+                return best
+        if node[2] is not None and node[2] < best:
+            best = node[2]
+        return best
+
+    def lookup(self, host: str, resolve=None) -> str:
+        """
+        Args:
+            host (str) - Lower-case host name.
+            resolve (callable) - dnsResolve used by isInNet rules.
+
+        Returns:
+            str - The answer of the first matching rule, or None when the
+            script has to be evaluated.
+        """
+        best = self.match_host(host)
+        if self.radix_min < best:
+            addr = host if resolve is None else resolve(host)
+            if addr is not None and addr is not UNDEFINED:
+                best = self.match_addr(addr, best)
+        if best == MISS:
+            return None
+        return self.answers[best]
+
+    # ------------------------------------------------------------------
+    # Serialization
+    # ------------------------------------------------------------------
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "version": self.VERSION,
+            "digest": self.digest,
+            "answers": self.answers,
+            "trie": self.trie,
+            "radix": self.radix,
+            "plain": None if self.plain == MISS else self.plain,
+            "always": None if self.always == MISS else self.always,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "PacIndex":
+        if data.get("version") != cls.VERSION:
+            raise ValueError("Invalid format")
+        index = cls(data["digest"], data["answers"], data["trie"], data["radix"],
+                    MISS if data["plain"] is None else data["plain"],
+                    MISS if data["always"] is None else data["always"])
+        index.radix_min = index._radix_min()
+        return index
+
+    def save(self, filepath: str) -> None:
+        with open(filepath, "w") as file_:
+            json.dump(self.to_dict(), file_, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, filepath: str, script: PacScript=None) -> "PacIndex":
+        """
+        Loads a saved index; when ``script`` is given, an index compiled
+        from another source is rejected with ValueError.
+        """
+        with open(filepath, "r") as file_:
+            index = cls.from_dict(json.load(file_))
+        if script is not None and index.digest != cls.hash_source(script.source):
+            raise ValueError("Index does not match the PAC script")
+        return index
+
+
+class IndexedPacEngine(PacEngine):
+    """
+    PacEngine answering from a PacIndex and running the script only when
+    the index cannot decide.
+    """
+
+    def __init__(self, script: PacScript, index: PacIndex=None, cache: DecisionCache=UNDEFINED):
+        PacEngine.__init__(self, script, cache)
+        self.index = index if index is not None else PacIndex.compile(script)
+        self.fallbacks = 0
+
+    def decide(self, url: str, host: str) -> str:
+        answer = self.index.lookup(host, self.script.helpers.dnsResolve)
+        if answer is None:
+            self.fallbacks += 1
+            answer = self.script.find_proxy(url, host)
+        return answer
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import re
+import gzip
+import asyncio
+import hashlib
+import functools
+import threading
+
+from typing import Dict, Tuple
+from pac import PacScript, PacError
+from pacfetch import PacFetcher
+
+
+COMMENTS = re.compile(r"""
+    ("(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')   # strings are kept
+  | //[^\n]*                                    # line comment
+  | /\*.*?\*/                                   # block comment
+""", re.S | re.X)
+
+
+def minify(source: str) -> str:
+    """
+    Drops comments, indentation and blank lines. Line breaks are kept so
+    scripts relying on automatic semicolon insertion still work; if the
+    result does not parse, the source is returned unchanged.
+    """
+    def strip(match):
+        if match.group(1):
+            return match.group(1)
+        return "\n" if "\n" in match.group(0) else ""
+
+    text = COMMENTS.sub(strip, source)
+    text = "\n".join(line.strip() for line in text.splitlines() if line.strip())
+    try:
+        PacScript(text)
+    except PacError:
+        return source
+    return text
+
+
+@functools.lru_cache(maxsize=64)
+def accepts_gzip(accept_encoding: str) -> bool:
+    """
+    Whether an Accept-Encoding value allows a gzip body: "gzip" (or "*"
+    when gzip is not listed) with a non-zero q-value. Clients send the same
+    few values, so answers are cached.
+    """
+    wildcard = None
+    for token in accept_encoding.lower().split(","):
+        coding, _, params = token.partition(";")
+        coding = coding.strip()
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding == "gzip":
+            return quality > 0
+        if coding == "*":
+            wildcard = quality > 0
+    return bool(wildcard)
+
+
+class PacResponses(object):
+    """
+    Prebuilt HTTP responses for one PAC body: identity and gzip variants
+    for GET and HEAD, plus the 304 answer. Built once per body, so serving
+    a request is a single buffer write.
+    """
+
+    CONTENT_TYPE = "application/x-ns-proxy-autoconfig"
+
+    def __init__(self, body: bytes):
+        self.etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+        self.plain = self.build(body, "")
+        self.gzip = self.build(gzip.compress(body, 9, mtime=0), "gzip")
+        self.not_modified = (
+            "HTTP/1.1 304 Not Modified\r\n"
+            "ETag: {}\r\n"
+            "Content-Length: 0\r\n\r\n".format(self.etag)
+        ).encode("ascii")
+
+    def build(self, payload: bytes, encoding: str) -> Tuple[bytes, bytes]:
+        headers = [
+            "HTTP/1.1 200 OK",
+            "Content-Type: {}".format(self.CONTENT_TYPE),
+            "Content-Length: {}".format(len(payload)),
+            "ETag: {}".format(self.etag),
+            "Cache-Control: max-age=300",
+            "Vary: Accept-Encoding",
+        ]
+        if encoding:
+            headers.append("Content-Encoding: {}".format(encoding))
+        head = ("\r\n".join(headers) + "\r\n\r\n").encode("ascii")
+        return head + payload, head
+
+
+class PacServer(object):
+    """
+    Localhost HTTP server for a mirrored PAC file.
+
+    Serves ``/proxy.pac`` (and ``/wpad.dat``) with strong ETags and a
+    precompressed gzip variant over keep-alive connections.
+    """
+
+    PATHS = ("/proxy.pac", "/wpad.dat")
+    MAX_HEADER = 8192
+    IDLE_TIMEOUT = 30.0
+
+    NOT_FOUND = b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n"
+    BAD_REQUEST = b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+    NOT_ALLOWED = b"HTTP/1.1 405 Method Not Allowed\r\nAllow: GET, HEAD\r\nContent-Length: 0\r\n\r\n"
+
+    def __init__(self, body: bytes, host: str="127.0.0.1", port: int=0, minified: bool=True):
+        self.host = host
+        self.port = port
+        self.minified = minified
+        self.server = None
+        self.loop = None
+        self.thread = None
+        self.requests = 0
+        self.tasks = set()
+        self.link = ""
+        self.fetcher = None
+        self.update(body)
+
+    @classmethod
+    def mirror(cls, link: str, fetcher: PacFetcher=None, **kwargs) -> "PacServer":
+        """
+        Creates a server for a copy of the PAC file at ``link``.
+        """
+        server = cls(b"", **kwargs)
+        server.link = link
+        server.fetcher = fetcher or PacFetcher()
+        server.refresh()
+        return server
+
+    def refresh(self) -> bool:
+        """
+        Revalidates the mirrored copy against its origin.
+
+        Returns:
+            bool - Whether the served body changed.
+        """
+        body = self.fetcher.fetch(self.link).body
+        if body == self.body:
+            return False
+        self.update(body)
+        return True
+
+    def update(self, body: bytes) -> None:
+        self.body = body
+        if self.minified and body:
+            body = minify(body.decode("utf-8", "replace")).encode("utf-8")
+        self.responses = PacResponses(body)
+
+    @property
+    def url(self) -> str:
+        return "http://{}:{}{}".format(self.host, self.port, self.PATHS[0])
+
+    def respond(self, head: bytes) -> Tuple[bytes, bool]:
+        """
+        Builds the answer to one request head.
+
+        Returns:
+            tuple - Response bytes and whether to keep the connection open.
+        """
+        lines = head.decode("latin-1").split("\r\n")
+        parts = lines[0].split(" ")
+        if len(parts) != 3:
+            return self.BAD_REQUEST, False
+        method, target, version = parts
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+        if method not in ("GET", "HEAD"):
+            return self.NOT_ALLOWED, keep_alive
+        if target.split("?", 1)[0] not in self.PATHS:
+            return self.NOT_FOUND, keep_alive
+        responses = self.responses
+        if responses.etag in headers.get("if-none-match", ""):
+            return responses.not_modified, keep_alive
+        variant = responses.gzip if accepts_gzip(headers.get("accept-encoding", "")) else responses.plain
+        return variant[0] if method == "GET" else variant[1], keep_alive
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.IDLE_TIMEOUT)
+                except asyncio.LimitOverrunError:
+                    writer.write(self.BAD_REQUEST)
+                    break
+                self.requests += 1
+                response, keep_alive = self.respond(head[:-4])
+                writer.write(response)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            self.tasks.discard(task)
+            writer.close()
+
+    async def start(self) -> "PacServer":
+        self.server = await asyncio.start_server(self.handle, self.host, self.port,
+                                                 limit=self.MAX_HEADER, backlog=1024)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            for task in list(self.tasks):
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            await self.server.wait_closed()
+            self.server = None
+
+    def start_in_thread(self) -> "PacServer":
+        """
+        Runs the server on its own event loop in a daemon thread, e.g. next
+        to the wx main loop.
+        """
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            self.loop.run_until_complete(self.start())
+            ready.set()
+            self.loop.run_forever()
+            self.loop.run_until_complete(self.stop())
+            self.loop.close()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self
+
+    def stop_thread(self) -> None:
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop = self.thread = None
@@ -0,0 +1,193 @@
+# #!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import json
+import hashlib
+import threading
+
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from reg import IEWindowsRegEditor
+from metrics import METRICS
+
+
+class Profile(object):
+    """
+    Named proxy configuration: a PAC URL, a manual proxy server, or
+    neither (direct connection).
+    """
+
+    __slots__ = ("name", "pac_url", "proxy_server")
+
+    def __init__(self, name: str, pac_url: str="", proxy_server: str=""):
+        if pac_url and proxy_server:
+            raise ValueError("A profile uses either a PAC URL or a proxy server")
+        self.name = name
+        self.pac_url = pac_url
+        self.proxy_server = proxy_server
+
+    @property
+    def auto_config(self) -> str:
+        return self.pac_url
+
+    def encode(self, base: bytes) -> bytes:
+        """
+        DefaultConnectionSettings for this profile, derived from ``base``.
+        """
+        if self.proxy_server:
+            return IEWindowsRegEditor.alter_proxy_reg(True, base, self.proxy_server)
+        return IEWindowsRegEditor.alter_bin_reg(bool(self.pac_url), base, self.pac_url)
+
+    def describe(self) -> str:
+        if self.pac_url:
+            return "PAC {}".format(self.pac_url)
+        if self.proxy_server:
+            return "proxy {}".format(self.proxy_server)
+        return "direct"
+
+    def to_dict(self) -> dict:
+        return {"pac_url": self.pac_url, "proxy_server": self.proxy_server}
+
+    @classmethod
+    def from_dict(cls, name: str, data: dict) -> "Profile":
+        return cls(name, data.get("pac_url", ""), data.get("proxy_server", ""))
+
+
+class ProfileStore(object):
+    """
+    Named profiles, kept in the backup directory, with a cache of their
+    encoded DefaultConnectionSettings.
+
+    A profile's blob only depends on the profile and on the blob it is
+    derived from, so encodings are cached under (profile, digest of the base
+    blob). While the base blob is unchanged a switch is a straight write of
+    the cached bytes; at most ``cache_size`` encodings are kept, least
+    recently used first out, so encodings of base blobs that no longer occur
+    age away. The store is shared by the GUI thread and the worker, so
+    every method runs under one lock.
+    """
+
+    FILE = "profiles.json"
+
+    def __init__(self, directory: str, cache_size: int=32):
+        self.directory = directory
+        self.path = os.path.join(directory, self.FILE)
+        self.cache_size = cache_size
+        self.profiles = OrderedDict() # type: Dict[str, Profile]
+        self.cache = OrderedDict() # type: Dict[str, bytes]
+        self.hits = self.misses = 0
+        self.dirty = False
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "r") as file_:
+                data = json.load(file_)
+        except (OSError, ValueError):
+            return
+        for name, profile in data.get("profiles", {}).items():
+            self.profiles[name] = Profile.from_dict(name, profile)
+        for key, blob in data.get("encoded", []):
+            self.cache[key] = bytes.fromhex(blob)
+
+    def save(self) -> None:
+        with self.lock:
+            data = {
+                "profiles": {name: p.to_dict() for name, p in self.profiles.items()},
+                "encoded": [[key, blob.hex()] for key, blob in self.cache.items()],
+            }
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.path + ".tmp", "w") as file_:
+                json.dump(data, file_, indent=1)
+            os.replace(self.path + ".tmp", self.path)
+            self.dirty = False
+
+    def names(self) -> List[str]:
+        with self.lock:
+            return list(self.profiles)
+
+    def get(self, name: str) -> Optional[Profile]:
+        with self.lock:
+            return self.profiles.get(name)
+
+    def add(self, profile: Profile) -> None:
+        with self.lock:
+            self.discard_encodings(profile.name)
+            self.profiles[profile.name] = profile
+            self.dirty = True
+
+    def remove(self, name: str) -> bool:
+        with self.lock:
+            if self.profiles.pop(name, None) is None:
+                return False
+            self.discard_encodings(name)
+            self.dirty = True
+            return True
+
+    def match(self, auto_config: str, blob: bytes) -> str:
+        """
+        Name of the profile the given settings correspond to, i.e. the one
+        whose switch would change nothing; "" when none does.
+        """
+        with self.lock:
+            profiles = list(self.profiles.items())
+        for name, profile in profiles:
+            try:
+                if profile.auto_config == auto_config and profile.encode(blob) == blob:
+                    return name
+            except ValueError:
+                continue
+        return ""
+
+    def discard_encodings(self, name: str) -> None:
+        prefix = name + "\0"
+        with self.lock:
+            for key in [k for k in self.cache if k.startswith(prefix)]:
+                del self.cache[key]
+
+    @staticmethod
+    def fingerprint(blob: bytes) -> str:
+        return hashlib.blake2b(blob, digest_size=8).hexdigest()
+
+    def encoded(self, profile: Profile, base: bytes) -> bytes:
+        """
+        ``profile.encode(base)``, from the cache when possible.
+        """
+        key = "{}\0{}".format(profile.name, self.fingerprint(base))
+        with self.lock:
+            blob = self.cache.get(key)
+            if blob is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                METRICS.count("profiles.cache_hits")
+                return blob
+            self.misses += 1
+        METRICS.count("profiles.cache_misses")
+        blob = profile.encode(base)
+        with self.lock:
+            self.cache[key] = blob
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            self.dirty = True
+        return blob
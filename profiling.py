@@ -0,0 +1,284 @@
+# #!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Opt-in profiling, for reports like "Install PAC file freezes".
+
+Enabled with ``--profile MODE`` or the IPSX_PROFILE environment variable
+(``sample``, ``ops`` or ``all``); nothing here is imported or installed
+otherwise, so the normal run pays nothing.
+
+- ``sample``: a thread samples every thread's stack for the whole session
+  and writes session.collapsed (counts of samples).
+- ``ops``: every ProxyHelper entry point runs under a deterministic tracer
+  on its own thread and writes <operation>.collapsed (microseconds of self
+  time); nested entry points count towards the outermost one.
+
+Collapsed files have one "frame;frame;frame weight" line per stack, the
+input of flamegraph.pl, speedscope or inferno. summary.txt lists the top
+functions by self time of each profile.
+"""
+
+import os
+import sys
+import time
+import threading
+import functools
+
+from collections import Counter
+from typing import Dict, List, Tuple
+from res import PROFILE_ENV, PROFILE_DIR_ENV, PROFILE_DIR
+
+
+MODES = ("sample", "ops", "all")
+
+
+def frame_name(code) -> str:
+    return "{}:{}".format(os.path.basename(code.co_filename), code.co_name).replace(" ", "_")
+
+
+def builtin_name(fn) -> str:
+    return "{}:{}".format(getattr(fn, "__module__", None) or "builtins",
+                          getattr(fn, "__qualname__", repr(fn))).replace(" ", "_")
+
+
+def top_functions(stacks: Counter, count: int=15) -> List[Tuple[str, int, int]]:
+    """
+    Returns:
+        list - (function, self weight, total weight) by decreasing self
+            weight; a recursive function counts once per stack in total.
+    """
+    own, total = Counter(), Counter()
+    for stack, weight in stacks.items():
+        frames = stack.split(";")
+        own[frames[-1]] += weight
+        for name in set(frames):
+            total[name] += weight
+    return [(name, weight, total[name]) for name, weight in own.most_common(count)]
+
+
+def write_collapsed(path: str, stacks: Counter) -> None:
+    with open(path, "w") as f:
+        for stack, weight in sorted(stacks.items()):
+            if weight:
+                f.write("{} {}\n".format(stack, weight))
+
+
+class Sampler(object):
+    """
+    Samples the stacks of all threads every ``interval`` seconds.
+    """
+
+    def __init__(self, interval: float=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.running = threading.Event()
+        self.thread = None
+
+    def sample(self) -> None:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        own = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(frame_name(frame.f_code))
+                frame = frame.f_back
+            frames.append(names.get(ident, "thread-{}".format(ident)).replace(" ", "_"))
+            self.stacks[";".join(reversed(frames))] += 1
+        self.samples += 1
+
+    def run(self) -> None:
+        while self.running.is_set():
+            self.sample()
+            time.sleep(self.interval)
+
+    def start(self) -> "Sampler":
+        self.running.set()
+        self.thread = threading.Thread(target=self.run, name="ipsx-profiler", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+class StackTracer(object):
+    """
+    Deterministic profiler for the current thread: every Python and C call
+    is tracked and the time between two events is charged, in nanoseconds,
+    to the stack active in between.
+    """
+
+    def __init__(self, stacks: Counter, root: str):
+        self.stacks = stacks
+        self.paths = [root]
+        self.last = 0
+
+    def event(self, frame, event: str, arg) -> None:
+        now = time.perf_counter_ns()
+        self.stacks[self.paths[-1]] += now - self.last
+        if event == "call":
+            self.paths.append(self.paths[-1] + ";" + frame_name(frame.f_code))
+        elif event == "c_call":
+            self.paths.append(self.paths[-1] + ";" + builtin_name(arg))
+        elif len(self.paths) > 1:
+            self.paths.pop()
+        self.last = time.perf_counter_ns()
+
+    def __enter__(self) -> "StackTracer":
+        self.previous = sys.getprofile()
+        self.last = time.perf_counter_ns()
+        sys.setprofile(self.event)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        sys.setprofile(self.previous)
+        self.stacks[self.paths[-1]] += time.perf_counter_ns() - self.last
+
+
+class Profiler(object):
+    """
+    One profiling session; see the module docstring. Files go to
+    ``directory`` when it stops.
+    """
+
+    def __init__(self, mode: str="all", directory: str=PROFILE_DIR, interval: float=0.005):
+        if mode not in MODES:
+            raise ValueError("Unknown profiling mode {}".format(mode))
+        self.mode = mode
+        self.directory = directory
+        self.sampler = Sampler(interval) if mode in ("sample", "all") else None
+        self.operations = {} # type: Dict[str, Counter]
+        self.calls = Counter()
+        self.slowest = {} # type: Dict[str, float]
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.patched = [] # type: List[Tuple[type, str, object]]
+        self.started = 0.0
+
+    @classmethod
+    def from_env(cls, mode: str=None, directory: str=None) -> "Profiler":
+        """
+        Profiler for the flag value ``mode`` or else the environment; None
+        when profiling is off. Boolean-looking values switch every mode on;
+        an unknown value only warns, so a stray variable never stops the
+        application from starting.
+        """
+        mode = (mode or os.environ.get(PROFILE_ENV, "")).strip().lower()
+        if mode in ("", "0", "off", "false", "no"):
+            return None
+        if mode in ("1", "on", "true", "yes"):
+            mode = "all"
+        if mode not in MODES:
+            sys.stderr.write("Ignoring {}={!r}: expected one of {}\n".format(
+                PROFILE_ENV, mode, ", ".join(MODES)))
+            return None
+        directory = directory or os.environ.get(PROFILE_DIR_ENV) or PROFILE_DIR
+        return cls(mode, directory)
+
+    def profiled(self, name: str, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if getattr(self.local, "active", False):
+                return fn(*args, **kwargs)
+            self.local.active = True
+            stacks = Counter()
+            start = time.perf_counter()
+            try:
+                with StackTracer(stacks, name):
+                    return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.local.active = False
+                with self.lock:
+                    self.operations.setdefault(name, Counter()).update(stacks)
+                    self.calls[name] += 1
+                    self.slowest[name] = max(self.slowest.get(name, 0.0), elapsed)
+        return wrapper
+
+    def instrument(self, cls: type, prefix: str, skip: Tuple[str, ...]=()) -> None:
+        """
+        Wraps the public classmethods of ``cls`` in place until stop().
+        """
+        for name, attr in list(vars(cls).items()):
+            if isinstance(attr, classmethod) and not name.startswith("_") and name not in skip:
+                self.patched.append((cls, name, attr))
+                setattr(cls, name, classmethod(self.profiled(prefix + name, attr.__func__)))
+
+    def start(self) -> "Profiler":
+        self.started = time.perf_counter()
+        if self.mode in ("ops", "all"):
+            from proxy import ProxyHelper
+            self.instrument(ProxyHelper, "proxy.", skip=("editor", "store", "profiles", "for_hive"))
+        if self.sampler is not None:
+            self.sampler.start()
+        return self
+
+    def stop(self) -> List[str]:
+        """
+        Restores the instrumented classes and writes the profiles.
+
+        Returns:
+            list - Paths of the files written.
+        """
+        if self.sampler is not None:
+            self.sampler.stop()
+        while self.patched:
+            cls, name, attr = self.patched.pop()
+            setattr(cls, name, attr)
+        return self.write()
+
+    def summary(self, count: int=15) -> List[str]:
+        lines = ["mode {}, {:.2f}s".format(self.mode, time.perf_counter() - self.started)]
+        if self.sampler is not None:
+            lines += ["", "session: {} samples every {:.0f} ms (self, total samples)".format(
+                self.sampler.samples, self.sampler.interval * 1000)]
+            lines += ["  {:>7} {:>7}  {}".format(own, total, name)
+                      for name, own, total in top_functions(self.sampler.stacks, count)]
+        for op in sorted(self.operations):
+            total_ms = sum(self.operations[op].values()) / 1e6
+            lines += ["", "{}: {} calls, {:.1f} ms traced, slowest call {:.1f} ms (self, total ms)".format(
+                op, self.calls[op], total_ms, self.slowest[op] * 1000)]
+            lines += ["  {:>9.3f} {:>9.3f}  {}".format(own / 1e6, total / 1e6, name)
+                      for name, own, total in top_functions(self.operations[op], count)]
+        return lines
+
+    def write(self) -> List[str]:
+        os.makedirs(self.directory, exist_ok=True)
+        paths = []
+        if self.sampler is not None:
+            paths.append(os.path.join(self.directory, "session.collapsed"))
+            write_collapsed(paths[-1], self.sampler.stacks)
+        for op, stacks in self.operations.items():
+            # Weights in microseconds
+            paths.append(os.path.join(self.directory, "{}.collapsed".format(op)))
+            write_collapsed(paths[-1], Counter({s: w // 1000 for s, w in stacks.items()}))
+        paths.append(os.path.join(self.directory, "summary.txt"))
+        with open(paths[-1], "w") as f:
+            f.write("\n".join(self.summary()) + "\n")
+        return paths
@@ -20,70 +20,412 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from typing import Tuple
-from res import OK, FAIL
+import os
+
+from typing import Callable
+from res import BACKUP_ERR, PAC_FETCH_ERR, APPLY_JOURNAL, HIVES_DIR, WPAD_ERR, NO_SETTINGS_ERR
+from res import BACKUP_REG, LEGACY_BACKUP_REG
 from reg import IEWindowsRegEditor
-from util import FileWriter, hex_dump
+from codec import ConnectionSettings
+from transaction import Transaction
+from metrics import timed
+from backend import RegistryBackend
+from backupstore import BackupStore, read_legacy
+from profiles import Profile, ProfileStore
+
+
+class Result(object):
+    """
+    Outcome of a ProxyHelper operation: a status message on success, an
+    error message on failure, and an optional value (e.g. a backup version).
+    """
+
+    __slots__ = ("ok", "status", "error", "value")
+
+    def __init__(self, ok: bool, status: str="", error: str="", value=None):
+        self.ok = ok
+        self.status = status
+        self.error = error
+        self.value = value
+
+    @classmethod
+    def success(cls, status: str="", value=None) -> "Result":
+        return cls(True, status, "", value)
+
+    @classmethod
+    def failure(cls, error: str) -> "Result":
+        return cls(False, "", error)
+
+    @property
+    def message(self) -> str:
+        return self.status if self.ok else self.error
+
+    def __bool__(self) -> bool:
+        return self.ok
+
+    def __repr__(self) -> str:
+        return "Result(ok={!r}, message={!r})".format(self.ok, self.message)
 
 
 class ProxyHelper(object):
 
     EMPTY_STRING = ""
-    last_error, last_status = "", ""
     backup_file = ""
+    journal_file = APPLY_JOURNAL
+    backend = None # type: RegistryBackend
+    backup_store = None # type: BackupStore
+    profile_store = None # type: ProfileStore
+    hive = None # type: str
+
+    @classmethod
+    @timed("proxy.editor")
+    def editor(cls) -> IEWindowsRegEditor:
+        return IEWindowsRegEditor(cls.backend, cls.hive)
+
+    @classmethod
+    def for_hive(cls, sid: str) -> type:
+        """
+        A ProxyHelper bound to another user's hive under HKEY_USERS. It has
+        its own backups, profiles and journal in a per-SID directory of
+        backup_file, so hives can be handled concurrently.
+        """
+        directory = os.path.join(cls.backup_file, HIVES_DIR, sid)
+        return type(cls.__name__, (cls,), {
+            "hive": sid,
+            "backup_file": directory,
+            "journal_file": os.path.join(directory, APPLY_JOURNAL),
+            "backup_store": None,
+            "profile_store": None,
+        })
 
     @classmethod
+    @timed("proxy.read_pac_link")
     def read_pac_link(cls) -> str:
-        net = IEWindowsRegEditor()
         try:
-            return net.read_auto_config()
+            with cls.editor() as net:
+                return net.read_auto_config()
         except:
             return cls.EMPTY_STRING
 
     @classmethod
-    def backup(cls) -> Tuple[bool, str]:
-        fw = FileWriter(cls.backup_file)
-        net = IEWindowsRegEditor()
-        fw.add(net.read_default_connection_settings())
-        fw.add(net.read_saved_legacy_settings())
-        ok, err = fw.binary_dump()
-        if ok:
-            cls.last_status = "Created backup at {}".format(cls.backup_file)
-        cls.last_error = err
-        return ok, err
+    @timed("proxy.store")
+    def store(cls) -> BackupStore:
+        """
+        The backup store, into which a backup file left by an older version
+        is imported on first use.
+        """
+        if cls.backup_store is None or cls.backup_store.directory != cls.backup_file:
+            legacy = cls.legacy_backup()
+            store = BackupStore(cls.backup_file)
+            if legacy and store.latest() is None:
+                try:
+                    default, saved = read_legacy(legacy)
+                    url = ConnectionSettings.decode(default).auto_config_url
+                except (OSError, ValueError):
+                    # Not a settings blob; leave it alone
+                    default = None
+                if default is not None:
+                    store.snapshot({
+                        IEWindowsRegEditor.AUTO_CONFIG_REGVAL: url.decode(ConnectionSettings.ENCODING),
+                        IEWindowsRegEditor.CONNECTION_SETTINGS: default,
+                        IEWindowsRegEditor.LEGACY_SETTINGS: saved,
+                    })
+            cls.backup_store = store
+        return cls.backup_store
+
+    @classmethod
+    def legacy_backup(cls) -> str:
+        """
+        Path of a single-file backup written by older versions, or "". One
+        found at backup_file itself is moved aside first, since that path
+        is now the store's directory.
+        """
+        moved = cls.backup_file + ".legacy"
+        if os.path.isfile(cls.backup_file):
+            os.replace(cls.backup_file, moved)
+        if os.path.isfile(moved):
+            return moved
+        if cls.backup_file == BACKUP_REG and os.path.isfile(LEGACY_BACKUP_REG):
+            return LEGACY_BACKUP_REG
+        return ""
+
+    @classmethod
+    @timed("proxy.profiles")
+    def profiles(cls) -> ProfileStore:
+        """
+        Named profiles, kept next to the backups.
+        """
+        if cls.profile_store is None or cls.profile_store.directory != cls.backup_file:
+            cls.store() # moves a legacy backup file out of the way
+            cls.profile_store = ProfileStore(cls.backup_file)
+        return cls.profile_store
+
+    @classmethod
+    @timed("proxy.read_settings")
+    def read_settings(cls, net: IEWindowsRegEditor) -> dict:
+        try:
+            auto_config = net.read_auto_config()
+        except OSError:
+            auto_config = cls.EMPTY_STRING
+        return {
+            IEWindowsRegEditor.AUTO_CONFIG_REGVAL: auto_config,
+            IEWindowsRegEditor.CONNECTION_SETTINGS: net.read_default_connection_settings(),
+            IEWindowsRegEditor.LEGACY_SETTINGS: net.read_saved_legacy_settings(),
+        }
+
+    @classmethod
+    @timed("proxy.backup")
+    def backup(cls) -> Result:
+        try:
+            with cls.editor() as net:
+                version = cls.store().snapshot(cls.read_settings(net))
+        except Exception as e:
+            return Result.failure(str(e))
+        return Result.success("Created backup #{} at {}".format(version, cls.backup_file), version)
+
+    @classmethod
+    @timed("proxy.apply")
+    def apply(cls, auto_config: str, alter: Callable[[bytes], bytes]) -> Result:
+        """
+        Writes AutoConfigURL and both Connections values as one journaled
+        transaction; ``alter`` maps the current DefaultConnectionSettings
+        to the new one. The value is the number of values actually written;
+        fails without writing when DefaultConnectionSettings is missing.
+        """
+        with cls.editor() as net:
+            txn = Transaction(net, cls.journal_file)
+            bytez_in = txn.read(IEWindowsRegEditor.CONNECTION_SETTINGS)
+            if bytez_in is None:
+                return Result.failure(NO_SETTINGS_ERR)
+            bytez_out = alter(bytez_in)
+            txn.set(IEWindowsRegEditor.AUTO_CONFIG_REGVAL, auto_config)
+            txn.set(IEWindowsRegEditor.CONNECTION_SETTINGS, bytez_out)
+            txn.set(IEWindowsRegEditor.LEGACY_SETTINGS, bytez_out)
+            return Result.success(value=txn.commit())
+
+    @classmethod
+    @timed("proxy.recover")
+    def recover(cls, forward: bool=True) -> Result:
+        """
+        Finishes (or with ``forward`` False, undoes) an apply that was
+        interrupted, e.g. by a crash. Succeeds with an empty status when
+        there was nothing to recover.
+        """
+        try:
+            with cls.editor() as net:
+                count = Transaction.recover(net, cls.journal_file, forward)
+        except Exception as e:
+            return Result.failure("Cannot recover interrupted change: {}".format(e))
+        if count is None:
+            return Result.success()
+        return Result.success("Interrupted change {} ({} values written)".format(
+            "completed" if forward else "rolled back", count), count)
+
+    @classmethod
+    @timed("proxy.restore_backup")
+    def restore_backup(cls, version: int=None) -> Result:
+        try:
+            values = cls.store().load(version)
+            with cls.editor() as net:
+                txn = Transaction(net, cls.journal_file)
+                for name in (IEWindowsRegEditor.AUTO_CONFIG_REGVAL,
+                             IEWindowsRegEditor.CONNECTION_SETTINGS,
+                             IEWindowsRegEditor.LEGACY_SETTINGS):
+                    txn.set(name, values[name])
+                txn.commit()
+            version = cls.store().entry(version)["version"]
+        except Exception as e:
+            return Result.failure("Cannot restore backup: {}".format(e))
+        return Result.success("Restored backup #{}".format(version), version)
+
+    @classmethod
+    @timed("proxy.restore_defaults")
+    def restore_defaults(cls) -> Result:
+        try:
+            applied = cls.apply(cls.EMPTY_STRING, lambda bytez_in: IEWindowsRegEditor.alter_bin_reg(False, bytez_in))
+            if not applied:
+                return applied
+        except Exception as e:
+            return Result.failure(str(e))
+        return Result.success("Proxy configuration disabled!")
+
+    @classmethod
+    @timed("proxy.install_pac_file")
+    def install_pac_file(cls, link: str) -> Result:
+        try:
+            applied = cls.apply(link, lambda bytez_in: IEWindowsRegEditor.alter_bin_reg(True, bytez_in, link))
+            if not applied:
+                return applied
+        except Exception as e:
+            return Result.failure(str(e))
+        return Result.success("Proxy configuration enabled on your system!", link)
+
+    @classmethod
+    @timed("proxy.backup_and_install")
+    def backup_and_install(cls, link: str, fetcher: "PacFetcher"=None) -> Result:
+        """
+        The whole "Install PAC file" action: optionally downloads the PAC
+        file, backs up the current settings and installs ``link``. Slow
+        (network and disk), so the GUI runs it on its Worker.
+        """
+        if fetcher is not None:
+            ok, err = fetcher.check(link)
+            if not ok:
+                return Result.failure(PAC_FETCH_ERR.format(err))
+        result = cls.backup()
+        if not result:
+            return Result.failure(BACKUP_ERR.format(result.error))
+        return cls.install_pac_file(link)
+
+    @classmethod
+    @timed("proxy.install_fastest")
+    def install_fastest(cls, mirrors: "MirrorSet") -> Result:
+        """
+        Probes every mirror of the PAC file concurrently and installs the
+        fastest healthy one; the Result value is that mirror's Probe.
+        """
+        best = mirrors.fastest()
+        if best is None:
+            return Result.failure(PAC_FETCH_ERR.format("no mirror answered"))
+        result = cls.backup_and_install(best.url)
+        if not result:
+            return result
+        return Result.success("{} Using {} ({:.0f} ms).".format(result.status, best.url, best.latency * 1000), best)
+
+    @classmethod
+    @timed("proxy.discover_and_install")
+    def discover_and_install(cls, discovery: "WpadDiscovery", fresh: bool=False) -> Result:
+        """
+        Finds the network's PAC file by WPAD and installs it like a typed
+        URL, which also sets the auto-detect bit; the value is the URL. A
+        cached URL that no longer installs is forgotten.
+        """
+        url = discovery.discover(fresh)
+        if url is None:
+            return Result.failure(WPAD_ERR)
+        result = cls.backup_and_install(url)
+        if not result:
+            discovery.cache.discard(discovery.network())
+            return result
+        return Result.success("{} Discovered {}.".format(result.status, url), url)
+
+    @classmethod
+    @timed("proxy.switch_profile")
+    def switch_profile(cls, name: str) -> Result:
+        """
+        Applies a named profile. The encoded settings come from the profile
+        cache while DefaultConnectionSettings is unchanged, so a switch back
+        and forth between profiles is one read and the writes.
+        """
+        try:
+            profiles = cls.profiles()
+            profile = profiles.get(name)
+            if profile is None:
+                return Result.failure("Unknown profile {}".format(name))
+            applied = cls.apply(profile.auto_config, lambda bytez_in: profiles.encoded(profile, bytez_in))
+            if not applied:
+                return applied
+            if profiles.dirty:
+                profiles.save()
+        except Exception as e:
+            return Result.failure(str(e))
+        return Result.success("Switched to profile {} ({})".format(name, profile.describe()), name)
 
     @classmethod
-    def restore_defaults(cls) -> "ProxyHelper":
-        net = IEWindowsRegEditor()
-        net.write_auto_config(cls.EMPTY_STRING)
-        bytez_in = net.read_default_connection_settings()
-        bytez_out = IEWindowsRegEditor.alter_bin_reg(False, bytez_in)
-        net.write_default_connection_settings(bytez_out)
-        net.write_saved_legacy_settings(bytez_out)
-        cls.last_status = "Proxy configuration disabled!"
-        return cls
+    @timed("proxy.save_profile")
+    def save_profile(cls, profile: Profile) -> Result:
+        try:
+            profiles = cls.profiles()
+            profiles.add(profile)
+            profiles.save()
+        except Exception as e:
+            return Result.failure(str(e))
+        return Result.success("Saved profile {} ({})".format(profile.name, profile.describe()), profile.name)
 
     @classmethod
-    def install_pac_file(cls, link: str) -> "ProxyHelper":
-        net = IEWindowsRegEditor()
-        net.write_auto_config(link)
-        bytez_in = net.read_default_connection_settings()
-        bytez_out = IEWindowsRegEditor.alter_bin_reg(True, bytez_in, link)
-        net.write_default_connection_settings(bytez_out)
-        net.write_saved_legacy_settings(bytez_out)
-        cls.last_status = "Proxy configuration enabled on your system!"
-        return cls
+    @timed("proxy.remove_profile")
+    def remove_profile(cls, name: str) -> Result:
+        try:
+            profiles = cls.profiles()
+            if not profiles.remove(name):
+                return Result.failure("Unknown profile {}".format(name))
+            profiles.save()
+        except Exception as e:
+            return Result.failure(str(e))
+        return Result.success("Removed profile {}".format(name), name)
 
     @classmethod
-    def save(cls) -> bytes:
-        if cls.last_error != cls.EMPTY_STRING:
-            return FAIL
-        return OK
+    @timed("proxy.active_profile")
+    def active_profile(cls) -> str:
+        try:
+            with cls.editor() as net:
+                auto_config = cls.read_pac_link()
+                return cls.profiles().match(auto_config, net.read_default_connection_settings())
+        except Exception:
+            return cls.EMPTY_STRING
 
     @classmethod
-    def get_last_error(cls) -> str:
-        return cls.last_error
+    @timed("proxy.install_local_pac_file")
+    def install_local_pac_file(cls, server: "PacServer") -> Result:
+        """
+        Points the system at a running local PacServer instead of the
+        remote PAC URL.
+        """
+        return cls.install_pac_file(server.url)
 
     @classmethod
-    def get_last_status(cls) -> str:
-        return cls.last_status
+    @timed("proxy.install_local_proxy")
+    def install_local_proxy(cls, proxy: "ForwardingProxy") -> Result:
+        """
+        Points the system at a running local ForwardingProxy, which routes
+        requests by the PAC decision itself.
+        """
+        try:
+            applied = cls.apply(cls.EMPTY_STRING,
+                                lambda bytez_in: IEWindowsRegEditor.alter_proxy_reg(True, bytez_in, proxy.address))
+            if not applied:
+                return applied
+        except Exception as e:
+            return Result.failure(str(e))
+        return Result.success("Local proxy enabled at {}".format(proxy.address), proxy.address)
+
+    @classmethod
+    @timed("proxy.set_proxy_server")
+    def set_proxy_server(cls, server: str, bypass: list=None) -> Result:
+        """
+        Sets (or with an empty ``server``, clears) the manual proxy, leaving
+        the auto config URL in place so both can be combined. ``bypass``,
+        when given, replaces the bypass list in the same write.
+        """
+        try:
+            auto_config = cls.read_pac_link()
+            applied = cls.apply(auto_config, lambda bytez_in: IEWindowsRegEditor.alter_settings(
+                bytez_in, auto_config, server, bypass))
+            if not applied:
+                return applied
+        except Exception as e:
+            return Result.failure(str(e))
+        if not server.strip():
+            return Result.success("Manual proxy disabled")
+        return Result.success("Manual proxy set to {}".format(server.strip()), server.strip())
+
+    @classmethod
+    @timed("proxy.edit_bypass")
+    def edit_bypass(cls, add: list=(), remove: list=(), replace: list=None) -> Result:
+        """
+        Bulk edit of the proxy bypass list: ``replace`` (when not None)
+        swaps the whole list, then ``add`` and ``remove`` are applied. The
+        value is the resulting number of entries.
+        """
+        try:
+            auto_config = cls.read_pac_link()
+            applied = cls.apply(auto_config, lambda bytez_in: IEWindowsRegEditor.alter_settings(
+                bytez_in, auto_config, None, replace, list(add), list(remove)))
+            if not applied:
+                return applied
+            with cls.editor() as net:
+                settings = ConnectionSettings.decode(net.read_default_connection_settings())
+            count = len(settings.bypass_entries())
+        except Exception as e:
+            return Result.failure(str(e))
+        return Result.success("Bypass list updated ({} entries)".format(count), count)
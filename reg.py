@@ -20,9 +20,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import winreg
 import struct
 
+from codec import ConnectionSettings
+from metrics import METRICS, timed
+from backend import RegistryBackend, KeyCache, WinRegBackend
+from backend import HKEY_CURRENT_USER, HKEY_USERS, KEY_ALL_ACCESS, REG_SZ, REG_BINARY
+
 
 class IEWindowsRegEditor(object):
     """
@@ -66,16 +70,30 @@ class IEWindowsRegEditor(object):
         "Connections"
     )
 
-    HKEY = winreg.HKEY_CURRENT_USER
-    ACCESS = winreg.KEY_ALL_ACCESS
+    HKEY = HKEY_CURRENT_USER
+    ACCESS = KEY_ALL_ACCESS
 
-    def __init__(self):
-        self.query = winreg.QueryValueEx
-        self.ropen = winreg.OpenKey
-        self.rsave = winreg.SetValueEx
+    def __init__(self, backend: RegistryBackend=None, hive: str=None):
+        self.backend = backend if backend is not None else WinRegBackend()
+        # A user's hive under HKEY_USERS, by SID, instead of HKEY_CURRENT_USER
+        self.hive = hive
+        self.hkey, self.prefix = (self.HKEY, ()) if hive is None else (HKEY_USERS, (hive,))
+        self.keys = KeyCache(self.backend)
         self.auto_config_path = -1
         self.connection_settings_path = len(self.COMPLETE_REG_PATH)
 
+    def __enter__(self) -> "IEWindowsRegEditor":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Closes every registry handle opened by this editor.
+        """
+        self.keys.close()
+
     def rfind(self, path: tuple) -> tuple:
         """
         Registry finder. Creates ready-to-use params for the registry opener.
@@ -86,11 +104,12 @@ class IEWindowsRegEditor(object):
         Returns:
             tuple - Registry opener parameter arguments.
         """
-        return self.HKEY, "\\".join(path), 0, self.ACCESS
+        return self.hkey, "\\".join(self.prefix + path), 0, self.ACCESS
 
     def get_reg(self, index: int) -> "PyHKEY":
         """
         Registry opener. Retrieves the handle object of the Windows Registry.
+        Handles are cached, so one operation opens each key only once.
 
         Args:
             index (int) - Stop index of the registry path.
@@ -98,8 +117,8 @@ class IEWindowsRegEditor(object):
         Returns:
             Windows HKEY
         """
-        params = self.rfind(self.COMPLETE_REG_PATH[:index])
-        return self.ropen(*params)
+        hkey, path, _, access = self.rfind(self.COMPLETE_REG_PATH[:index])
+        return self.keys.get(hkey, path, access)
 
     def read_auto_config(self) -> str:
         """
@@ -108,9 +127,7 @@ class IEWindowsRegEditor(object):
         Returns:
             str - Value of AutoConfigURL.
         """
-        reg = self.get_reg(self.auto_config_path)
-        value, _ = self.query(reg, self.AUTO_CONFIG_REGVAL)
-        return value
+        return self.read_value(self.AUTO_CONFIG_REGVAL)
 
     def write_auto_config(self, value: str) -> None:
         """
@@ -122,8 +139,7 @@ class IEWindowsRegEditor(object):
         Returns:
             None
         """
-        reg = self.get_reg(self.auto_config_path)
-        self.rsave(reg, self.AUTO_CONFIG_REGVAL, 0, winreg.REG_SZ, value)
+        self.write_value(self.AUTO_CONFIG_REGVAL, value)
 
     def read_default_connection_settings(self) -> bytes:
         """
@@ -132,9 +148,7 @@ class IEWindowsRegEditor(object):
         Returns:
             bytes - Value of DefaultConnectionSettings.
         """
-        reg = self.get_reg(self.connection_settings_path)
-        value, _ = self.query(reg, self.CONNECTION_SETTINGS)
-        return value
+        return self.read_value(self.CONNECTION_SETTINGS)
 
     def write_default_connection_settings(self, value: bytes) -> None:
         """
@@ -146,8 +160,7 @@ class IEWindowsRegEditor(object):
         Returns:
             None
         """
-        reg = self.get_reg(self.connection_settings_path)
-        self.rsave(reg, self.CONNECTION_SETTINGS, 0, winreg.REG_BINARY, value)
+        self.write_value(self.CONNECTION_SETTINGS, value)
 
     def read_saved_legacy_settings(self) -> bytes:
         """
@@ -156,9 +169,7 @@ class IEWindowsRegEditor(object):
         Returns:
             bytes - Value of SavedLegacySettings.
         """
-        reg = self.get_reg(self.connection_settings_path)
-        value, _ = self.query(reg, self.LEGACY_SETTINGS)
-        return value
+        return self.read_value(self.LEGACY_SETTINGS)
 
     def write_saved_legacy_settings(self, value: bytes) -> None:
         """
@@ -170,10 +181,76 @@ class IEWindowsRegEditor(object):
         Returns:
             None
         """
-        reg = self.get_reg(self.connection_settings_path)
-        self.rsave(reg, self.LEGACY_SETTINGS, 0, winreg.REG_BINARY, value)
+        self.write_value(self.LEGACY_SETTINGS, value)
+
+    def locate(self, name: str) -> tuple:
+        """
+        Where a watched value lives.
+
+        Args:
+            name (str) - One of AUTO_CONFIG_REGVAL, CONNECTION_SETTINGS or
+                LEGACY_SETTINGS.
+
+        Returns:
+            tuple - Stop index of the registry path and registry value type.
+        """
+        if name == self.AUTO_CONFIG_REGVAL:
+            return self.auto_config_path, REG_SZ
+        return self.connection_settings_path, REG_BINARY
+
+    def read_value(self, name: str):
+        """
+        Getter interface for any of the watched values.
+
+        Args:
+            name (str) - Registry value name.
+
+        Returns:
+            str or bytes - Value of the registry.
+        """
+        index, _ = self.locate(name)
+        with METRICS.span("registry.read." + name):
+            value, _ = self.backend.query_value(self.get_reg(index), name)
+        METRICS.count("registry.reads")
+        return value
+
+    def write_value(self, name: str, value) -> None:
+        """
+        Setter interface for any of the watched values.
+
+        Args:
+            name (str) - Registry value name.
+            value (str or bytes) - Value to write.
+
+        Returns:
+            None
+        """
+        index, kind = self.locate(name)
+        with METRICS.span("registry.write." + name):
+            self.backend.set_value(self.get_reg(index), name, kind, value)
+        METRICS.count("registry.writes")
+        METRICS.count("registry.bytes_written", len(value))
+
+    def delete_value(self, name: str) -> None:
+        """
+        Removes one of the watched values; a value that is already missing
+        is not an error.
+
+        Args:
+            name (str) - Registry value name.
+
+        Returns:
+            None
+        """
+        index, _ = self.locate(name)
+        try:
+            self.backend.delete_value(self.get_reg(index), name)
+        except FileNotFoundError:
+            return
+        METRICS.count("registry.writes")
 
     @classmethod
+    @timed("registry.alter_bin_reg")
     def alter_bin_reg(cls, enable: bool, bytes_in: bytes, data: str="") -> bytes:
         """
         Helper method to edit bytes values for Windows Registries.
@@ -189,43 +266,81 @@ class IEWindowsRegEditor(object):
         Raises:
             ValueError - If some bytes order are not as expected.
         """
-        byte_list = list(bytes_in)
         cfg = cls.AUTO_DETECT_SETTINGS
-        data_length = len(data.strip())
 
         # It's the equivalent of the GUI's checkbox for the "Use automatic
         # configuration script". Update configuration byte afterwards
         if enable:
             cfg |= cls.AUTO_CONFIG_SCRIPT
-        byte_list[cls.PROXY_IDX:cls.PROXY_IDX+cls.INT32] = [cfg, 0x0, 0x0, 0x0]
-
-        # Resolve X-Byte order and padding
-        x_size = byte_list[cls.X_LEN_IDX:cls.X_LEN_IDX + cls.INT32]
-        x_len = struct.unpack(cls.NATIVE + cls.INT, bytes(x_size))
-        if len(x_len) == 0:
-            raise ValueError("Invalid format")
-        x_len = x_len[0]
-
-        # Resolve data byte order and data len
-        data_len_start = cls.X_LEN_IDX + cls.INT32 + x_len
-        data_len_end = data_len_start + cls.INT32
-        b_size = byte_list[data_len_start:data_len_end]
-        data_len = struct.unpack(cls.NATIVE + cls.INT, bytes(b_size))
-        if len(data_len) == 0:
-            raise ValueError("Invalid format")
-        data_len = data_len[0]
-
-        # Set data length
-        b_size_in = struct.pack(cls.NATIVE + cls.INT, data_length)
-        byte_list[data_len_start:data_len_end] = list(b_size_in)
-
-        # Remove old data
-        data_start = data_len_end
-        data_end = data_start + data_len
-        del byte_list[data_start:data_end]
-
-        # Set new data
-        chars = [ord(c) for c in data]
-        enc = cls.NATIVE + (cls.CHAR * data_length)
-        byte_list[data_start:data_start] = struct.pack(enc, *chars)
-        return bytes(byte_list)
+        settings = ConnectionSettings.decode(bytes_in)
+        settings.flags = cfg
+        return settings.set_auto_config_url(data).encode()
+
+    @classmethod
+    @timed("registry.alter_proxy_reg")
+    def alter_proxy_reg(cls, enable: bool, bytes_in: bytes, server: str="") -> bytes:
+        """
+        Helper method to set the manual proxy server of the settings blob.
+
+        Args:
+            enable (bool) - Wheather to enable or not the manual proxy.
+            bytes_in (bytes) - Initial bytes as an input.
+            server (str) - Proxy server, as "host:port".
+
+        Returns:
+            bytes - The updated input.
+
+        Raises:
+            ValueError - If some bytes order are not as expected.
+        """
+        cfg = cls.NOOP
+
+        # It's the equivalent of the GUI's checkbox for the "Use a proxy
+        # server for your LAN"
+        if enable:
+            cfg |= cls.MANUAL_PROXY
+        settings = ConnectionSettings.decode(bytes_in)
+        settings.flags = cfg
+        settings.proxy_server = server.strip().encode(ConnectionSettings.ENCODING)
+        return settings.encode()
+
+    @classmethod
+    @timed("registry.alter_settings")
+    def alter_settings(cls, bytes_in: bytes, auto_config: str=None, proxy_server: str=None,
+                       bypass: list=None, add_bypass: list=None, remove_bypass: list=None) -> bytes:
+        """
+        Edits several segments of the settings blob with a single decode and
+        encode, e.g. to combine a PAC file with a manual proxy. Segments left
+        as None are kept along with their bit: Windows keeps the proxy server
+        text when the user unchecks it, so only a passed auto_config or
+        proxy_server sets the AUTO_CONFIG_SCRIPT or MANUAL_PROXY bit, to
+        whether it is non-empty.
+
+        Args:
+            bytes_in (bytes) - Initial bytes as an input.
+            auto_config (str) - Auto config URL ("" to clear).
+            proxy_server (str) - Proxy server ("" to clear).
+            bypass (list) - Entries replacing the bypass list.
+            add_bypass (list) - Entries to append to the bypass list.
+            remove_bypass (list) - Entries to drop from the bypass list.
+
+        Returns:
+            bytes - The updated input.
+
+        Raises:
+            ValueError - If some bytes order are not as expected.
+        """
+        settings = ConnectionSettings.decode(bytes_in)
+        if auto_config is not None:
+            settings.set_auto_config_url(auto_config)
+            settings.set_flag(ConnectionSettings.AUTO_PROXY_URL, bool(settings.auto_config_url))
+        if proxy_server is not None:
+            settings.set_proxy_server(proxy_server)
+        if bypass is not None:
+            settings.set_bypass_list(bypass)
+        if add_bypass:
+            settings.add_bypass(add_bypass)
+        if remove_bypass:
+            settings.remove_bypass(remove_bypass)
+        settings.set_flag(ConnectionSettings.DIRECT)
+        return settings.encode()
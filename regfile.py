@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import re
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, TextIO, Tuple
+from reg import IEWindowsRegEditor
+
+
+class RegFileReader(object):
+    """
+    Streaming reader for regedit exports (``.reg`` files).
+
+    Yields one event per logical line, so files of any size are processed
+    with constant memory:
+
+        ("key", path, lines)        - a ``[HKEY_...]`` section header
+        ("value", name, lines)      - a value, continuation lines included
+        ("line", None, lines)       - anything else (header, blank lines)
+
+    ``lines`` always holds the raw text, line endings included, so events
+    can be written back untouched.
+    """
+
+    VALUE = re.compile(r'^"((?:[^"\\]|\\.)*)"=')
+
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+
+    def __iter__(self) -> Iterator[Tuple[str, str, List[str]]]:
+        lines = []
+        for line in self.stream:
+            lines.append(line)
+            if line.rstrip("\r\n").endswith("\\"):
+                continue
+            yield self.classify(lines)
+            lines = []
+        if lines:
+            yield self.classify(lines)
+
+    def classify(self, lines: List[str]) -> Tuple[str, str, List[str]]:
+        first = lines[0].strip()
+        if first.startswith("[") and first.endswith("]"):
+            return "key", first[1:-1], lines
+        match = self.VALUE.match(first)
+        if match is not None:
+            return "value", match.group(1).replace('\\"', '"').replace("\\\\", "\\"), lines
+        return "line", None, lines
+
+    @staticmethod
+    def payload(lines: List[str]) -> str:
+        """
+        Joins a value's continuation lines and returns the text after ``=``.
+        """
+        text = "".join(l.rstrip("\r\n").rstrip("\\").strip() for l in lines)
+        return text.split("=", 1)[1]
+
+    @classmethod
+    def decode_binary(cls, lines: List[str]) -> bytes:
+        """
+        Decodes a ``hex:`` (REG_BINARY) value.
+
+        Raises:
+            ValueError - If the value is not REG_BINARY.
+        """
+        kind, _, data = cls.payload(lines).partition(":")
+        if kind not in ("hex", "hex(3)"):
+            raise ValueError("Invalid format")
+        return bytes.fromhex(data.replace(",", ""))
+
+
+class RegFileWriter(object):
+    """
+    Formats values the way regedit exports them.
+    """
+
+    WIDTH = 80
+    NEWLINE = "\r\n"
+
+    @staticmethod
+    def escape(text: str) -> str:
+        return text.replace("\\", "\\\\").replace('"', '\\"')
+
+    @classmethod
+    def format_string(cls, name: str, value: str) -> str:
+        return '"{}"="{}"{}'.format(cls.escape(name), cls.escape(value), cls.NEWLINE)
+
+    @classmethod
+    def format_binary(cls, name: str, value: bytes) -> str:
+        out = []
+        line = '"{}"=hex:'.format(cls.escape(name))
+        last = len(value) - 1
+        for i, byte in enumerate(value):
+            token = "{:02x},".format(byte) if i < last else "{:02x}".format(byte)
+            if len(line) + len(token) > cls.WIDTH - 1:
+                out.append(line + "\\" + cls.NEWLINE)
+                line = "  "
+            line += token
+        out.append(line + cls.NEWLINE)
+        return "".join(out)
+
+
+class RegFilePatcher(object):
+    """
+    Applies install_pac_file/restore_defaults to a registry export.
+
+    Binary Connections values are re-encoded with alter_bin_reg and the
+    AutoConfigURL string is replaced (or added to the Internet Settings
+    section when missing). Everything else is copied verbatim.
+    """
+
+    SETTINGS_KEY = "\\".join(IEWindowsRegEditor.COMPLETE_REG_PATH[:-1]).lower()
+    CONNECTIONS_KEY = "\\".join(IEWindowsRegEditor.COMPLETE_REG_PATH).lower()
+    AUTO_CONFIG_VALUE = IEWindowsRegEditor.AUTO_CONFIG_REGVAL.lower()
+    BINARY_VALUES = (
+        IEWindowsRegEditor.CONNECTION_SETTINGS.lower(),
+        IEWindowsRegEditor.LEGACY_SETTINGS.lower(),
+    )
+
+    def __init__(self, link: str=""):
+        self.link = link.strip()
+        self.enable = self.link != ""
+
+    @staticmethod
+    def user_key(section: str, key: str) -> bool:
+        """
+        Whether the lower-cased ``section`` is ``key`` under a user root:
+        HKEY_CURRENT_USER, or one hive of HKEY_USERS. Machine-wide copies
+        of the key (HKEY_LOCAL_MACHINE...) are not per-user settings.
+        """
+        root, _, rest = section.partition("\\")
+        if root == "hkey_current_user":
+            return rest == key
+        if root == "hkey_users":
+            return rest.partition("\\")[2] == key
+        return False
+
+    def patch_stream(self, src: TextIO, dst: TextIO) -> int:
+        """
+        Copies ``src`` to ``dst`` while patching the proxy settings.
+
+        Returns:
+            int - Number of values patched.
+        """
+        patched = 0
+        settings = connections = False
+        pending = False
+        for kind, name, lines in RegFileReader(src):
+            if pending and (kind == "key" or not lines[0].strip()):
+                dst.write(RegFileWriter.format_string(IEWindowsRegEditor.AUTO_CONFIG_REGVAL, self.link))
+                patched += 1
+                pending = False
+            if kind == "key":
+                section = name.lower()
+                settings = self.user_key(section, self.SETTINGS_KEY)
+                connections = self.user_key(section, self.CONNECTIONS_KEY)
+                pending = settings
+            elif kind == "value":
+                if settings and name.lower() == self.AUTO_CONFIG_VALUE:
+                    lines = [RegFileWriter.format_string(name, self.link)]
+                    pending = False
+                    patched += 1
+                elif connections and name.lower() in self.BINARY_VALUES:
+                    bytez_in = RegFileReader.decode_binary(lines)
+                    bytez_out = IEWindowsRegEditor.alter_bin_reg(self.enable, bytez_in, self.link)
+                    lines = [RegFileWriter.format_binary(name, bytez_out)]
+                    patched += 1
+            dst.writelines(lines)
+        if pending:
+            dst.write(RegFileWriter.format_string(IEWindowsRegEditor.AUTO_CONFIG_REGVAL, self.link))
+            patched += 1
+        return patched
+
+    @staticmethod
+    def detect_encoding(filepath: str) -> str:
+        with open(filepath, "rb") as file_:
+            bom = file_.read(2)
+        if bom in (b"\xff\xfe", b"\xfe\xff"):
+            return "utf-16"
+        return "utf-8"
+
+    def patch_file(self, src_path: str, dst_path: str=None) -> int:
+        """
+        Patches an export file; in place when ``dst_path`` is omitted.
+
+        Returns:
+            int - Number of values patched.
+        """
+        encoding = self.detect_encoding(src_path)
+        target = dst_path or src_path
+        tmp_path = target + ".tmp"
+        opts = {"encoding": encoding, "errors": "surrogateescape", "newline": ""}
+        try:
+            with open(src_path, "r", **opts) as src, open(tmp_path, "w", **opts) as dst:
+                patched = self.patch_stream(src, dst)
+            os.replace(tmp_path, target)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return patched
+
+
+def _patch_one(args: Tuple[str, str, str]) -> Tuple[str, bool, str]:
+    src_path, dst_path, link = args
+    try:
+        return src_path, True, str(RegFilePatcher(link).patch_file(src_path, dst_path))
+    except Exception as e:
+        return src_path, False, str(e)
+
+
+def patch_directory(directory: str, link: str="", output: str=None,
+                    workers: int=None) -> Dict[str, Tuple[bool, str]]:
+    """
+    Patches every ``.reg`` file of a directory using a process pool.
+
+    Args:
+        directory (str) - Directory holding the exports.
+        link (str) - PAC URL to install; empty restores the defaults.
+        output (str) - Directory for patched copies; in place when omitted.
+        workers (int) - Number of worker processes.
+
+    Returns:
+        dict - Maps each file to (ok, patched value count or error).
+    """
+    jobs = []
+    for entry in sorted(os.listdir(directory)):
+        if not entry.lower().endswith(".reg"):
+            continue
+        dst_path = os.path.join(output, entry) if output else None
+        jobs.append((os.path.join(directory, entry), dst_path, link))
+    if output:
+        os.makedirs(output, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return {path: (ok, msg) for path, ok, msg in pool.map(_patch_one, jobs, chunksize=4)}
@@ -20,19 +20,35 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import wx
-
-
-BACKUP_REG = "backup"
+BACKUP_REG = "backups"
+# Single-file backup written by versions before the BACKUP_REG store
+LEGACY_BACKUP_REG = "backup"
 BACKUP_ERR = "Cannot create backup: {}. Leaving your configuration unchanged."
 
 INVALID_URL = "Invalid PAC resource provided. Leaving your configuration unchanged."
+PAC_FETCH_ERR = "Cannot download PAC file: {}. Leaving your configuration unchanged."
+UNRESOLVED_HOST = "Cannot resolve {}. Leaving your configuration unchanged."
+WPAD_ERR = "No WPAD server found on this network. Leaving your configuration unchanged."
+NO_SETTINGS_ERR = "No DefaultConnectionSettings value found. Leaving your configuration unchanged."
+
+PAC_CACHE_DIR = "pac_cache"
+APPLY_JOURNAL = "apply.journal"
+MIRROR_CHECK_INTERVAL = 30
+METRICS_FILE = "metrics.json"
+HIVES_DIR = "hives"
+HIVE_WORKERS = 16
+PROFILE_ENV = "IPSX_PROFILE"
+PROFILE_DIR_ENV = "IPSX_PROFILE_DIR"
+PROFILE_DIR = "profile"
+WPAD_CACHE = "wpad.json"
+WPAD_TTL = 24 * 3600
 
 HISTORY_LOG_FILE = "history"
+HISTORY_MAX_BYTES = 1 << 20
+HISTORY_TAIL = 100
 
 OK, FAIL = 0x0a, 0x0b
 APP_CONFIG = {
     "title": "IP.SX Proxy Helper",
-    "size": (290, 360),
-    "style": wx.DEFAULT_FRAME_STYLE ^ wx.RESIZE_BORDER
+    "size": (290, 400)
 }
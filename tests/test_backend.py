@@ -0,0 +1,57 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import pytest
+
+from backend import HKEY_CURRENT_USER, REG_SZ, KeyCache, MemoryBackend, RegistryBackend
+
+
+def test_incomplete_backend_fails_at_construction():
+    class ReadOnly(RegistryBackend):
+        def open_key(self, root, path, access=0):
+            return None
+
+    with pytest.raises(TypeError):
+        ReadOnly()
+
+
+def test_memory_backend_values():
+    backend = MemoryBackend({(HKEY_CURRENT_USER, "Software\\Test"): {"a": ("1", REG_SZ)}})
+    handle = backend.open_key(HKEY_CURRENT_USER, "software\\TEST")
+    assert backend.query_value(handle, "a") == ("1", REG_SZ)
+    backend.set_value(handle, "b", REG_SZ, "2")
+    backend.delete_value(handle, "a")
+    with pytest.raises(FileNotFoundError):
+        backend.query_value(handle, "a")
+    with pytest.raises(FileNotFoundError):
+        backend.delete_value(handle, "a")
+    backend.close_key(handle)
+    assert backend.live == 0
+    assert backend.enum_keys(HKEY_CURRENT_USER, "Software") == ["test"]
+
+
+def test_key_cache_reuses_and_closes_handles():
+    backend = MemoryBackend({(HKEY_CURRENT_USER, "Software\\Test"): {}})
+    with KeyCache(backend) as keys:
+        assert keys.get(HKEY_CURRENT_USER, "Software\\Test") is keys.get(HKEY_CURRENT_USER, "Software\\Test")
+        assert backend.opened == 1
+    assert backend.live == 0
@@ -0,0 +1,91 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import pytest
+
+from backupstore import BackupStore, read_legacy
+from codec import ConnectionSettings
+from proxy import ProxyHelper
+from reg import IEWindowsRegEditor
+from res import BACKUP_REG, LEGACY_BACKUP_REG
+
+
+def blob(url="", counter=1):
+    return ConnectionSettings(counter=counter, flags=0x05 if url else 0x01,
+                              auto_config_url=url.encode("latin-1"), trailer=b"\0" * 32).encode()
+
+
+def test_snapshot_dedup_and_load(tmp_path):
+    store = BackupStore(str(tmp_path))
+    assert store.snapshot({"a": b"\x01\x02", "b": "text"}) == 1
+    assert store.snapshot({"a": b"\x01\x02", "b": "text"}) == 1
+    assert store.snapshot({"a": b"\x03", "b": "text"}) == 2
+    assert store.load(1) == {"a": b"\x01\x02", "b": "text"}
+    assert BackupStore(str(tmp_path)).load() == {"a": b"\x03", "b": "text"}
+
+
+def test_read_legacy_pair(tmp_path):
+    path = tmp_path / "backup"
+    default, saved = blob("http://pac/proxy.pac", 7), blob("", 3)
+    path.write_bytes(default + saved)
+    assert read_legacy(str(path)) == (default, saved)
+    path.write_bytes(default + default)
+    assert read_legacy(str(path)) == (default, default)
+    path.write_bytes(default)
+    assert read_legacy(str(path)) == (default, default)
+
+
+def test_read_legacy_rejects_garbage(tmp_path):
+    path = tmp_path / "backup"
+    path.write_bytes(b"\x01\x02")
+    with pytest.raises(ValueError):
+        read_legacy(str(path))
+
+
+@pytest.fixture
+def helper(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ProxyHelper, "backup_store", None)
+    monkeypatch.setattr(ProxyHelper, "profile_store", None)
+    return ProxyHelper
+
+
+def test_legacy_backup_imported_on_first_use(helper, monkeypatch, tmp_path):
+    default = blob("http://pac/proxy.pac")
+    (tmp_path / LEGACY_BACKUP_REG).write_bytes(default + default)
+    monkeypatch.setattr(ProxyHelper, "backup_file", BACKUP_REG)
+    values = helper.store().load()
+    assert values == {
+        IEWindowsRegEditor.AUTO_CONFIG_REGVAL: "http://pac/proxy.pac",
+        IEWindowsRegEditor.CONNECTION_SETTINGS: default,
+        IEWindowsRegEditor.LEGACY_SETTINGS: default,
+    }
+    assert len(helper.store().versions()) == 1
+
+
+def test_legacy_backup_at_the_store_path_is_moved_aside(helper, monkeypatch, tmp_path):
+    default = blob()
+    (tmp_path / "custom").write_bytes(default)
+    monkeypatch.setattr(ProxyHelper, "backup_file", "custom")
+    assert helper.profiles().names() == []
+    assert (tmp_path / "custom").is_dir() and (tmp_path / "custom.legacy").is_file()
+    assert helper.store().load()[IEWindowsRegEditor.CONNECTION_SETTINGS] == default
@@ -0,0 +1,70 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import zipfile
+
+from corpus import ZipReader, _inspect_blobs, iter_archive
+
+
+PAC = b'function FindProxyForURL(url, host) { return "DIRECT"; }' * 20
+
+
+def archive(path, corrupt=None):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zip_:
+        for name in ("a.pac", "b.pac", "c.pac"):
+            zip_.writestr(name, PAC)
+    if corrupt:
+        data = bytearray(path.read_bytes())
+        start = data.find(corrupt.encode()) + len(corrupt) + 4
+        data[start:start + 30] = b"\xff" * 30
+        path.write_bytes(bytes(data))
+    return str(path)
+
+
+def test_members(tmp_path):
+    with ZipReader(archive(tmp_path / "ok.zip")) as reader:
+        assert [(name, blob) for name, blob in reader.members()] == [
+            ("a.pac", PAC), ("b.pac", PAC), ("c.pac", PAC)]
+
+
+def test_corrupt_member_is_an_outlier(tmp_path):
+    with ZipReader(archive(tmp_path / "bad.zip", "b.pac")) as reader:
+        members = list(reader.members())
+    assert [name for name, _ in members] == ["a.pac", "b.pac", "c.pac"]
+    assert isinstance(members[1][1], ValueError)
+    assert members[0][1] == members[2][1] == PAC
+
+
+def test_iter_archive_reports_corrupt_members(tmp_path):
+    members = list(iter_archive(archive(tmp_path / "bad.zip", "b.pac")))
+    assert [name for name, _ in members] == ["a.pac", "b.pac", "c.pac"]
+    assert isinstance(members[1][1], ValueError)
+    # PAC is no settings blob either, so the readable members are outliers too
+    samples = _inspect_blobs(members).outlier_samples
+    assert ("b.pac", str(members[1][1]), "") in samples and len(samples) == 3
+
+
+def test_close_after_partial_iteration(tmp_path):
+    reader = ZipReader(archive(tmp_path / "ok.zip"))
+    members = reader.members()
+    next(members)
+    reader.close()
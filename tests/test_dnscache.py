@@ -0,0 +1,127 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import time
+import asyncio
+import threading
+
+from dnscache import DnsCache, StubResolver
+from pac import PacEngine, PacHelpers
+
+
+RECORDS = {"a.example": "10.0.0.1", "b.example": "10.0.0.2"}
+
+
+def test_get_caches_answers_and_failures():
+    stub = StubResolver(RECORDS)
+    cache = DnsCache(stub)
+    try:
+        assert cache.get("A.example") == "10.0.0.1"
+        assert cache.get("a.example") == "10.0.0.1"
+        assert cache.get("missing.example") is None
+        assert cache.get("missing.example") is None
+        assert stub.queries == 2
+        stats = cache.stats()
+        assert stats["hits"] == 1 and stats["negative_hits"] == 1 and stats["misses"] == 2
+    finally:
+        cache.close()
+
+
+def test_negative_ttl_expires():
+    stub = StubResolver()
+    cache = DnsCache(stub, negative_ttl=0.05)
+    try:
+        assert cache.get("late.example") is None
+        stub.records["late.example"] = "10.0.0.9"
+        time.sleep(0.1)
+        assert cache.get("late.example") == "10.0.0.9"
+    finally:
+        cache.close()
+
+
+def test_concurrent_lookups_share_one_query():
+    stub = StubResolver(RECORDS, delay=0.2)
+    cache = DnsCache(stub)
+    answers = []
+    threads = [threading.Thread(target=lambda: answers.append(cache.get("b.example")))
+               for _ in range(8)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert answers == ["10.0.0.2"] * 8
+        assert stub.queries == 1
+        assert cache.stats()["coalesced"] >= 1
+    finally:
+        cache.close()
+
+
+def test_timeout_answers_none():
+    cache = DnsCache(StubResolver(RECORDS, delay=1.0), timeout=0.1)
+    try:
+        assert cache.get("a.example") is None
+    finally:
+        cache.close()
+
+
+def test_lru_eviction():
+    cache = DnsCache(StubResolver(RECORDS), size=1)
+    try:
+        cache.get("a.example")
+        cache.get("b.example")
+        assert cache.stats()["entries"] == 1 and cache.stats()["evictions"] == 1
+    finally:
+        cache.close()
+
+
+def test_resolve_from_another_loop():
+    cache = DnsCache(StubResolver(RECORDS))
+    try:
+        assert asyncio.run(cache.resolve("a.example")) == "10.0.0.1"
+        assert cache.get("a.example") == "10.0.0.1"
+    finally:
+        cache.close()
+
+
+def test_close_cancels_lookups_in_flight():
+    stub = StubResolver(RECORDS, delay=5.0)
+    cache = DnsCache(stub, timeout=10.0)
+    cache.warm(["a.example"])
+    cache.close()
+    assert not cache.pending
+    stub.delay = 0.0
+    assert cache.get("a.example") == "10.0.0.1"
+    cache.close()
+
+
+def test_pac_helpers_use_the_stub():
+    cache = DnsCache(StubResolver(RECORDS))
+    try:
+        engine = PacEngine.from_source(
+            'function FindProxyForURL(url, host) {'
+            ' return isInNet(host, "10.0.0.0", "255.255.255.0") ? "PROXY p:8080" : "DIRECT"; }',
+            PacHelpers(cache.get))
+        assert engine.evaluate("http://a.example/") == "PROXY p:8080"
+        assert engine.evaluate("http://nowhere.example/") == "DIRECT"
+    finally:
+        cache.close()
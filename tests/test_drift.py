@@ -0,0 +1,143 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from backend import HKEY_CURRENT_USER, REG_BINARY, REG_SZ, MemoryBackend
+from codec import ConnectionSettings
+from drift import DriftMonitor, RegistrySource
+from reg import IEWindowsRegEditor
+
+
+AUTO_CONFIG = IEWindowsRegEditor.AUTO_CONFIG_REGVAL
+SETTINGS = IEWindowsRegEditor.CONNECTION_SETTINGS
+LEGACY = IEWindowsRegEditor.LEGACY_SETTINGS
+PATH = "\\".join(IEWindowsRegEditor.COMPLETE_REG_PATH)
+PAC = "http://pac.example/proxy.pac"
+
+
+def installed(url=PAC, counter=1):
+    settings = ConnectionSettings.decode(IEWindowsRegEditor.alter_bin_reg(True, ConnectionSettings().encode(), url))
+    settings.counter = counter
+    return settings.encode()
+
+
+def registry(blob=None):
+    blob = blob or installed()
+    return MemoryBackend({
+        (HKEY_CURRENT_USER, PATH.rsplit("\\", 1)[0]): {AUTO_CONFIG: (PAC, REG_SZ)},
+        (HKEY_CURRENT_USER, PATH): {
+            SETTINGS: (blob, REG_BINARY),
+            LEGACY: (blob, REG_BINARY),
+        },
+    })
+
+
+def write(backend, name, value):
+    with IEWindowsRegEditor(backend) as net:
+        net.write_value(name, value)
+
+
+def test_reports_changed_fields():
+    backend = registry()
+    monitor = DriftMonitor(RegistrySource(backend))
+    monitor.baseline()
+    settings = ConnectionSettings.decode(installed())
+    settings.set_proxy_server("evil.example:8080")
+    write(backend, SETTINGS, settings.encode())
+
+    drifts = monitor.check()
+    assert [d.name for d in drifts] == [SETTINGS]
+    fields = [field for field, old, new in drifts[0].changes]
+    assert "proxy_server" in fields and "counter" not in fields
+    assert monitor.check() == []
+
+
+def test_counter_only_change_is_not_drift():
+    backend = registry()
+    monitor = DriftMonitor(RegistrySource(backend))
+    monitor.baseline()
+    write(backend, SETTINGS, installed(counter=2))
+    assert monitor.check() == []
+    assert monitor.decodes == 1
+
+
+def test_quiet_polls_skip_decoding():
+    monitor = DriftMonitor(RegistrySource(registry()))
+    for _ in range(3):
+        assert monitor.check() == []
+    assert monitor.polls == 3 and monitor.decodes == 0
+
+
+def test_reapplies_the_desired_pac_url():
+    backend = registry()
+    log = []
+
+    def reapply(url):
+        with IEWindowsRegEditor(backend) as net:
+            net.write_value(AUTO_CONFIG, url)
+            net.write_value(SETTINGS, installed(url, counter=3))
+        return "ok"
+
+    monitor = DriftMonitor(RegistrySource(backend), desired=PAC, reapply=reapply,
+                           log=lambda message, kind: log.append((kind, message)))
+    monitor.baseline()
+    write(backend, AUTO_CONFIG, "http://other.example/proxy.pac")
+    write(backend, SETTINGS, installed("http://other.example/proxy.pac", counter=2))
+
+    assert len(monitor.check()) == 2
+    assert monitor.reapplies == 1
+    assert monitor.source.read()[AUTO_CONFIG] == PAC.encode()
+    assert ("drift", "Re-applied {}: ok".format(PAC)) in log
+    # The re-apply itself is not reported as drift
+    assert monitor.check() == []
+    assert monitor.reapplies == 1
+
+
+def test_drift_to_the_desired_state_is_not_reapplied():
+    backend = registry()
+    calls = []
+    monitor = DriftMonitor(RegistrySource(backend), desired=PAC, reapply=calls.append)
+    monitor.baseline()
+    settings = ConnectionSettings.decode(installed())
+    settings.add_bypass(["*.local"])
+    write(backend, SETTINGS, settings.encode())
+    assert monitor.check()
+    assert calls == []
+
+
+def test_interval_backs_off_and_resets_on_drift():
+    backend = registry()
+    monitor = DriftMonitor(RegistrySource(backend), min_interval=1.0, max_interval=8.0, backoff=2.0)
+    monitor.baseline()
+    intervals = []
+    for _ in range(4):
+        monitor.check()
+        intervals.append(monitor.interval)
+    assert intervals == [2.0, 4.0, 8.0, 8.0]
+
+    write(backend, AUTO_CONFIG, "http://a.example/proxy.pac")
+    monitor.check()
+    assert monitor.interval == 4.0
+    write(backend, AUTO_CONFIG, "http://b.example/proxy.pac")
+    monitor.check()
+    write(backend, AUTO_CONFIG, "http://c.example/proxy.pac")
+    monitor.check()
+    assert monitor.interval == 1.0
@@ -0,0 +1,143 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import socket
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from fwdproxy import BadRequest, ForwardingProxy, split_authority
+from pac import PacEngine
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def origin():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd.server_port
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def proxy():
+    engine = PacEngine.from_source('function FindProxyForURL(url, host) { return "DIRECT"; }')
+    proxy = ForwardingProxy(engine).start_in_thread()
+    yield proxy
+    proxy.stop_thread()
+
+
+def exchange(proxy, request):
+    with socket.create_connection((proxy.host, proxy.port), timeout=5) as sock:
+        sock.sendall(request)
+        data = b""
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return data
+            data += chunk
+
+
+def test_split_authority():
+    assert split_authority("example.com", 80) == ("example.com", 80)
+    assert split_authority("example.com:8080", 80) == ("example.com", 8080)
+    assert split_authority("[::1]:443", 80) == ("::1", 443)
+    assert split_authority("[::1]", 80) == ("::1", 80)
+    for bad in ("host:abc", "host:0", "host:70000", ":80"):
+        with pytest.raises(BadRequest):
+            split_authority(bad, 80)
+
+
+def test_forwards_request(proxy, origin):
+    answer = exchange(proxy, "GET http://127.0.0.1:{}/ HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n"
+                      .format(origin).encode())
+    assert answer.startswith(b"HTTP/1.1 200") and answer.endswith(b"ok")
+
+
+@pytest.mark.parametrize("request_", [
+    b"GET http://host:abc/ HTTP/1.1\r\nHost: host\r\n\r\n",
+    b"GET /relative HTTP/1.1\r\nHost: host\r\n\r\n",
+    b"CONNECT host:abc HTTP/1.1\r\n\r\n",
+    b"POST http://127.0.0.1:9/ HTTP/1.1\r\nContent-Length: ten\r\n\r\n",
+])
+def test_malformed_request_answers_400(proxy, request_):
+    assert exchange(proxy, request_).startswith(b"HTTP/1.1 400")
+
+
+@pytest.fixture
+def raw_origin():
+    """
+    Answers one request with ``response`` and keeps the request head.
+    """
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    state = {"response": b"", "request": b""}
+
+    def serve():
+        conn, _ = server.accept()
+        with conn:
+            while b"\r\n\r\n" not in state["request"]:
+                state["request"] += conn.recv(65536)
+            conn.sendall(state["response"])
+
+    thread = threading.Thread(target=serve, daemon=True)
+    state["start"] = thread.start
+    yield server.getsockname()[1], state
+    server.close()
+
+
+def test_interim_response_is_followed_by_the_real_one(proxy, raw_origin):
+    port, state = raw_origin
+    state["response"] = (b"HTTP/1.1 100 Continue\r\n\r\n"
+                         b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+    state["start"]()
+    answer = exchange(proxy, "GET http://127.0.0.1:{}/ HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n"
+                      .format(port).encode())
+    assert answer.startswith(b"HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 200 OK\r\n")
+    assert answer.endswith(b"\r\n\r\nok")
+
+
+def test_headers_named_by_connection_are_not_forwarded(proxy, raw_origin):
+    port, state = raw_origin
+    state["response"] = (b"HTTP/1.1 200 OK\r\nConnection: X-Hop\r\nX-Hop: upstream\r\nX-Kept: 1\r\n"
+                         b"Content-Length: 2\r\n\r\nok")
+    state["start"]()
+    answer = exchange(proxy, "GET http://127.0.0.1:{}/ HTTP/1.1\r\nHost: x\r\nConnection: close, X-Client\r\n"
+                             "X-Client: secret\r\nX-Other: 2\r\n\r\n".format(port).encode())
+    assert b"X-Kept: 1" in answer and b"X-Hop" not in answer
+    assert b"X-Other: 2" in state["request"] and b"X-Client" not in state["request"]
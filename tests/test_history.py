@@ -0,0 +1,75 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import sys
+import threading
+
+from history import HistoryLog
+
+
+def test_concurrent_appends_keep_the_index_consistent(tmp_path):
+    log = HistoryLog(str(tmp_path / "history"), max_bytes=1 << 16, backups=2, page=16)
+
+    errors = []
+
+    def writer(n):
+        try:
+            for i in range(500):
+                log.append("thread {} record {}".format(n, i))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    log.close()
+    assert not errors
+
+    reopened = HistoryLog(str(tmp_path / "history"), max_bytes=1 << 16, backups=2, page=16)
+    assert reopened.count == log.count and reopened.size == log.size
+    with open(str(tmp_path / "history"), "rb") as file_:
+        data = file_.read()
+    offsets = reopened._offsets(reopened.filepath)
+    assert all(o == 0 or data[o - 1:o] == b"\n" for o in offsets)
+    for number in range(len(offsets)):
+        assert all(r.message.startswith("thread ") for r in reopened.page_at(number))
+
+
+def test_tail_and_older_across_rotation(tmp_path):
+    log = HistoryLog(str(tmp_path / "history"), max_bytes=512, backups=3, page=4)
+    for i in range(40):
+        log.append("record {}".format(i))
+    records, cursor = log.tail(5)
+    assert [r.message for r in records] == ["record {}".format(i) for i in range(35, 40)]
+    seen = [r.message for r in records]
+    while cursor is not None:
+        records, cursor = log.older(cursor, 7)
+        seen[:0] = [r.message for r in records]
+    assert seen == ["record {}".format(i) for i in range(40 - len(seen), 40)]
+    log.close()
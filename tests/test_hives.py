@@ -0,0 +1,151 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import sys
+import threading
+
+import pytest
+
+from backend import HKEY_USERS, REG_BINARY, REG_SZ, FileBackend, HivesBackend
+from codec import ConnectionSettings
+from hives import MultiUserApply, list_hives
+from proxy import ProxyHelper
+from reg import IEWindowsRegEditor
+
+
+PATH = "\\".join(IEWindowsRegEditor.COMPLETE_REG_PATH)
+PAC = "http://pac.example/proxy.pac"
+USERS = ("S-1-5-21-1-2-3-1001", "S-1-5-21-1-2-3-1002", "S-1-12-1-4-5-6-7")
+# MemoryBackend enumerates keys lower-cased
+LISTED = sorted(sid.lower() for sid in USERS)
+
+
+def hive(url=""):
+    blob = ConnectionSettings(flags=0x05 if url else 0x01, auto_config_url=url.encode("latin-1")).encode()
+    return {
+        PATH.rsplit("\\", 1)[0]: {IEWindowsRegEditor.AUTO_CONFIG_REGVAL: (url, REG_SZ)},
+        PATH: {IEWindowsRegEditor.CONNECTION_SETTINGS: (blob, REG_BINARY),
+               IEWindowsRegEditor.LEGACY_SETTINGS: (blob, REG_BINARY)},
+    }
+
+
+def auto_config(backend, sid):
+    with IEWindowsRegEditor(backend, sid) as net:
+        settings = ConnectionSettings.decode(net.read_default_connection_settings())
+        return net.read_auto_config(), settings.auto_config_url.decode("latin-1")
+
+
+@pytest.fixture
+def backend(monkeypatch, tmp_path):
+    backend = HivesBackend()
+    for sid in USERS:
+        backend.add_hive(sid, hive())
+    # Hives without Internet Settings of their own
+    for sid in ("S-1-5-18", ".DEFAULT", USERS[0] + "_Classes"):
+        backend.add_hive(sid, {"Software": {}})
+    monkeypatch.setattr(ProxyHelper, "backend", backend)
+    monkeypatch.setattr(ProxyHelper, "backup_file", str(tmp_path))
+    monkeypatch.setattr(ProxyHelper, "backup_store", None)
+    monkeypatch.setattr(ProxyHelper, "profile_store", None)
+    return backend
+
+
+def test_list_hives_keeps_user_sids_only(backend):
+    assert list_hives(backend) == LISTED
+
+
+def test_install_and_restore_every_hive(backend, tmp_path):
+    report = MultiUserApply(workers=4).install_pac_file(PAC)
+    assert report.ok and [r.sid for r in report.results] == LISTED
+    for sid in LISTED:
+        assert auto_config(backend, sid) == (PAC, PAC)
+        # Each hive keeps its own backups and journal
+        assert os.listdir(str(tmp_path / "hives" / sid))
+    assert all(r.backup == 1 for r in report.results)
+
+    report = MultiUserApply(workers=4).restore_defaults()
+    assert report.ok
+    assert all(r.backup == 2 for r in report.results)
+    for sid in LISTED:
+        assert auto_config(backend, sid) == ("", "")
+        assert ProxyHelper.for_hive(sid).store().load(2)[IEWindowsRegEditor.AUTO_CONFIG_REGVAL] == PAC
+
+
+def test_report_aggregates_failures(backend):
+    broken = "S-1-5-21-9-9-9-1000"
+    backend.add_hive(broken, {"Software": {}})
+    report = MultiUserApply(sids=list(USERS) + [broken]).install_pac_file(PAC)
+    summary = report.to_dict()
+    assert not report.ok
+    assert (summary["hives"], summary["succeeded"], summary["failed"]) == (4, 3, 1)
+    failed = [entry for entry in summary["results"] if not entry["ok"]]
+    assert [entry["sid"] for entry in failed] == [broken] and failed[0]["error"]
+    assert all("status" in entry for entry in summary["results"] if entry["ok"])
+
+
+def test_no_hives_is_not_ok(backend):
+    report = MultiUserApply(sids=[]).install_pac_file(PAC)
+    assert not report.ok and report.to_dict()["hives"] == 0
+
+
+def test_file_backend_is_safe_to_share(tmp_path):
+    # The CLI runs --all-users --registry on up to HIVE_WORKERS threads
+    backend = FileBackend(str(tmp_path / "registry.json"))
+    backend.create_key(HKEY_USERS, "S-1-5-21-1")
+    errors = []
+    done = threading.Event()
+
+    def writer(n):
+        try:
+            for i in range(1000):
+                handle = backend.open_key(HKEY_USERS, "S-1-5-21-1")
+                backend.set_value(handle, "v{}-{}".format(n, i), REG_SZ, str(i))
+                backend.close_key(handle)
+        except Exception as e:
+            errors.append(e)
+
+    def saver():
+        try:
+            while not done.is_set():
+                backend.save()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(8)]
+    save_thread = threading.Thread(target=saver)
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        save_thread.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        done.set()
+        save_thread.join()
+        sys.setswitchinterval(interval)
+    assert not errors
+    assert (backend.opened, backend.writes, backend.live) == (8000, 8000, 0)
+    backend.save()
+    assert len(FileBackend(str(tmp_path / "registry.json")).keys[(HKEY_USERS, "s-1-5-21-1")]) == 8000
@@ -0,0 +1,59 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import pytest
+
+from fwdproxy import BadRequest, ProxyError
+from httphead import HttpError, content_length, end_to_end, header, parse_head
+
+
+def test_parse_head():
+    first, headers = parse_head(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nETag:  \"v1\" \r\n\r\n")
+    assert first == [b"HTTP/1.1", b"200", b"OK"]
+    assert headers == [(b"content-length", b"Content-Length", b"2"), (b"etag", b"ETag", b'"v1"')]
+    assert header(headers, b"etag") == b'"v1"'
+    assert header(headers, b"via") is None
+
+
+@pytest.mark.parametrize("head", [b"HTTP/1.1\r\n\r\n", b"GET / HTTP/1.1\r\nNoColon\r\n\r\n"])
+def test_malformed_heads(head):
+    with pytest.raises(HttpError):
+        parse_head(head)
+
+
+def test_end_to_end_drops_headers_named_by_connection():
+    _, headers = parse_head(b"GET / HTTP/1.1\r\nConnection: close, X-Trace\r\nX-Trace: 1\r\n"
+                            b"Keep-Alive: 5\r\nAccept: */*\r\n\r\n")
+    assert end_to_end(headers) == [b"Accept: */*\r\n"]
+
+
+def test_content_length():
+    assert content_length([]) is None
+    assert content_length([(b"content-length", b"Content-Length", b"12")]) == 12
+    with pytest.raises(HttpError):
+        content_length([(b"content-length", b"Content-Length", b"-1")])
+    with pytest.raises(BadRequest):
+        content_length([(b"content-length", b"Content-Length", b"1e3")], BadRequest)
+
+
+def test_proxy_errors_are_http_errors():
+    assert issubclass(ProxyError, HttpError)
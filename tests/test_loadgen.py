@@ -0,0 +1,71 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import asyncio
+import json
+import socket
+
+import pytest
+
+from loadgen import LoadGenerator, main, schedule
+
+
+def test_schedules_are_ordered_and_reproducible():
+    for pattern in ("steady", "ramp", "storm"):
+        arrivals = schedule(pattern, 2.0, rate=50, clients=100, seed=7)
+        assert arrivals == sorted(arrivals) == schedule(pattern, 2.0, rate=50, clients=100, seed=7)
+        assert arrivals and 0 <= arrivals[0] and arrivals[-1] <= 2.0
+    assert len(schedule("storm", 2.0, clients=100)) == 100
+
+
+@pytest.mark.parametrize("extra", [[], ["--local-proxy", "--revalidate", "0.5"]])
+def test_run_against_the_stand_in_origin(tmp_path, capsys, extra):
+    output = tmp_path / "report.json"
+    code = main(["--origin", "--pattern", "storm", "--clients", "40", "--duration", "0.5",
+                 "--output", str(output)] + extra)
+    report = json.loads(output.read_text())
+    assert code == 0
+    assert report["requests"] == report["ok"] == 40 and report["failed"] == 0
+    assert report["throughput_rps"] > 0 and report["errors"] == {}
+    assert set(report["statuses"]) <= {"200", "304"}
+    latency = report["latency_us"]
+    assert 0 < latency["p50"] <= latency["p99"] <= latency["p99.99"] <= latency["max"]
+    assert report["service_us"]["p50"] <= latency["max"]
+    assert sum(s.get("ok", 0) for s in report["timeline"]) == 40
+
+
+def test_connection_errors_are_broken_down():
+    with socket.socket() as closed:
+        closed.bind(("127.0.0.1", 0))
+        port = closed.getsockname()[1]
+    generator = LoadGenerator("http://127.0.0.1:{}/proxy.pac".format(port), timeout=2.0)
+    report = asyncio.run(generator.run(schedule("storm", 0.1, clients=5))).to_dict()
+    assert report["requests"] == report["failed"] == 5
+    assert report["errors"] == {"refused": 5}
+    assert report["ok"] == 0 and report["throughput_rps"] == 0
+
+
+def test_rejects_unsupported_targets():
+    with pytest.raises(ValueError):
+        LoadGenerator("ftp://example.com/proxy.pac")
+    with pytest.raises(ValueError):
+        LoadGenerator("https://example.com/proxy.pac", via="127.0.0.1:3128")
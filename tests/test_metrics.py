@@ -0,0 +1,124 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import json
+import os
+import runpy
+
+import pytest
+
+from metrics import METRICS, Histogram, Metrics, timed
+from proxy import ProxyHelper, Result
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_histogram_buckets_cover_values_within_a_quarter():
+    for value in list(range(64)) + [100, 1000, 12345, 10 ** 6, 2 ** 40 + 1]:
+        low, high = Histogram.bounds(Histogram.index(value))
+        assert low <= value < high
+        assert high - low <= max(1, low // 4)
+
+
+def test_record_matches_index():
+    histogram = Histogram()
+    for value in (0, 7, 8, 9, 1000, 123456):
+        histogram.record(value)
+        assert histogram.counts[Histogram.index(value)] >= 1
+    assert histogram.count == 6 and histogram.max == 123456
+
+
+def test_percentiles():
+    histogram = Histogram()
+    for value in range(1, 1001):
+        histogram.record(value)
+    assert 500 <= histogram.percentile(50) <= 625
+    assert 990 <= histogram.percentile(99) <= 1000
+    assert histogram.percentile(100) == 1000
+    assert Histogram().percentile(50) == 0
+
+
+def test_timed_counts_failures():
+    @timed("test.timed")
+    def operation(outcome):
+        if outcome == "raise":
+            raise OSError("boom")
+        return outcome
+
+    before = METRICS.histogram("test.timed").count
+    failures = METRICS.counters.get("test.timed.failures", 0)
+    operation(Result.success())
+    operation(Result.failure("no"))
+    operation((False, "no"))
+    with pytest.raises(OSError):
+        operation("raise")
+    assert METRICS.histogram("test.timed").count == before + 4
+    assert METRICS.counters["test.timed.failures"] == failures + 3
+
+
+def test_prometheus_export():
+    metrics = Metrics()
+    for micros in (100, 200, 5000):
+        metrics.observe("proxy.backup", micros)
+    metrics.count("registry.key_opens", 3)
+    lines = metrics.prometheus().splitlines()
+    assert "# TYPE ipsx_proxy_backup_seconds histogram" in lines
+    assert 'ipsx_proxy_backup_seconds_bucket{le="+Inf"} 3' in lines
+    assert "ipsx_proxy_backup_seconds_count 3" in lines
+    assert "ipsx_proxy_backup_seconds_sum 0.0053" in lines
+    assert "ipsx_registry_key_opens_total 3" in lines
+    buckets = [int(line.rsplit(" ", 1)[1]) for line in lines if "_bucket{" in line]
+    assert buckets == sorted(buckets)
+
+
+def test_saves_append_and_load_adds_them_up(tmp_path):
+    path = str(tmp_path / "metrics.json")
+    for _ in range(3):
+        metrics = Metrics()
+        metrics.observe("proxy.install_pac_file", 1500)
+        metrics.count("registry.key_opens")
+        metrics.save(path)
+    with open(path, "a") as file_:
+        file_.write('{"histograms": {"proxy.inst')
+    loaded = Metrics.load(path)
+    assert loaded.summary("proxy.install_pac_file")["count"] == 3
+    assert loaded.counters == {"registry.key_opens": 3}
+    snapshot = json.loads(json.dumps(loaded.snapshot()))
+    assert Metrics().merge_snapshot(snapshot).summary("proxy.install_pac_file") == \
+        loaded.summary("proxy.install_pac_file")
+
+
+@pytest.fixture
+def cli(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    for name in ("backend", "backup_file", "backup_store", "profile_store"):
+        monkeypatch.setattr(ProxyHelper, name, getattr(ProxyHelper, name))
+    (tmp_path / "registry.json").write_text("[]")
+    return runpy.run_path(os.path.join(ROOT, "__main__.py"))["main"]
+
+
+def test_cli_keeps_metrics_only_when_asked(cli, tmp_path, capsys):
+    cli(["--registry", "registry.json", "backup", "--list"])
+    assert not (tmp_path / "metrics.json").exists()
+    cli(["--registry", "registry.json", "--metrics", "m.json", "backup", "--list"])
+    assert Metrics.load(str(tmp_path / "m.json")).recorded()
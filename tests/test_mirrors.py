@@ -0,0 +1,94 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import asyncio
+
+import pytest
+
+from mirrors import HealthMonitor, MirrorSet, Probe, http_get
+from proxy import Result
+
+
+PAC = b'function FindProxyForURL(url, host) { return "DIRECT"; }'
+
+
+async def close_delimited(body, max_size=1 << 20):
+    """
+    Serves ``body`` without Content-Length, in small delayed writes.
+    """
+    async def handle(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(b"HTTP/1.1 200 OK\r\nConnection: close\r\n\r\n")
+        for start in range(0, len(body), 16):
+            writer.write(body[start:start + 16])
+            await writer.drain()
+            await asyncio.sleep(0.005)
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        return await http_get("http://127.0.0.1:{}/proxy.pac".format(port), max_size=max_size)
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+def test_close_delimited_body_read_to_eof():
+    assert asyncio.run(close_delimited(PAC)) == (200, PAC)
+
+
+def test_close_delimited_body_size_cap():
+    with pytest.raises(ValueError, match="too large"):
+        asyncio.run(close_delimited(PAC, max_size=32))
+
+
+class CannedMirrors(MirrorSet):
+
+    def __init__(self, probes):
+        MirrorSet.__init__(self, list(probes))
+        self.probes = probes
+
+    def probe(self, urls=None, fresh=False):
+        return [self.probes[u] for u in (self.urls if urls is None else urls)]
+
+
+def monitor(apply):
+    mirrors = CannedMirrors({
+        "http://a/proxy.pac": Probe("http://a/proxy.pac", False, error="timed out"),
+        "http://b/proxy.pac": Probe("http://b/proxy.pac", True, 0.01),
+    })
+    log = []
+    return HealthMonitor(mirrors, "http://a/proxy.pac", apply, log=lambda *args: log.append(args)), log
+
+
+def test_failover_switches_after_successful_apply():
+    health, log = monitor(lambda url: Result.success("installed"))
+    assert health.check().url == "http://b/proxy.pac"
+    assert health.active == "http://b/proxy.pac" and health.failovers == 1
+
+
+def test_failover_keeps_active_mirror_when_apply_fails():
+    health, log = monitor(lambda url: Result.failure("Access denied"))
+    assert health.check() is None
+    assert health.active == "http://a/proxy.pac" and health.failovers == 0
+    assert log == [("Cannot switch PAC mirror to http://b/proxy.pac: Access denied", "mirror")]
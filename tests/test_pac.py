@@ -0,0 +1,74 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import sys
+import threading
+
+import pytest
+
+from pac import DecisionCache, PacEngine, PacError, PacScript
+
+
+def test_regex_literal():
+    engine = PacEngine.from_source(
+        'function FindProxyForURL(url, host) { return /^intra\\./i.test(host) ? "DIRECT" : "PROXY p:1"; }')
+    assert engine.evaluate("http://Intra.example/") == "DIRECT"
+    assert engine.evaluate("http://www.example/") == "PROXY p:1"
+
+
+def test_invalid_regex_literal_is_a_pac_error():
+    with pytest.raises(PacError, match="Invalid regular expression"):
+        PacScript('function FindProxyForURL(url, host) { return /(unclosed/.test(host) ? "DIRECT" : "DIRECT"; }')
+
+
+def test_missing_find_proxy_for_url():
+    with pytest.raises(PacError):
+        PacScript("var x = 1;")
+
+
+def test_decision_cache_survives_concurrent_readers_and_writers():
+    # The forwarding proxy reads on its loop while the evaluator writes;
+    # a tiny cache makes every put evict what a reader just found
+    cache = DecisionCache(size=2)
+    errors = []
+
+    def run(operation):
+        try:
+            for i in range(20000):
+                operation(("http", "h{}".format(i % 4)))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(lambda key: cache.put(key, "DIRECT"),)) for _ in range(2)]
+    threads += [threading.Thread(target=run, args=(cache.get,)) for _ in range(2)]
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert not errors
+    assert len(cache.entries) <= 2
+    assert cache.hits + cache.misses == 40000
@@ -0,0 +1,185 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from pacfetch import DiskCache, PacFetcher
+
+
+PAC = b'function FindProxyForURL(url, host) { return "DIRECT"; }'
+
+
+class Origin(object):
+    """
+    Stand-in PAC origin on http.server, recording the requests it sees.
+    """
+
+    def __init__(self):
+        self.body = PAC
+        self.etag = '"v1"'
+        self.chunked = False
+        self.requests = []
+        origin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                origin.requests.append(dict(self.headers))
+                if self.headers.get("If-None-Match") == origin.etag:
+                    self.send_response(304)
+                    self.send_header("ETag", origin.etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ns-proxy-autoconfig")
+                self.send_header("ETag", origin.etag)
+                if origin.chunked:
+                    # No Content-Length: the size limit must hold on the body itself
+                    self.send_header("Connection", "close")
+                    self.end_headers()
+                    self.wfile.write(origin.body)
+                    self.close_connection = True
+                    return
+                self.send_header("Content-Length", str(len(origin.body)))
+                self.end_headers()
+                self.wfile.write(origin.body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, path="/proxy.pac"):
+        return "http://127.0.0.1:{}{}".format(self.httpd.server_port, path)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def origin():
+    origin = Origin()
+    yield origin
+    origin.close()
+
+
+@pytest.fixture
+def fetcher(tmp_path):
+    fetcher = PacFetcher(DiskCache(str(tmp_path / "cache")))
+    yield fetcher
+    fetcher.close()
+
+
+def test_fetch_stores_validators(origin, fetcher):
+    resp = fetcher.fetch(origin.url())
+    assert resp.status == 200 and resp.body == PAC and not resp.from_cache
+    assert resp.etag == '"v1"'
+    assert fetcher.cache.validators(origin.url())["etag"] == '"v1"'
+
+
+def test_conditional_get_served_from_cache(origin, fetcher):
+    fetcher.fetch(origin.url())
+    resp = fetcher.fetch(origin.url())
+    assert resp.status == 304 and resp.from_cache and resp.body == PAC
+    assert "If-None-Match" not in origin.requests[0]
+    assert origin.requests[1]["If-None-Match"] == '"v1"'
+
+
+def test_changed_etag_refetches(origin, fetcher):
+    fetcher.fetch(origin.url())
+    origin.etag = '"v2"'
+    origin.body = PAC.replace(b"DIRECT", b"PROXY p:8080")
+    resp = fetcher.fetch(origin.url())
+    assert resp.status == 200 and resp.body == origin.body and resp.etag == '"v2"'
+    assert fetcher.cache.get(origin.url()) == origin.body
+
+
+def test_etag_reused_across_fetchers(origin, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    first = PacFetcher(DiskCache(cache_dir))
+    first.fetch(origin.url())
+    first.close()
+    second = PacFetcher(DiskCache(cache_dir))
+    resp = second.fetch(origin.url())
+    second.close()
+    assert resp.from_cache and resp.body == PAC
+    assert origin.requests[-1]["If-None-Match"] == '"v1"'
+
+
+def test_missing_cached_body_refetches(origin, fetcher):
+    fetcher.fetch(origin.url())
+    fetcher.cache.discard(origin.url())
+    resp = fetcher.fetch(origin.url())
+    assert resp.status == 200 and not resp.from_cache
+
+
+def test_size_limit_by_content_length(origin):
+    fetcher = PacFetcher(max_size=16)
+    with pytest.raises(ValueError, match="too large"):
+        fetcher.fetch(origin.url())
+    fetcher.close()
+
+
+def test_size_limit_without_content_length(origin):
+    origin.chunked = True
+    fetcher = PacFetcher(max_size=16)
+    with pytest.raises(ValueError, match="too large"):
+        fetcher.fetch(origin.url())
+    fetcher.close()
+
+
+def test_rejects_non_pac(origin, fetcher):
+    origin.body = b"<html>captive portal</html>"
+    with pytest.raises(ValueError, match="Not a PAC file"):
+        fetcher.fetch(origin.url())
+    assert fetcher.cache.get(origin.url()) is None
+
+
+def test_disk_cache_lru_eviction(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=10)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    assert cache.get("a") == b"aaaa"
+    cache.put("c", b"cccc")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"aaaa" and cache.get("c") == b"cccc"
+    assert cache.size == 8
+
+
+def test_disk_cache_skips_oversized_and_persists(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=10)
+    cache.put("big", b"x" * 11)
+    cache.put("a", b"aaaa", etag='"e"')
+    assert cache.get("big") is None
+    reopened = DiskCache(str(tmp_path), max_bytes=10)
+    assert reopened.get("a") == b"aaaa"
+    assert reopened.validators("a")["etag"] == '"e"'
+    assert reopened.size == 4
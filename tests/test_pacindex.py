@@ -0,0 +1,116 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import pytest
+
+from pac import PacEngine, PacHelpers, PacScript
+from pacindex import IndexedPacEngine, PacIndex
+
+
+ADDRESSES = {"intranet.corp.example": "10.1.2.3", "www.example.com": "93.184.216.34"}
+
+HOSTS = ("localhost", "intranet", "corp.example", "intranet.corp.example", "a.b.corp.example",
+         "notcorp.example", "www.example.com", "example.com", "cdn.example.net", "10.0.0.7",
+         "printer.lan.example", "172.16.0.1", "unknown.test")
+
+RULES = """
+var proxy = "PROXY proxy.example:8080";
+function FindProxyForURL(url, host) {
+    host = host.toLowerCase();
+    if (isPlainHostName(host)) return "DIRECT";
+    if (dnsDomainIs(host, ".corp.example") || shExpMatch(host, "corp.example")) return "DIRECT";
+    if (shExpMatch(host, "*example.net")) return "PROXY cdn.example:3128";
+    if (isInNet(host, "10.0.0.0", "255.0.0.0")) return "DIRECT";
+    if (isInNet(dnsResolve(host), "93.184.216.0", "255.255.255.0")) return "PROXY edge.example:80";
+    if (shExpMatch(host, "*.lan.example")) return "DIRECT";
+    return proxy;
+}
+"""
+
+
+def engines(source):
+    helpers = PacHelpers(resolver=ADDRESSES.get)
+    script = PacScript(source, helpers)
+    return PacEngine(script, cache=None), IndexedPacEngine(script, cache=None)
+
+
+def assert_equivalent(source):
+    plain, indexed = engines(source)
+    for host in HOSTS:
+        url = "http://{}/".format(host)
+        assert indexed.evaluate(url) == plain.evaluate(url), host
+    return indexed
+
+
+def test_index_matches_engine():
+    indexed = assert_equivalent(RULES)
+    assert len(indexed.index.answers) == 7
+    assert indexed.fallbacks < len(HOSTS)
+
+
+def test_index_stops_at_the_first_unsupported_rule():
+    source = RULES.replace('    if (shExpMatch(host, "*example.net"))',
+                           '    if (url.substring(0, 5) == "https") return "DIRECT";\n'
+                           '    if (shExpMatch(host, "*example.net"))')
+    indexed = assert_equivalent(source)
+    assert len(indexed.index.answers) == 2
+
+
+def test_local_var_shadows_a_constant():
+    # The var is hoisted: proxy is undefined when the rules run
+    source = RULES.replace("    return proxy;\n", "    return proxy;\n    var proxy = \"DIRECT\";\n")
+    indexed = assert_equivalent(source)
+    assert "PROXY proxy.example:8080" not in indexed.index.answers
+
+
+def test_parameter_shadows_a_constant():
+    source = RULES.replace("function FindProxyForURL(url, host)", "function FindProxyForURL(url, host, proxy)")
+    indexed = assert_equivalent(source)
+    assert "PROXY proxy.example:8080" not in indexed.index.answers
+
+
+@pytest.mark.parametrize("override", [
+    "function dnsDomainIs(host, domain) { return false; }\n",
+    "var isPlainHostName = function (host) { return false; };\n",
+    "function dnsResolve(host) { return \"10.9.9.9\"; }\n",
+])
+def test_redefined_helpers_are_not_lowered(override):
+    assert_equivalent(override + RULES)
+
+
+def test_local_helper_shadowing_is_not_lowered():
+    # Hoisted like the var above
+    source = RULES.replace("    return proxy;\n",
+                           "    return proxy;\n    function shExpMatch(s, p) { return true; }\n")
+    assert_equivalent(source)
+
+
+def test_saved_index_round_trip(tmp_path):
+    script = PacScript(RULES, PacHelpers(resolver=ADDRESSES.get))
+    index = PacIndex.compile(script)
+    path = str(tmp_path / "index.json")
+    index.save(path)
+    loaded = PacIndex.load(path, script)
+    for host in HOSTS:
+        assert loaded.lookup(host, script.helpers.dnsResolve) == index.lookup(host, script.helpers.dnsResolve)
+    with pytest.raises(ValueError):
+        PacIndex.load(path, PacScript(RULES.replace("8080", "8081")))
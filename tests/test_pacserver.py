@@ -0,0 +1,74 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import gzip
+import http.client
+
+import pytest
+
+from pacserver import PacServer, accepts_gzip
+
+
+PAC = b'function FindProxyForURL(url, host) { return "DIRECT"; }' * 10
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("gzip", True),
+    ("gzip, deflate, br", True),
+    ("deflate, gzip;q=0.5", True),
+    ("GZIP", True),
+    ("", False),
+    ("identity", False),
+    ("gzip;q=0", False),
+    ("gzip; q=0.000", False),
+    ("identity, x-gzip", False),
+    ("*", True),
+    ("*;q=0", False),
+    ("gzip;q=0, *", False),
+    ("gzip;q=bogus", False),
+])
+def test_accepts_gzip(value, expected):
+    assert accepts_gzip(value) is expected
+
+
+@pytest.fixture
+def server():
+    server = PacServer(PAC).start_in_thread()
+    yield server
+    server.stop_thread()
+
+
+def get(server, accept_encoding):
+    conn = http.client.HTTPConnection("127.0.0.1", server.port, timeout=5)
+    try:
+        conn.request("GET", "/proxy.pac", headers={"Accept-Encoding": accept_encoding})
+        resp = conn.getresponse()
+        return resp.getheader("Content-Encoding"), resp.read()
+    finally:
+        conn.close()
+
+
+def test_serves_gzip_only_when_accepted(server):
+    encoding, body = get(server, "gzip")
+    assert encoding == "gzip" and gzip.decompress(body) == PAC
+    encoding, body = get(server, "gzip;q=0")
+    assert encoding is None and body == PAC
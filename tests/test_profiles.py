@@ -0,0 +1,130 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import pytest
+
+from backend import HKEY_CURRENT_USER, REG_BINARY, REG_SZ, MemoryBackend
+from codec import ConnectionSettings
+from profiles import Profile, ProfileStore
+from proxy import ProxyHelper
+from reg import IEWindowsRegEditor
+
+
+PATH = "\\".join(IEWindowsRegEditor.COMPLETE_REG_PATH)
+PAC = "http://pac.example/proxy.pac"
+
+
+def blob(counter=1, bypass=b""):
+    return ConnectionSettings(counter=counter, bypass_list=bypass).encode()
+
+
+def test_encodings_are_cached_per_base_blob(tmp_path):
+    store = ProfileStore(str(tmp_path))
+    profile = Profile("office", PAC)
+    first = store.encoded(profile, blob())
+    assert store.encoded(profile, blob()) == first == profile.encode(blob())
+    assert (store.hits, store.misses) == (1, 1)
+    # Another base blob, e.g. after Windows bumped the counter, is a miss
+    assert store.encoded(profile, blob(counter=2)) == profile.encode(blob(counter=2))
+    assert (store.hits, store.misses) == (1, 2)
+
+
+def test_least_recently_used_encodings_are_evicted(tmp_path):
+    store = ProfileStore(str(tmp_path), cache_size=2)
+    profile = Profile("office", PAC)
+    for counter in (1, 2):
+        store.encoded(profile, blob(counter))
+    store.encoded(profile, blob(1))
+    store.encoded(profile, blob(3))
+    assert len(store.cache) == 2
+    store.encoded(profile, blob(1))
+    assert store.misses == 3
+    store.encoded(profile, blob(2))
+    assert store.misses == 4
+
+
+def test_replacing_a_profile_discards_its_encodings(tmp_path):
+    store = ProfileStore(str(tmp_path))
+    store.add(Profile("office", PAC))
+    store.add(Profile("home"))
+    store.encoded(store.get("office"), blob())
+    store.encoded(store.get("home"), blob())
+    replaced = Profile("office", proxy_server="proxy.example:8080")
+    store.add(replaced)
+    assert store.encoded(store.get("office"), blob()) == replaced.encode(blob())
+    assert store.misses == 3
+    assert store.remove("home") and not store.remove("home")
+    assert all(not key.startswith("home\0") for key in store.cache)
+
+
+def test_profiles_and_encodings_persist(tmp_path):
+    store = ProfileStore(str(tmp_path))
+    store.add(Profile("office", PAC))
+    store.encoded(store.get("office"), blob())
+    store.save()
+    reloaded = ProfileStore(str(tmp_path))
+    assert reloaded.names() == ["office"] and reloaded.get("office").pac_url == PAC
+    reloaded.encoded(reloaded.get("office"), blob())
+    assert (reloaded.hits, reloaded.misses) == (1, 0)
+
+
+def test_profile_needs_one_kind_of_proxy():
+    with pytest.raises(ValueError):
+        Profile("both", PAC, "proxy.example:8080")
+
+
+@pytest.fixture
+def helper(monkeypatch, tmp_path):
+    backend = MemoryBackend({
+        (HKEY_CURRENT_USER, PATH.rsplit("\\", 1)[0]): {IEWindowsRegEditor.AUTO_CONFIG_REGVAL: ("", REG_SZ)},
+        (HKEY_CURRENT_USER, PATH): {IEWindowsRegEditor.CONNECTION_SETTINGS: (blob(), REG_BINARY),
+                                    IEWindowsRegEditor.LEGACY_SETTINGS: (blob(), REG_BINARY)},
+    })
+    monkeypatch.setattr(ProxyHelper, "backend", backend)
+    monkeypatch.setattr(ProxyHelper, "backup_file", str(tmp_path))
+    monkeypatch.setattr(ProxyHelper, "journal_file", str(tmp_path / "journal"))
+    monkeypatch.setattr(ProxyHelper, "backup_store", None)
+    monkeypatch.setattr(ProxyHelper, "profile_store", None)
+    return ProxyHelper
+
+
+def test_switch_add_and_remove(helper):
+    assert helper.save_profile(Profile("office", PAC))
+    assert helper.save_profile(Profile("home"))
+    assert helper.profiles().names() == ["office", "home"]
+
+    assert helper.switch_profile("office").value == "office"
+    assert helper.read_pac_link() == PAC
+    assert helper.active_profile() == "office"
+    assert helper.switch_profile("home")
+    assert helper.read_pac_link() == ""
+    assert helper.active_profile() == "home"
+    # Switching back reuses the encoding cached for this base blob
+    hits = helper.profiles().hits
+    assert helper.switch_profile("office") and helper.switch_profile("home")
+    assert helper.profiles().hits >= hits + 1
+
+    assert not helper.switch_profile("missing")
+    assert helper.remove_profile("home")
+    assert not helper.remove_profile("home")
+    ProxyHelper.profile_store = None
+    assert helper.profiles().names() == ["office"]
@@ -0,0 +1,49 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import pytest
+
+from profiling import Profiler
+from res import PROFILE_ENV
+
+
+@pytest.mark.parametrize("value", ["", "0", "off", "False", "no"])
+def test_off_values(monkeypatch, value):
+    monkeypatch.setenv(PROFILE_ENV, value)
+    assert Profiler.from_env() is None
+
+
+@pytest.mark.parametrize("value", ["1", "yes", "TRUE", "on"])
+def test_truthy_values_profile_everything(monkeypatch, tmp_path, value):
+    monkeypatch.setenv(PROFILE_ENV, value)
+    assert Profiler.from_env(directory=str(tmp_path)).mode == "all"
+
+
+def test_flag_wins_over_environment(monkeypatch, tmp_path):
+    monkeypatch.setenv(PROFILE_ENV, "all")
+    assert Profiler.from_env("ops", str(tmp_path)).mode == "ops"
+
+
+def test_unknown_value_warns_instead_of_failing(monkeypatch, capsys):
+    monkeypatch.setenv(PROFILE_ENV, "verbose")
+    assert Profiler.from_env() is None
+    assert PROFILE_ENV in capsys.readouterr().err
@@ -0,0 +1,58 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from codec import ConnectionSettings
+from reg import IEWindowsRegEditor
+
+
+def settings(**kwargs):
+    settings = ConnectionSettings()
+    settings.set_flag(ConnectionSettings.DIRECT)
+    settings.set_proxy_server("proxy.example:8080", **kwargs)
+    return settings.encode()
+
+
+def test_bypass_edit_keeps_disabled_proxy_off():
+    out = ConnectionSettings.decode(IEWindowsRegEditor.alter_settings(settings(enable=False),
+                                                                      add_bypass=["*.local"]))
+    assert out.proxy_server == b"proxy.example:8080"
+    assert not out.flags & ConnectionSettings.PROXY
+    assert out.bypass_entries() == ["*.local"]
+
+
+def test_bypass_edit_keeps_enabled_proxy_on():
+    out = ConnectionSettings.decode(IEWindowsRegEditor.alter_settings(settings(), bypass=["a"]))
+    assert out.flags & ConnectionSettings.PROXY
+
+
+def test_proxy_server_sets_and_clears_the_bit():
+    out = IEWindowsRegEditor.alter_settings(settings(enable=False), proxy_server="other:3128")
+    assert ConnectionSettings.decode(out).flags & ConnectionSettings.PROXY
+    out = ConnectionSettings.decode(IEWindowsRegEditor.alter_settings(out, proxy_server=""))
+    assert not out.flags & ConnectionSettings.PROXY and out.proxy_server == b""
+
+
+def test_auto_config_sets_its_bit_only():
+    out = ConnectionSettings.decode(IEWindowsRegEditor.alter_settings(
+        settings(enable=False), auto_config="http://pac.example/proxy.pac"))
+    assert out.flags & ConnectionSettings.AUTO_PROXY_URL
+    assert not out.flags & ConnectionSettings.PROXY
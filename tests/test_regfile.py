@@ -0,0 +1,79 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import io
+
+from codec import ConnectionSettings
+from regfile import RegFilePatcher, RegFileReader, RegFileWriter
+
+
+SETTINGS = "Software\\Microsoft\\Windows\\CurrentVersion\\Internet Settings"
+BLOB = ConnectionSettings(counter=1, trailer=b"\0" * 32).encode()
+
+
+def export(root, auto_config_name="AutoConfigURL"):
+    return (
+        "Windows Registry Editor Version 5.00\r\n\r\n"
+        "[{0}\\{1}]\r\n"
+        '"{2}"="http://old/proxy.pac"\r\n\r\n'
+        "[{0}\\{1}\\Connections]\r\n"
+        "{3}\r\n"
+    ).format(root, SETTINGS, auto_config_name,
+             RegFileWriter.format_binary("DefaultConnectionSettings", BLOB).rstrip("\r\n"))
+
+
+def patch(text, link="http://new/proxy.pac"):
+    out = io.StringIO()
+    count = RegFilePatcher(link).patch_stream(io.StringIO(text), out)
+    return count, out.getvalue()
+
+
+def binary(text):
+    for kind, name, lines in RegFileReader(io.StringIO(text)):
+        if kind == "value" and name == "DefaultConnectionSettings":
+            return ConnectionSettings.decode(RegFileReader.decode_binary(lines))
+
+
+def test_patches_current_user():
+    count, out = patch(export("HKEY_CURRENT_USER"))
+    assert count == 2
+    assert '"AutoConfigURL"="http://new/proxy.pac"' in out and "old" not in out
+    assert binary(out).auto_config_url == b"http://new/proxy.pac"
+
+
+def test_value_names_are_case_insensitive():
+    count, out = patch(export("HKEY_CURRENT_USER", "autoconfigurl"))
+    assert count == 2
+    assert '"autoconfigurl"="http://new/proxy.pac"' in out
+    assert out.count("AutoConfigURL") == 0
+
+
+def test_patches_a_user_hive():
+    count, out = patch(export("HKEY_USERS\\S-1-5-21-1-2-3-1001"))
+    assert count == 2 and "old" not in out
+
+
+def test_machine_sections_are_left_alone():
+    text = export("HKEY_LOCAL_MACHINE")
+    assert patch(text) == (0, text)
+    text = export("HKEY_USERS\\S-1-5-21-1-2-3-1001\\Nested")
+    assert patch(text) == (0, text)
@@ -0,0 +1,190 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import json
+import os
+import runpy
+
+import pytest
+
+from backend import HKEY_CURRENT_USER, REG_BINARY, FileBackend, MemoryBackend
+from proxy import ProxyHelper
+from reg import IEWindowsRegEditor
+from res import NO_SETTINGS_ERR
+from transaction import Transaction, encode_value
+
+
+AUTO_CONFIG = IEWindowsRegEditor.AUTO_CONFIG_REGVAL
+SETTINGS = IEWindowsRegEditor.CONNECTION_SETTINGS
+LEGACY = IEWindowsRegEditor.LEGACY_SETTINGS
+PATH = "\\".join(IEWindowsRegEditor.COMPLETE_REG_PATH)
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FailingBackend(MemoryBackend):
+    """
+    Fails the write of one value name.
+    """
+
+    fail = None
+
+    def set_value(self, handle, name, kind, value):
+        if name == self.fail:
+            raise OSError("Access denied")
+        MemoryBackend.set_value(self, handle, name, kind, value)
+
+
+class LockedBackend(MemoryBackend):
+    """
+    Fails every read of one value name like a sharing violation would.
+    """
+
+    locked = None
+
+    def query_value(self, handle, name):
+        if name == self.locked:
+            raise PermissionError("The process cannot access the file")
+        return MemoryBackend.query_value(self, handle, name)
+
+
+def registry(cls=MemoryBackend):
+    # No AutoConfigURL yet, like a machine that never had a PAC file
+    return cls({
+        (HKEY_CURRENT_USER, PATH.rsplit("\\", 1)[0]): {},
+        (HKEY_CURRENT_USER, PATH): {SETTINGS: (b"\x46old", REG_BINARY), LEGACY: (b"\x46old", REG_BINARY)},
+    })
+
+
+def values(backend):
+    with IEWindowsRegEditor(backend) as net:
+        out = {}
+        for name in (AUTO_CONFIG, SETTINGS, LEGACY):
+            try:
+                out[name] = net.read_value(name)
+            except OSError:
+                out[name] = None
+        return out
+
+
+def test_commit_skips_unchanged_values(tmp_path):
+    backend = registry()
+    with IEWindowsRegEditor(backend) as net:
+        txn = Transaction(net, str(tmp_path / "journal"))
+        txn.set(AUTO_CONFIG, "http://pac/proxy.pac").set(SETTINGS, b"\x46old")
+        assert txn.commit() == 1
+    assert values(backend)[AUTO_CONFIG] == "http://pac/proxy.pac"
+    assert not (tmp_path / "journal").exists()
+
+
+def test_failed_commit_removes_values_it_created(tmp_path):
+    backend = registry(FailingBackend)
+    backend.fail = LEGACY
+    with IEWindowsRegEditor(backend) as net:
+        txn = Transaction(net, str(tmp_path / "journal"))
+        txn.set(AUTO_CONFIG, "http://pac/proxy.pac").set(SETTINGS, b"\x46new").set(LEGACY, b"\x46new")
+        with pytest.raises(OSError):
+            txn.commit()
+    assert values(backend) == {AUTO_CONFIG: None, SETTINGS: b"\x46old", LEGACY: b"\x46old"}
+    assert not (tmp_path / "journal").exists()
+
+
+def test_read_error_aborts_instead_of_planning_a_delete(tmp_path):
+    backend = registry(LockedBackend)
+    backend.locked = LEGACY
+    with IEWindowsRegEditor(backend) as net:
+        txn = Transaction(net, str(tmp_path / "journal"))
+        txn.set(SETTINGS, b"\x46new").set(LEGACY, b"\x46new")
+        with pytest.raises(PermissionError):
+            txn.commit()
+    assert values(backend)[SETTINGS] == b"\x46old"
+    assert not (tmp_path / "journal").exists()
+
+
+def test_apply_fails_cleanly_without_connection_settings(tmp_path):
+    backend = MemoryBackend({(HKEY_CURRENT_USER, PATH.rsplit("\\", 1)[0]): {}, (HKEY_CURRENT_USER, PATH): {}})
+    saved = ProxyHelper.backend, ProxyHelper.journal_file
+    ProxyHelper.backend, ProxyHelper.journal_file = backend, str(tmp_path / "journal")
+    try:
+        result = ProxyHelper.install_pac_file("http://pac/proxy.pac")
+    finally:
+        ProxyHelper.backend, ProxyHelper.journal_file = saved
+    assert not result
+    assert result.error == NO_SETTINGS_ERR
+    assert backend.writes == 0
+
+
+def test_recover_backward_removes_created_values(tmp_path):
+    backend = registry()
+    journal = tmp_path / "journal"
+    with IEWindowsRegEditor(backend) as net:
+        net.write_value(AUTO_CONFIG, "http://pac/proxy.pac")
+        journal.write_text(json.dumps({
+            "before": {AUTO_CONFIG: None, SETTINGS: encode_value(b"\x46old")},
+            "after": {AUTO_CONFIG: encode_value("http://pac/proxy.pac"), SETTINGS: encode_value(b"\x46new")},
+        }))
+        assert Transaction.recover(net, str(journal), forward=False) == 1
+    assert values(backend)[AUTO_CONFIG] is None
+    assert not journal.exists()
+
+
+def test_recover_forward(tmp_path):
+    backend = registry()
+    journal = tmp_path / "journal"
+    journal.write_text(json.dumps({
+        "before": {AUTO_CONFIG: None},
+        "after": {AUTO_CONFIG: encode_value("http://pac/proxy.pac")},
+    }))
+    with IEWindowsRegEditor(backend) as net:
+        assert Transaction.recover(net, str(journal)) == 1
+    assert values(backend)[AUTO_CONFIG] == "http://pac/proxy.pac"
+
+
+def test_recover_quarantines_unreadable_journal(tmp_path):
+    journal = tmp_path / "journal"
+    journal.write_text("{not json")
+    with IEWindowsRegEditor(registry()) as net:
+        with pytest.raises(ValueError, match="Unreadable journal"):
+            Transaction.recover(net, str(journal))
+        assert Transaction.recover(net, str(journal)) is None
+    assert (tmp_path / "journal.corrupt").read_text() == "{not json"
+
+
+def test_cli_recovers_before_writes_only(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    for name in ("backend", "backup_file", "backup_store", "journal_file"):
+        monkeypatch.setattr(ProxyHelper, name, getattr(ProxyHelper, name))
+    saved = FileBackend(str(tmp_path / "registry.json"))
+    saved.keys = registry().keys
+    saved.save()
+    journal = tmp_path / ProxyHelper.journal_file
+    journal.write_text(json.dumps({
+        "before": {AUTO_CONFIG: None},
+        "after": {AUTO_CONFIG: encode_value("http://pac/proxy.pac")},
+    }))
+    main = runpy.run_path(os.path.join(ROOT, "__main__.py"))["main"]
+    for argv in (["backup", "--list"], ["users"], ["status"]):
+        main(["--registry", "registry.json"] + argv)
+        assert journal.exists()
+        assert values(FileBackend(str(tmp_path / "registry.json")))[AUTO_CONFIG] is None
+    assert main(["--registry", "registry.json", "backup"]) == 0
+    assert not journal.exists()
+    assert values(FileBackend(str(tmp_path / "registry.json")))[AUTO_CONFIG] == "http://pac/proxy.pac"
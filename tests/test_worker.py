@@ -0,0 +1,77 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import threading
+
+from worker import Worker
+
+
+def blocked_worker():
+    worker = Worker()
+    gate = threading.Event()
+    worker.submit("block", gate.wait)
+    return worker, gate
+
+
+def test_coalesced_submit_chains_the_callback():
+    worker, gate = blocked_worker()
+    results = []
+    first = worker.submit("job", lambda: 1, callback=results.append)
+    second = worker.submit("job", lambda: 2, callback=results.append)
+    assert first is second
+    gate.set()
+    second.result()
+    worker.shutdown()
+    assert [r.value for r in results] == [1, 1]
+
+
+def test_exceptions_become_failed_results():
+    worker = Worker()
+    results = []
+
+    def fail():
+        raise OSError("boom")
+
+    worker.submit(None, fail, callback=results.append)
+    worker.shutdown()
+    assert not results[0].ok and results[0].error == "boom"
+
+
+def test_drain_runs_keyless_jobs_only():
+    worker, gate = blocked_worker()
+    ran = []
+    worker.submit("apply", ran.append, "keyed")
+    worker.submit(None, ran.append, "history")
+    # Cancel before the blocker returns, then wait for the keyless job
+    worker.shutdown(wait=False, drain=True)
+    gate.set()
+    worker.shutdown(drain=True)
+    assert ran == ["history"]
+
+
+def test_shutdown_drops_queued_jobs():
+    worker, gate = blocked_worker()
+    ran = []
+    worker.submit(None, ran.append, "history")
+    threading.Timer(0.05, gate.set).start()
+    worker.shutdown()
+    assert ran == []
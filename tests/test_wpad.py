@@ -0,0 +1,121 @@
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+
+import pytest
+
+from dnscache import DnsCache, StubResolver
+from pacserver import PacServer
+from wpad import WpadCache, WpadDiscovery, candidates
+
+
+PAC = b'function FindProxyForURL(url, host) { return "PROXY p.corp.example:8080"; }'
+
+
+@pytest.fixture
+def server():
+    server = PacServer(PAC).start_in_thread()
+    yield server
+    server.stop_thread()
+
+
+def discovery(records, server, cache=None, gateway="10.0.0.1"):
+    resolver = DnsCache(StubResolver(records))
+    return WpadDiscovery(["a.corp.example"], gateway, resolver, cache or WpadCache(), port=server.port,
+                         timeout=2.0)
+
+
+def test_candidates_most_specific_first():
+    assert candidates(["a.b.example.com"]) == [
+        "http://wpad.a.b.example.com/wpad.dat",
+        "http://wpad.b.example.com/wpad.dat",
+        "http://wpad.example.com/wpad.dat",
+    ]
+
+
+def test_candidates_stop_at_organisational_domain():
+    assert candidates(["corp.co.uk"]) == ["http://wpad.corp.co.uk/wpad.dat"]
+    assert candidates(["a.corp.com.au"]) == ["http://wpad.a.corp.com.au/wpad.dat",
+                                             "http://wpad.corp.com.au/wpad.dat"]
+    assert candidates(["co.uk", "example"]) == []
+
+
+def test_candidates_deduplicated_across_suffixes():
+    assert candidates(["a.corp.example", "corp.example"]) == [
+        "http://wpad.a.corp.example/wpad.dat",
+        "http://wpad.corp.example/wpad.dat",
+    ]
+
+
+def test_cache_ttl():
+    now = [1000.0]
+    cache = WpadCache(ttl=60, clock=lambda: now[0])
+    cache.put("gw|corp", "http://wpad.corp.example/wpad.dat")
+    assert cache.get("gw|corp") == "http://wpad.corp.example/wpad.dat"
+    now[0] += 61
+    assert cache.get("gw|corp") is None
+
+
+def test_cache_discard_and_persistence(tmp_path):
+    path = str(tmp_path / "wpad.json")
+    cache = WpadCache(path)
+    cache.put("a", "http://wpad.a.example/wpad.dat")
+    cache.put("b", "http://wpad.b.example/wpad.dat")
+    cache.discard("a")
+    reloaded = WpadCache(path)
+    assert reloaded.get("a") is None
+    assert reloaded.get("b") == "http://wpad.b.example/wpad.dat"
+
+
+def test_race_first_valid_answer_wins(server):
+    # wpad.a.corp.example resolves to an address nothing listens on
+    wpad = discovery({"wpad.a.corp.example": "127.0.0.2", "wpad.corp.example": "127.0.0.1"}, server)
+    url = asyncio.run(wpad.race(wpad.candidates()))
+    assert url == "http://wpad.corp.example/wpad.dat"
+    assert list(wpad.errors) == ["http://wpad.a.corp.example/wpad.dat"]
+
+
+def test_race_without_answer(server):
+    wpad = discovery({}, server)
+    assert asyncio.run(wpad.race(wpad.candidates())) is None
+    assert sorted(wpad.errors) == sorted(wpad.candidates())
+    assert all("does not resolve" in error for error in wpad.errors.values())
+
+
+def test_discover_uses_network_cache(server):
+    records = {"wpad.corp.example": "127.0.0.1"}
+    cache = WpadCache()
+    first = discovery(records, server, cache)
+    assert first.discover() == "http://wpad.corp.example/wpad.dat"
+    assert not first.cached
+    again = discovery({}, server, cache)
+    assert again.discover() == "http://wpad.corp.example/wpad.dat"
+    assert again.cached
+    other_network = discovery({}, server, cache, gateway="10.9.9.9")
+    assert other_network.discover() is None
+
+
+def test_rejects_answer_that_is_not_pac(server):
+    server.update(b"<html>captive portal</html>")
+    wpad = discovery({"wpad.corp.example": "127.0.0.1"}, server)
+    assert wpad.discover() is None
+    assert "not a PAC script" in wpad.errors["http://wpad.corp.example/wpad.dat"]
@@ -0,0 +1,179 @@
+# #!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import json
+
+from collections import OrderedDict
+from typing import Dict, Optional
+from reg import IEWindowsRegEditor
+
+
+def encode_value(value) -> Optional[dict]:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return {"s": value}
+    return {"b": bytes(value).hex()}
+
+
+def decode_value(entry: Optional[dict]):
+    if entry is None:
+        return None
+    if "s" in entry:
+        return entry["s"]
+    return bytes.fromhex(entry["b"])
+
+
+class Transaction(object):
+    """
+    Gathers the writes of one settings change and applies them in one pass.
+
+    Values are read at most once. commit() skips every planned value whose
+    current bytes already match, so re-applying the same settings costs only
+    the reads. Before the first write, the old and new values go to a
+    journal file that is removed once all writes succeeded (or a failed
+    commit was undone); recover() uses a leftover journal to finish or undo
+    a commit that was interrupted by a crash.
+    """
+
+    def __init__(self, editor: IEWindowsRegEditor, journal: str=""):
+        self.editor = editor
+        self.journal = journal
+        self.current = {} # type: Dict[str, object]
+        self.planned = OrderedDict()
+        self.reads = self.writes = 0
+
+    def read(self, name: str):
+        """
+        Returns the current value, or None when it does not exist. Other
+        read errors propagate: journaling them as missing would make a
+        rollback delete the value.
+        """
+        if name not in self.current:
+            self.reads += 1
+            try:
+                self.current[name] = self.editor.read_value(name)
+            except FileNotFoundError:
+                self.current[name] = None
+        return self.current[name]
+
+    def set(self, name: str, value) -> "Transaction":
+        """
+        Plans a write of ``value``; None plans the removal of the value.
+        """
+        self.planned[name] = value
+        return self
+
+    def apply(self, name: str, value) -> None:
+        if value is None:
+            self.editor.delete_value(name)
+        else:
+            self.editor.write_value(name, value)
+        self.current[name] = value
+
+    def changes(self) -> "OrderedDict":
+        changed = OrderedDict()
+        for name, value in self.planned.items():
+            current = self.read(name)
+            if value is None:
+                if current is not None:
+                    changed[name] = value
+            elif isinstance(value, str):
+                if current != value:
+                    changed[name] = value
+            elif current is None or bytes(current) != bytes(value):
+                changed[name] = value
+        return changed
+
+    def write_journal(self, changes: dict) -> None:
+        entry = {
+            "before": {name: encode_value(self.current[name]) for name in changes},
+            "after": {name: encode_value(value) for name, value in changes.items()},
+        }
+        temp = "{}.tmp".format(self.journal)
+        with open(temp, "w") as f:
+            json.dump(entry, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.journal)
+
+    def commit(self) -> int:
+        """
+        Returns:
+            int - Number of values written; 0 when nothing changed.
+        """
+        changes = self.changes()
+        if not changes:
+            return 0
+        if self.journal:
+            self.write_journal(changes)
+        before = {name: self.current[name] for name in changes}
+        written = []
+        try:
+            for name, value in changes.items():
+                self.apply(name, value)
+                written.append(name)
+                self.writes += 1
+        except Exception:
+            # Undo what was written, removing values that did not exist;
+            # if that fails too the journal stays behind for recover()
+            for name in reversed(written):
+                self.apply(name, before[name])
+            if self.journal:
+                os.remove(self.journal)
+            raise
+        if self.journal:
+            os.remove(self.journal)
+        self.planned.clear()
+        return len(changes)
+
+    @classmethod
+    def recover(cls, editor: IEWindowsRegEditor, journal: str, forward: bool=True) -> Optional[int]:
+        """
+        Finishes (``forward``) or undoes an interrupted commit.
+
+        Returns:
+            int - Number of values written, or None when there was no
+                interrupted commit.
+
+        Raises:
+            ValueError - If the journal cannot be parsed; it is renamed with
+                a ".corrupt" suffix first.
+        """
+        if not journal or not os.path.exists(journal):
+            return None
+        try:
+            with open(journal) as f:
+                entry = json.load(f)
+            values = {name: decode_value(value)
+                      for name, value in entry["after" if forward else "before"].items()}
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            # Set aside, so an unreadable journal does not fail every start
+            os.replace(journal, journal + ".corrupt")
+            raise ValueError("Unreadable journal moved to {}.corrupt ({})".format(journal, e))
+        txn = cls(editor)
+        for name, value in values.items():
+            txn.set(name, value)
+        count = txn.commit()
+        os.remove(journal)
+        return count
@@ -20,40 +20,56 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from typing import Tuple, List
+import ipaddress
+
+from typing import Callable, Iterator, Tuple, List
 from urllib.parse import urlparse
-from res import HISTORY_LOG_FILE
+from res import HISTORY_LOG_FILE, HISTORY_MAX_BYTES, HISTORY_TAIL
+from history import HistoryLog
+from metrics import timed
 
 
 class FileWriter(object):
 
-    buffer = set([])
-
     def __init__(self, filepath: str):
         self.filepath = filepath
+        self.buffer = []
 
     def add(self, data: bytes) -> "FileWriter":
-        self.buffer.add(data)
+        self.buffer.append(data)
         return self
 
     def binary_dump(self) -> Tuple[bool, str]:
         try:
             with open(self.filepath, "wb") as file_:
-                [file_.write(d) for d in self.buffer]
+                file_.writelines(self.buffer)
         except Exception as e:
             return False, str(e)
         return True, ""
 
     def flush(self) -> "FileWriter":
-        self.buffer = set([])
+        self.buffer = []
         return self
 
 
-def hex_dump(data: bytes) -> List[Tuple]:
-    return [(i, b) for i, b in enumerate(list(data))]
+def hex_dump(data: bytes, width: int=16) -> Iterator[str]:
+    """
+    Classic offset/hex/ASCII dump, one line per ``width`` bytes. Lines are
+    produced lazily over a memoryview, so large blobs are not copied.
+    """
+    view = memoryview(data).cast("B")
+    for offset in range(0, len(view), width):
+        row = view[offset:offset + width].tobytes()
+        text = "".join(chr(b) if 32 <= b < 127 else "." for b in row)
+        yield "{:08x}  {:<{}}  |{}|".format(offset, row.hex(" "), width * 3 - 1, text)
 
 
-def validate_pac_url(url: str) -> bool:
+def validate_pac_url(url: str, resolver: Callable[[str], str]=None) -> bool:
+    """
+    Whether ``url`` looks like a PAC file URL (a .pac file, or a WPAD
+    wpad.dat). With a ``resolver`` (e.g. dnscache.shared().get), its host
+    must also resolve.
+    """
     if len(url.strip()) == 0:
         return False
     vld = urlparse(url)
@@ -61,22 +77,43 @@ def validate_pac_url(url: str) -> bool:
         return False
     if vld.netloc == "":
         return False
-    if not vld.path.endswith(".pac"):
+    if not vld.path.endswith((".pac", "/wpad.dat")):
         return False
+    if resolver is not None:
+        return host_resolves(vld.hostname or "", resolver)
     return True
 
 
-def history_log(event: str) -> Tuple[bool, str]:
+def host_resolves(host: str, resolver: Callable[[str], str]) -> bool:
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return bool(host) and resolver(host) is not None
+
+
+_HISTORY = None
+
+
+def history() -> HistoryLog:
+    global _HISTORY
+    if _HISTORY is None:
+        _HISTORY = HistoryLog(HISTORY_LOG_FILE, HISTORY_MAX_BYTES)
+    return _HISTORY
+
+
+@timed("history.append")
+def history_log(event: str, kind: str="event") -> Tuple[bool, str]:
     try:
-        with open(HISTORY_LOG_FILE, "a") as file_:
-            file_.write(event)
+        history().append(event.rstrip("\n"), kind)
         return True, event
     except Exception as e:
         return False, str(e)
 
-def history_init() -> Tuple[bool, str]:
+@timed("history.tail")
+def history_init(count: int=HISTORY_TAIL) -> Tuple[bool, str]:
     try:
-        with open(HISTORY_LOG_FILE, "r") as file_:
-            return True, file_.read()
+        records, _ = history().tail(count)
+        return True, "".join("{}\n".format(r) for r in records)
     except Exception as e:
         return False, str(e)
@@ -0,0 +1,103 @@
+# #!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Dict, Optional
+from proxy import Result
+
+
+class Worker(object):
+    """
+    Runs registry, network and history work off the GUI thread.
+
+    Jobs run one at a time on a single background thread, so registry
+    writes and history appends never race each other. Each job returns a
+    Result (exceptions become failed Results) which is handed to its
+    callback through ``dispatch``; the GUI passes wx.CallAfter so callbacks
+    run on the event loop. Submitting a key that is still queued or running
+    returns the existing future instead of queueing the job again, which
+    coalesces repeated clicks; the new callback is chained onto it, so a key
+    must only be shared by identical jobs. Jobs submitted without a key
+    always run.
+    """
+
+    def __init__(self, dispatch: Callable=None, workers: int=1):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ipsx-worker")
+        self.dispatch = dispatch or (lambda cb, *args: cb(*args))
+        self.pending = {} # type: Dict[str, Future]
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def run(job: Callable, *args) -> Result:
+        try:
+            result = job(*args)
+        except Exception as e:
+            return Result.failure(str(e))
+        if isinstance(result, Result):
+            return result
+        return Result.success(value=result)
+
+    def submit(self, key: Optional[str], job: Callable, *args,
+               callback: Callable[[Result], None]=None) -> Future:
+        if key is None:
+            future = self.executor.submit(self.run, job, *args)
+            future.add_done_callback(lambda f: self._done(key, f, callback))
+            return future
+        with self.lock:
+            future = self.pending.get(key)
+            if future is None or future.done():
+                future = self.executor.submit(self.run, job, *args)
+            self.pending[key] = future
+        future.add_done_callback(lambda f: self._done(key, f, callback))
+        return future
+
+    def _done(self, key: Optional[str], future: Future, callback: Callable[[Result], None]) -> None:
+        with self.lock:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+        if callback is not None and not future.cancelled():
+            self.dispatch(callback, future.result())
+
+    def busy(self, key: str=None) -> bool:
+        with self.lock:
+            if key is not None:
+                future = self.pending.get(key)
+                return future is not None and not future.done()
+            return any(not f.done() for f in self.pending.values())
+
+    def shutdown(self, wait: bool=True, drain: bool=False) -> None:
+        """
+        Drops queued jobs and, with ``wait``, blocks until the running one
+        has finished. With ``drain``, only keyed jobs are dropped: the
+        keyless ones (e.g. history appends) still run before the worker
+        stops.
+        """
+        if not drain:
+            self.executor.shutdown(wait=wait, cancel_futures=True)
+            return
+        with self.lock:
+            keyed = list(self.pending.values())
+        for future in keyed:
+            future.cancel()
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,296 @@
+# #!/usr/bin/env python
+#
+# Copyright 2018 ip.sx
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import threading
+
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlparse
+from backend import RegistryBackend, HKEY_LOCAL_MACHINE, KEY_READ
+from dnscache import DnsCache, shared
+from mirrors import http_get
+from pac import PacScript, PacHelpers, PacError
+from pacfetch import PacFetcher
+from res import WPAD_TTL
+
+
+TCPIP_PARAMETERS = "SYSTEM\\CurrentControlSet\\Services\\Tcpip\\Parameters"
+RESOLV_CONF = "/etc/resolv.conf"
+PROC_ROUTE = "/proc/net/route"
+
+
+def _query(backend: RegistryBackend, path: str, name: str):
+    try:
+        handle = backend.open_key(HKEY_LOCAL_MACHINE, path, KEY_READ)
+    except OSError:
+        return None
+    try:
+        return backend.query_value(handle, name)[0]
+    except OSError:
+        return None
+    finally:
+        backend.close_key(handle)
+
+
+def search_domains(backend: RegistryBackend=None) -> List[str]:
+    """
+    DNS search suffixes of this machine: the TCP/IP parameters in the
+    registry on Windows (or from ``backend``), resolv.conf elsewhere, and
+    the domain of the host name as a last resort.
+    """
+    domains = []
+    if backend is None and sys.platform == "win32":
+        from backend import WinRegBackend
+        backend = WinRegBackend()
+    if backend is not None:
+        for name in ("SearchList", "Domain", "DhcpDomain"):
+            value = _query(backend, TCPIP_PARAMETERS, name) or ""
+            domains.extend(value.replace(" ", ",").split(","))
+    else:
+        try:
+            with open(RESOLV_CONF, "r") as f:
+                for line in f:
+                    words = line.split()
+                    if words and words[0] in ("search", "domain"):
+                        domains.extend(words[1:])
+        except OSError:
+            pass
+    if not any(domains):
+        domains.append(socket.getfqdn().partition(".")[2])
+    result = []
+    for domain in domains:
+        domain = domain.strip().strip(".").lower()
+        if domain and domain not in result:
+            result.append(domain)
+    return result
+
+
+def default_gateway(backend: RegistryBackend=None) -> str:
+    """
+    Address of the default gateway, "" when unknown.
+    """
+    if backend is None and sys.platform == "win32":
+        from backend import WinRegBackend
+        backend = WinRegBackend()
+    if backend is not None:
+        interfaces = TCPIP_PARAMETERS + "\\Interfaces"
+        try:
+            names = backend.enum_keys(HKEY_LOCAL_MACHINE, interfaces)
+        except OSError:
+            return ""
+        for name in names:
+            for value in ("DhcpDefaultGateway", "DefaultGateway"):
+                gateways = _query(backend, interfaces + "\\" + name, value) or []
+                gateways = [g for g in ([gateways] if isinstance(gateways, str) else gateways) if g]
+                if gateways:
+                    return gateways[0]
+        return ""
+    try:
+        with open(PROC_ROUTE, "r") as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if len(fields) > 3 and fields[1] == "00000000" and int(fields[3], 16) & 0x2:
+                    return socket.inet_ntoa(int(fields[2], 16).to_bytes(4, "little"))
+    except (OSError, ValueError):
+        pass
+    return ""
+
+
+# Second-level labels under which country-code registries sell names
+# (co.uk, com.au, ac.jp...): with them, the public suffix has two labels.
+CC_SECOND_LEVEL = frozenset((
+    "ac", "co", "com", "edu", "gen", "go", "gob", "gov", "gv", "ltd", "me",
+    "mil", "ne", "net", "nic", "or", "org", "plc", "sch",
+))
+
+
+def suffix_labels(labels: List[str]) -> int:
+    """
+    Number of labels of the public suffix ``labels`` ends with.
+    """
+    if len(labels) >= 2 and len(labels[-1]) == 2 and labels[-2] in CC_SECOND_LEVEL:
+        return 2
+    return 1
+
+
+def candidates(domains: List[str]) -> List[str]:
+    """
+    WPAD URLs for the search suffixes, most specific first: a.b.example
+    gives wpad.a.b.example and wpad.b.example. Devolution stops at the
+    organisational domain (the public suffix plus one label), so nothing
+    like wpad.com or wpad.co.uk, which anyone could register, is tried.
+    """
+    urls = []
+    for domain in domains:
+        labels = domain.split(".")
+        for i in range(len(labels) - suffix_labels(labels)):
+            url = "http://wpad.{}/wpad.dat".format(".".join(labels[i:]))
+            if url not in urls:
+                urls.append(url)
+    return urls
+
+
+def is_pac(body: bytes) -> bool:
+    """
+    Whether ``body`` is a PAC script defining FindProxyForURL.
+    """
+    text = body.decode("utf-8", "replace")
+    if "FindProxyForURL" not in text:
+        return False
+    try:
+        PacScript(text, PacHelpers(resolver=lambda host: None))
+    except PacError:
+        return False
+    return True
+
+
+class WpadCache(object):
+    """
+    Discovered WPAD URLs per network, kept ``ttl`` seconds and persisted
+    as JSON in ``path`` (memory only without one).
+    """
+
+    def __init__(self, path: str=None, ttl: float=WPAD_TTL, clock: Callable[[], float]=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = {} # type: Dict[str, list]
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+
+    def get(self, network: str) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(network)
+        if entry is None or entry[1] + self.ttl <= self.clock():
+            return None
+        return entry[0]
+
+    def put(self, network: str, url: str) -> None:
+        with self.lock:
+            self.entries[network] = [url, self.clock()]
+        self.save()
+
+    def discard(self, network: str) -> None:
+        with self.lock:
+            found = self.entries.pop(network, None) is not None
+        if found:
+            self.save()
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self.lock:
+            data = dict(self.entries)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class WpadDiscovery(object):
+    """
+    Web Proxy Auto-Discovery over DNS.
+
+    Every candidate URL is probed at once: its host is resolved through
+    the DnsCache, then wpad.dat is fetched and must be a PAC script. The
+    first valid answer wins and the other probes are cancelled. Answers
+    are cached per network, keyed by gateway and search suffixes, so a
+    known network is recognized without any probe.
+    """
+
+    def __init__(self, domains: List[str]=None, gateway: str=None, resolver: DnsCache=None,
+                 cache: WpadCache=None, port: int=80, timeout: float=3.0):
+        self.domains = search_domains() if domains is None else [d.strip(".").lower() for d in domains]
+        self.gateway = default_gateway() if gateway is None else gateway
+        self.resolver = resolver if resolver is not None else shared()
+        self.cache = cache if cache is not None else WpadCache()
+        self.port = port
+        self.timeout = timeout
+        self.errors = {} # type: Dict[str, str]
+        self.cached = False
+
+    def network(self) -> str:
+        return "{}|{}".format(self.gateway, ",".join(self.domains))
+
+    def candidates(self) -> List[str]:
+        return candidates(self.domains)
+
+    async def probe(self, url: str) -> str:
+        """
+        Returns:
+            str - ``url``, when it serves a PAC script.
+
+        Raises:
+            Exception - Describing why it does not.
+        """
+        parts = urlparse(url)
+        address = await self.resolver.resolve(parts.hostname)
+        if address is None:
+            raise LookupError("{} does not resolve".format(parts.hostname))
+        target = parts._replace(netloc="{}:{}".format(parts.hostname, self.port)).geturl()
+        status, body = await http_get(target, self.timeout, PacFetcher.MAX_SIZE, address)
+        if status != 200:
+            raise ValueError("HTTP {}".format(status))
+        if not is_pac(body):
+            raise ValueError("not a PAC script")
+        return url
+
+    async def race(self, urls: List[str]) -> Optional[str]:
+        tasks = {asyncio.ensure_future(self.probe(url)): url for url in urls}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    self.errors[tasks[task]] = str(task.exception()) or type(task.exception()).__name__
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+    def discover(self, fresh: bool=False) -> Optional[str]:
+        """
+        The WPAD URL of the current network, or None if there is none.
+        """
+        network = self.network()
+        self.errors = {}
+        url = None if fresh else self.cache.get(network)
+        self.cached = url is not None
+        if url is None:
+            url = asyncio.run(self.race(self.candidates()))
+            if url is not None:
+                self.cache.put(network, url)
+        return url